@@ -27,7 +27,7 @@ from .grammar import lcfrsproductions, printrule
 from .treetransforms import binarize, handledisc
 
 cimport cython
-from libc.stdlib cimport malloc, realloc, free
+from libc.stdlib cimport malloc, calloc, realloc, free, qsort
 from libc.string cimport memset, memcpy
 from libc.stdint cimport uint8_t, uint32_t, uint64_t, SIZE_MAX
 from cpython.array cimport array, clone, extend_buffer, resize
@@ -109,7 +109,8 @@ cdef inline void setrootid(uint64_t *data, short root, uint32_t id,
 cpdef extractfragments(Ctrees trees1, int start1, int end1, Vocabulary vocab,
 		Ctrees trees2=None, int start2=0, int end2=0,
 		bint approx=True, bint debug=False,
-		bint disc=False, str twoterms=None, bint adjacent=False):
+		bint disc=False, str twoterms=None, bint adjacent=False,
+		object subset1=None, object subset2=None):
 	"""Find the largest fragments in treebank(s) with the fast tree kernel.
 
 	- scenario 1: recurring fragments in single treebank, use::
@@ -129,6 +130,9 @@ cpdef extractfragments(Ctrees trees1, int start1, int end1, Vocabulary vocab,
 		one of which has a POS tag matching the given regex.
 	:param adjacent: only extract fragments from sentences with adjacent
 		indices.
+	:param subset1, subset2: if given, a RoaringBitmap with indices of trees;
+		only pairs of trees in these subsets of ``trees1`` and ``trees2``
+		are compared; cf. ``selecttrees()``.
 	:returns: a dictionary; keys are fragments as strings; values are
 		either counts (if approx=True), or bitsets describing fragments of
 		``trees1``.
@@ -154,19 +158,22 @@ cpdef extractfragments(Ctrees trees1, int start1, int end1, Vocabulary vocab,
 	if trees2 is None:
 		trees2 = trees1
 	SLOTS = BITNSLOTS(max(trees1.maxnodes, trees2.maxnodes) + 1)
-	matrix = <uint64_t *>malloc(trees2.maxnodes * SLOTS * sizeof(uint64_t))
+	# the matrix is cleared by extractbitsets() after each tree pair
+	matrix = <uint64_t *>calloc(trees2.maxnodes * SLOTS, sizeof(uint64_t))
 	scratch = <uint64_t *>malloc((SLOTS + 2) * sizeof(uint64_t))
 	if matrix is NULL or scratch is NULL:
 		raise MemoryError('allocation error')
 	end2 = min(end2 or trees2.len, trees2.len)
 	# loop over tree pairs to extract fragments from
 	for n in range(start1, min(end1 or trees1.len, trees1.len)):
+		if subset1 is not None and n not in subset1:
+			continue
 		a = trees1.trees[n]
 		asent = trees1.extractsent(n, vocab)
 		anodes = &trees1.nodes[a.offset]
 		if adjacent:
 			m = n + 1
-			if m < trees2.len:
+			if m < trees2.len and (subset2 is None or m in subset2):
 				extractfrompair(a, anodes, trees2, n, m, debug,
 						vocab, inter, minterms, matrix, scratch, SLOTS)
 		elif twoterms:
@@ -176,10 +183,19 @@ cpdef extractfragments(Ctrees trees1, int start1, int end1, Vocabulary vocab,
 					continue
 				elif start2 > m or m > end2:
 					continue
+				elif subset2 is not None and m not in subset2:
+					continue
 				elif m < 0 or m >= trees2.len:
 					raise ValueError('illegal index %d' % m)
 				extractfrompair(a, anodes, trees2, n, m, debug,
 						vocab, inter, minterms, matrix, scratch, SLOTS)
+		elif subset2 is not None:
+			if trees1 is trees2:
+				start2 = max(n + 1, start2)
+			for m in subset2.clamp(start2, end2):
+				extractfrompair(a, anodes, trees2, n, m,
+						debug, vocab, inter, minterms, matrix,
+						scratch, SLOTS)
 		else:  # all pairs
 			if trees1 is trees2:
 				start2 = max(n + 1, start2)
@@ -197,20 +213,23 @@ cpdef extractfragments(Ctrees trees1, int start1, int end1, Vocabulary vocab,
 cdef inline extractfrompair(NodeArray a, Node *anodes, Ctrees trees2,
 		int n, int m, bint debug, Vocabulary vocab, set inter,
 		short minterms, uint64_t *matrix, uint64_t *scratch, short SLOTS):
-	"""Extract the bitsets of maximal overlapping fragments for a tree pair."""
+	"""Extract the bitsets of maximal overlapping fragments for a tree pair.
+
+	Expects ``matrix`` to be zeroed; it is left zeroed as well, since
+	extractbitsets() clears every bit it visits."""
 	cdef NodeArray b = trees2.trees[m]
 	cdef Node *bnodes = &trees2.nodes[b.offset]
-	# initialize table
-	memset(<void *>matrix, 0, b.len * SLOTS * sizeof(uint64_t))
 	# fill table
-	fasttreekernel(anodes, bnodes, a.len, b.len, matrix, SLOTS)
+	cdef int common = fasttreekernel(anodes, bnodes, a.len, b.len,
+			matrix, SLOTS)
 	# dump table
 	if debug:
 		print(n, m)
 		dumpmatrix(matrix, a, b, anodes, bnodes, vocab, scratch, SLOTS)
-	# extract results
-	extractbitsets(matrix, anodes, bnodes, b.root, n,
-			inter, minterms, scratch, SLOTS)
+	# extract results; most tree pairs have no productions in common.
+	if common:
+		extractbitsets(matrix, anodes, bnodes, b.root, n,
+				inter, minterms, scratch, SLOTS)
 
 
 cdef inline collectfragments(dict fragments, set inter, Node *anodes,
@@ -242,36 +261,39 @@ cdef inline collectfragments(dict fragments, set inter, Node *anodes,
 	inter.clear()
 
 
-cdef inline void fasttreekernel(Node *a, Node *b, int alen, int blen,
+cdef inline int fasttreekernel(Node *a, Node *b, int alen, int blen,
 		uint64_t *matrix, short SLOTS):
 	"""Fast Tree Kernel (average case linear time).
 
 	Expects trees to be sorted according to their productions (in descending
 	order, with terminals as -1). This algorithm is from the pseudocode in
 	Moschitti (2006): Making Tree Kernels practical for Natural Language
-	Learning."""
+	Learning.
+
+	:returns: the number of pairs of nodes with a common production."""
 	# i is an index to a, j to b, and ii is a temp index starting at i.
-	cdef int i = 0, j = 0, ii = 0
+	cdef int i = 0, j = 0, ii = 0, common = 0
 	while True:
 		if a[i].prod < b[j].prod:
 			i += 1
 			if i >= alen:
-				return
+				return common
 		elif a[i].prod > b[j].prod:
 			j += 1
 			if j >= blen:
-				return
+				return common
 		else:
 			while a[i].prod == b[j].prod:
 				ii = i
 				while a[ii].prod == b[j].prod:
 					SETBIT(&matrix[j * SLOTS], ii)
+					common += 1
 					ii += 1
 					if ii >= alen:
 						break
 				j += 1
 				if j >= blen:
-					return
+					return common
 
 
 cdef inline extractbitsets(uint64_t *matrix, Node *a, Node *b, short j, int n,
@@ -320,7 +342,7 @@ cdef inline int extractat(uint64_t *matrix, uint64_t *result, Node *a, Node *b,
 
 
 cpdef exactcounts(Ctrees trees1, Ctrees trees2, list bitsets,
-		int indices=False, maxnodes=None):
+		int indices=False, maxnodes=None, object subset=None):
 	"""Get exact counts or indices of occurrence for fragments.
 
 	:param trees1, bitsets: ``bitsets`` defines fragments of trees in
@@ -337,6 +359,8 @@ cpdef exactcounts(Ctrees trees1, Ctrees trees2, list bitsets,
 		bitset size; use the same value as the function that generated these
 		bitsets. For ``extractfragments``, it is the maximum value across both
 		treebanks, which is also the default here.
+	:param subset: if given, a RoaringBitmap with indices of trees;
+		only occurrences in this subset of ``trees2`` are considered.
 	:returns: depending on ``indices``:
 
 		:0: an array of counts, corresponding to ``bitsets``.
@@ -381,6 +405,8 @@ cpdef exactcounts(Ctrees trees1, Ctrees trees2, list bitsets,
 				0, 0, SLOTS)
 		if candidates is None:  # ran across unseen production
 			continue
+		if subset is not None:
+			candidates = candidates & subset
 		if indices == 1:
 			treenums = theindices[n]
 		elif indices == 2:
@@ -389,7 +415,7 @@ cpdef exactcounts(Ctrees trees1, Ctrees trees2, list bitsets,
 		for m in candidates:
 			b = &(trees2.trees[m])
 			bnodes = &trees2.nodes[b.offset]
-			for j in range(b.len):
+			for j in range(firstnode(bnodes, b.len, anodes[i].prod), b.len):
 				if anodes[i].prod == bnodes[j].prod:
 					if containsbitset(anodes, bnodes, bitset, i, j):
 						if indices == 0:
@@ -405,7 +431,8 @@ cpdef exactcounts(Ctrees trees1, Ctrees trees2, list bitsets,
 
 
 cpdef exactcountsslice(Ctrees trees1, Ctrees trees2, list bitsets,
-		int indices=0, maxnodes=None, start=None, end=None, maxresults=None):
+		int indices=0, maxnodes=None, start=None, end=None, maxresults=None,
+		object subset=None):
 	"""Get counts of fragments in a slice of the treebank.
 
 	Variant of exactcounts() that releases the GIL in the inner loop and is
@@ -414,6 +441,8 @@ cpdef exactcountsslice(Ctrees trees1, Ctrees trees2, list bitsets,
 	:param start, end: only search through this interval of trees from
 		``trees2`` (defaults to all trees).
 	:param maxresults: stop searching after this number of matchs.
+	:param subset: if given, a RoaringBitmap with indices of trees;
+		only occurrences in this subset of ``trees2`` are considered.
 	:returns: depending on ``indices``:
 
 		:0: an array of counts, corresponding to ``bitsets``.
@@ -469,6 +498,8 @@ cpdef exactcountsslice(Ctrees trees1, Ctrees trees2, list bitsets,
 				start_, end_, SLOTS)
 		if candidates is None:  # ran across unseen production
 			continue
+		if subset is not None:
+			candidates = candidates & subset
 		candidatesarray.extend(candidates)
 		numcandidates = len(candidatesarray)
 		if indices == 1:
@@ -510,7 +541,7 @@ cdef int countbitset(uint64_t *bitset, Node *anodes, int i, int n,
 		m = candidatesarrayp[x]
 		b = trees[m]
 		bnodes = &nodes[b.offset]
-		for j in range(b.len):
+		for j in range(firstnode(bnodes, b.len, anodes[i].prod), b.len):
 			if anodes[i].prod == bnodes[j].prod:
 				if containsbitset(anodes, bnodes, bitset, i, j):
 					if indices == 0:
@@ -540,6 +571,167 @@ cdef int countbitset(uint64_t *bitset, Node *anodes, int i, int n,
 	return cnt
 
 
+cpdef exactcountsbatch(Ctrees trees1, Ctrees trees2, list bitsets,
+		maxnodes=None, start=None, end=None, object subset=None):
+	"""Get counts of a batch of fragments with a single pass over the trees.
+
+	Variant of exactcountsslice() for large numbers of fragments. The posting
+	list of each production is looked up once for the whole batch, and the
+	candidate trees of all fragments are visited in order; each tree is
+	matched against all fragments for which it is a candidate while its
+	nodes are in the cache.
+
+	:param start, end: only search through this interval of trees from
+		``trees2`` (defaults to all trees).
+	:param subset: if given, a RoaringBitmap with indices of trees;
+		only occurrences in this subset of ``trees2`` are considered.
+	:returns: an array of counts, corresponding to ``bitsets``."""
+	cdef:
+		array counts = clone(uintarray, len(bitsets), True)
+		array candidatesarray = clone(uintarray, 0, False)
+		dict postings = {}
+		object candidates, posting  # RoaringBitmap
+		short SLOTS
+		int k, idx, start_ = start or 0, end_ = end or trees2.len
+		uint32_t n, x, numcandidates, numfrags = len(bitsets)
+		size_t numpairs = 0, allocated = 1024
+		uint64_t cur
+		uint64_t *pairs = NULL
+		uint64_t *tmp = NULL
+		uint64_t **fragbitsets = NULL
+		Node **fragnodes = NULL
+		short *roots = NULL
+		NodeArray *a
+		Node *anodes
+		uint64_t *bitset
+	if maxnodes:
+		SLOTS = BITNSLOTS(maxnodes + 1)
+	else:
+		SLOTS = BITNSLOTS(max(trees1.maxnodes, trees2.maxnodes) + 1)
+	if numfrags == 0:
+		return counts
+	pairs = <uint64_t *>malloc(allocated * sizeof(uint64_t))
+	fragbitsets = <uint64_t **>malloc(numfrags * sizeof(uint64_t *))
+	fragnodes = <Node **>malloc(numfrags * sizeof(Node *))
+	roots = <short *>malloc(numfrags * sizeof(short))
+	try:
+		if (pairs is NULL or fragbitsets is NULL or fragnodes is NULL
+				or roots is NULL):
+			raise MemoryError
+		# collect (tree, fragment) pairs for the candidates of each fragment
+		for n, wrapper in enumerate(bitsets):
+			bitset = getpointer(wrapper)
+			a = &(trees1.trees[getid(bitset, SLOTS)])
+			anodes = &trees1.nodes[a.offset]
+			fragbitsets[n] = bitset
+			fragnodes[n] = anodes
+			roots[n] = getroot(bitset, SLOTS)
+			candidates = None
+			cur = bitset[0]
+			idx = 0
+			while True:
+				k = iteratesetbits(bitset, SLOTS, &cur, &idx)
+				if k == -1 or k >= a.len:
+					break
+				try:
+					posting = postings[anodes[k].prod]
+				except KeyError:
+					posting = postings[anodes[k].prod] = getposting(
+							trees2, anodes[k].prod, start_, end_)
+				if candidates is None:
+					candidates = posting
+				else:
+					candidates = candidates & posting
+				if not candidates:
+					break
+			if subset is not None and candidates:
+				candidates = candidates & subset
+			if not candidates:
+				continue
+			candidatesarray.extend(candidates)
+			numcandidates = len(candidatesarray)
+			if numpairs + numcandidates > allocated:
+				allocated = 2 * (numpairs + numcandidates)
+				tmp = <uint64_t *>realloc(pairs, allocated * sizeof(uint64_t))
+				if tmp is NULL:
+					raise MemoryError
+				pairs = tmp
+			for x in range(numcandidates):
+				pairs[numpairs] = (<uint64_t>candidatesarray.data.as_uints[x]
+						<< 32) | n
+				numpairs += 1
+			resize(candidatesarray, 0)
+		# visit the candidate trees in order
+		qsort(pairs, numpairs, sizeof(uint64_t), &cmpuint64)
+		with nogil:
+			countpairs(pairs, numpairs, fragbitsets, fragnodes, roots,
+					trees2.trees, trees2.nodes, counts.data.as_uints)
+	finally:
+		free(pairs)
+		free(fragbitsets)
+		free(fragnodes)
+		free(roots)
+	return counts
+
+
+cdef void countpairs(uint64_t *pairs, size_t numpairs,
+		uint64_t **fragbitsets, Node **fragnodes, short *roots,
+		NodeArray *trees, Node *nodes, uint32_t *countsp) nogil:
+	"""Internal function to match fragments against their candidate trees.
+
+	:param pairs: sorted array of tree numbers in the upper 32 bits, paired
+		with fragment numbers in the lower 32 bits."""
+	cdef NodeArray b
+	cdef Node *anodes
+	cdef Node *bnodes
+	cdef size_t x
+	cdef uint32_t m, n
+	cdef int i, j
+	for x in range(numpairs):
+		m = pairs[x] >> 32
+		n = pairs[x] & 0xffffffffUL
+		b = trees[m]
+		bnodes = &nodes[b.offset]
+		anodes = fragnodes[n]
+		i = roots[n]
+		for j in range(firstnode(bnodes, b.len, anodes[i].prod), b.len):
+			if anodes[i].prod != bnodes[j].prod:
+				break
+			elif containsbitset(anodes, bnodes, fragbitsets[n], i, j):
+				countsp[n] += 1
+
+
+cdef getposting(Ctrees trees, int prod, int start, int end):
+	"""Return the trees in the interval ``start:end`` with a production.
+
+	:param prod: the ID of a production, as in ``trees.prodindex``."""
+	cdef object posting = trees.prodindex.get(prod)
+	if posting is None:
+		return RoaringBitmap()
+	return posting.clamp(start, end)
+
+
+cdef int cmpuint64(const void *p1, const void *p2) nogil:
+	cdef uint64_t a = (<uint64_t *>p1)[0]
+	cdef uint64_t b = (<uint64_t *>p2)[0]
+	return (a > b) - (a < b)
+
+
+cdef inline int firstnode(Node *nodes, int length, int prod) nogil:
+	"""Binary search for the first node with a production ``>= prod``.
+
+	Nodes are sorted by production, so the nodes with a production equal to
+	``prod`` start at the returned index."""
+	cdef int lo = 0, hi = length, mid
+	while lo < hi:
+		mid = (lo + hi) >> 1
+		if nodes[mid].prod < prod:
+			lo = mid + 1
+		else:
+			hi = mid
+	return lo
+
+
 cdef getcandidates(Node *a, uint64_t *bitset, Ctrees trees, short alen,
 		int start, int end, short SLOTS):
 	"""Get candidates from productions in fragment ``bitset`` at ``a[i]``."""
@@ -625,6 +817,91 @@ cpdef completebitsets(Ctrees trees, Vocabulary vocab,
 	return result, bitsets
 
 
+def selecttrees(Ctrees trees, Vocabulary vocab, str pattern):
+	"""Select trees with a label or production matching a regex.
+
+	:param pattern: a regular expression that should match the whole label,
+		or a production of the binarized trees written as
+		``LHS RHS1 [RHS2]``, or ``POS word`` for lexical productions.
+	:returns: a RoaringBitmap with the indices of the selected trees."""
+	cdef Rule *rule
+	cdef int n
+	cdef list result = []
+	match = re.compile('(?:%s)$' % pattern).match
+	for n in range(len(trees.prodindex)):
+		rule = <Rule *>&vocab.prodbuf.d.aschar[n * sizeof(Rule)]
+		lhs = vocab.idtolabel(rule.lhs)
+		if rule.rhs1 == 0:
+			prod = '%s %s' % (lhs,
+					vocab.idtolabel(rule.args) if rule.args else '')
+		elif rule.rhs2 == 0:
+			prod = '%s %s' % (lhs, vocab.idtolabel(rule.rhs1))
+		else:
+			prod = '%s %s %s' % (lhs, vocab.idtolabel(rule.rhs1),
+					vocab.idtolabel(rule.rhs2))
+		if match(lhs) or match(prod):
+			result.append(trees.prodindex[n])
+	return RoaringBitmap().union(*result)
+
+
+def selectprods(Vocabulary vocab, match):
+	"""Select productions with a label or word for which ``match`` is true.
+
+	:param match: a function that takes a label or word and returns a bool;
+		it is applied to the left-hand side label of each production, and to
+		the word of lexical productions.
+	:returns: an array with the IDs of the selected productions."""
+	cdef Rule *rule
+	cdef int n
+	cdef array result = clone(intarray, 0, False)
+	for n in range(vocab.prodbuf.len // sizeof(Rule)):
+		rule = <Rule *>&vocab.prodbuf.d.aschar[n * sizeof(Rule)]
+		if match(vocab.idtolabel(rule.lhs)) or (rule.rhs1 == 0
+				and rule.args != 0 and match(vocab.idtolabel(rule.args))):
+			result.append(n)
+	return result
+
+
+def treenodes(Ctrees trees, Vocabulary vocab, int n):
+	"""Return the nodes of a tree in pre-order, with binarization undone.
+
+	Intermediate nodes introduced by binarization (labels with ``|<``) are
+	left out, so that their children are attached to the original parent.
+	Words are included as nodes, as the only child of their preterminal.
+
+	:returns: a tuple ``(labels, parents, leaves)`` with for each node its
+		label or word, the index of its parent (-1 for the root node), and
+		for words the index in the sentence (-1 for non-terminals)."""
+	cdef list labels = []
+	cdef array parents = clone(intarray, 0, False)
+	cdef array leaves = clone(intarray, 0, False)
+	if n < 0 or n >= trees.len:
+		raise IndexError
+	_treenodes(&(trees.nodes[trees.trees[n].offset]), vocab,
+			trees.trees[n].root, -1, labels, parents, leaves)
+	return labels, parents, leaves
+
+
+cdef _treenodes(Node *nodes, Vocabulary vocab, int i, int parent,
+		list labels, array parents, array leaves):
+	"""Recursive helper for treenodes()."""
+	cdef int idx = parent
+	cdef str label = vocab.getlabel(nodes[i].prod)
+	if '|<' not in label:
+		idx = len(labels)
+		labels.append(label)
+		parents.append(parent)
+		leaves.append(-1)
+	if nodes[i].left < 0:
+		labels.append(vocab.getword(nodes[i].prod) or '')
+		parents.append(idx)
+		leaves.append(termidx(nodes[i].left))
+		return
+	_treenodes(nodes, vocab, nodes[i].left, idx, labels, parents, leaves)
+	if nodes[i].right >= 0:
+		_treenodes(nodes, vocab, nodes[i].right, idx, labels, parents, leaves)
+
+
 cdef twoterminals(NodeArray a, Node *anodes,
 		Ctrees trees2, set contentwordprods, set lexicalprods):
 	"""Produce tree pairs that share at least two words.
@@ -1223,4 +1500,5 @@ def readtreebank(treebankfile, Vocabulary vocab,
 
 __all__ = ['extractfragments', 'exactcounts', 'completebitsets',
 		'allfragments', 'repl', 'pygetsent', 'getctrees',
-		'readtreebank', 'exactcountsslice']
+		'readtreebank', 'exactcountsslice', 'exactcountsbatch', 'selectprods',
+		'treenodes']
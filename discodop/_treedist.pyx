@@ -0,0 +1,67 @@
+"""Compiled dynamic programming kernel of the Zhang-Shasha tree edit distance.
+
+The trees are given as arrays of a post-order enumeration of their nodes;
+cf. ``treedist.AnnotatedTree`` and ``treedist.treedist()``."""
+
+from libc.stdlib cimport malloc, free
+
+
+def zhangshasha(int [:] lmd1, int [:] lmd2, int [:] labels1,
+		int [:] labels2, int [:] keyroots1, int [:] keyroots2,
+		int [:, :] treedists):
+	"""Compute the tree distances of all pairs of subtrees.
+
+	:param lmd1, lmd2: the leftmost descendant of each node.
+	:param labels1, labels2: integer label IDs of the nodes; nodes with equal
+		IDs can be matched without a relabeling cost.
+	:param keyroots1, keyroots2: the keyroots of the trees, in ascending
+		order.
+	:param treedists: a matrix of shape ``(len(lmd1), len(lmd2))`` in which
+		the distance of each pair of subtrees will be stored.
+	:returns: the tree edit distance of the whole trees."""
+	cdef int n1 = lmd1.shape[0], n2 = lmd2.shape[0], stride = n2 + 1
+	cdef int ki, kj, i, j, x, y, m, n, ioff, joff, a, b, cost, ins
+	# a single table of forest distances, reused for every pair of keyroots
+	cdef int *table = <int *>malloc((n1 + 1) * stride * sizeof(int))
+	if table is NULL:
+		raise MemoryError
+	try:
+		for ki in range(keyroots1.shape[0]):
+			i = keyroots1[ki]
+			for kj in range(keyroots2.shape[0]):
+				j = keyroots2[kj]
+				m = i - lmd1[i] + 2
+				n = j - lmd2[j] + 2
+				ioff = lmd1[i] - 1
+				joff = lmd2[j] - 1
+				for x in range(m):
+					table[x * stride] = x
+				for y in range(n):
+					table[y] = y
+				for x in range(1, m):
+					for y in range(1, n):
+						cost = table[(x - 1) * stride + y] + 1
+						ins = table[x * stride + y - 1] + 1
+						if ins < cost:
+							cost = ins
+						if (lmd1[x + ioff] == lmd1[i]
+								and lmd2[y + joff] == lmd2[j]):
+							ins = (table[(x - 1) * stride + y - 1]
+									+ (labels1[x + ioff] != labels2[y + joff]))
+							if ins < cost:
+								cost = ins
+							treedists[x + ioff, y + joff] = cost
+						else:
+							a = lmd1[x + ioff] - 1 - ioff
+							b = lmd2[y + joff] - 1 - joff
+							ins = (table[a * stride + b]
+									+ treedists[x + ioff, y + joff])
+							if ins < cost:
+								cost = ins
+						table[x * stride + y] = cost
+	finally:
+		free(table)
+	return treedists[n1 - 1, n2 - 1]
+
+
+__all__ = ['zhangshasha']
@@ -0,0 +1,86 @@
+"""Asynchronous query methods for corpus searchers.
+
+Requires Python 3.7+ (asynchronous generators, ``get_running_loop()``);
+imported by :mod:`discodop.treesearchbase` when available."""
+import asyncio
+import concurrent.futures
+from functools import partial
+
+
+class AsyncSearcherMixin(object):
+	"""Awaitable counterparts of the query methods of ``CorpusSearcher``.
+
+	Each method is an asynchronous generator yielding a tuple
+	``(filename, result)`` for each file as soon as its result is available;
+	``result`` has the same form as the results for a single file of the
+	corresponding blocking method. Queries on individual files are run by
+	the blocking methods in a thread pool shared by all queries on this
+	searcher, so results are cached as usual. When the generator is closed
+	early or the task consuming it is cancelled (e.g., because a client
+	disconnected), queries on files that have not been started are
+	abandoned."""
+
+	async def acounts(self, query, subset=None, start=None, end=None,
+			indices=False, breakdown=False, restrict=None):
+		"""Asynchronous variant of ``counts()``."""
+		async for filename, result in self._aperfile(
+				self.counts, subset, query, start=start, end=end,
+				indices=indices, breakdown=breakdown, restrict=restrict):
+			yield filename, result[filename]
+
+	async def abatchcounts(self, queries, subset=None, start=None, end=None,
+			restrict=None):
+		"""Asynchronous variant of ``batchcounts()``."""
+		queries = list(queries)
+		async for item in self._aperfile(
+				self._batchcountsfile, subset, queries, start=start, end=end,
+				restrict=restrict):
+			yield item
+
+	async def atrees(self, query, subset=None, start=None, end=None,
+			maxresults=10, nofunc=False, nomorph=False, restrict=None):
+		"""Asynchronous variant of ``trees()``."""
+		async for item in self._aperfile(
+				self.trees, subset, query, start=start, end=end,
+				maxresults=maxresults, nofunc=nofunc, nomorph=nomorph,
+				restrict=restrict):
+			yield item
+
+	async def asents(self, query, subset=None, start=None, end=None,
+			maxresults=100, brackets=False, restrict=None):
+		"""Asynchronous variant of ``sents()``."""
+		async for item in self._aperfile(
+				self.sents, subset, query, start=start, end=end,
+				maxresults=maxresults, brackets=brackets, restrict=restrict):
+			yield item
+
+	def _batchcountsfile(self, queries, subset=None, start=None, end=None,
+			restrict=None):
+		"""Run ``batchcounts()`` on a single file and return its result."""
+		for _, result in self.batchcounts(queries, subset=subset,
+				start=start, end=end, restrict=restrict):
+			return result
+
+	async def _aperfile(self, func, subset, *args, **kwargs):
+		"""Run blocking method ``func`` on each file in a thread pool.
+
+		:yields: ``(filename, result)`` tuples in order of completion."""
+		loop = asyncio.get_running_loop()
+		if getattr(self, '_asyncpool', None) is None:
+			self._asyncpool = concurrent.futures.ThreadPoolExecutor(
+					self.numproc)
+		pending = {loop.run_in_executor(self._asyncpool, partial(
+				func, *args, subset=[filename], **kwargs)): filename
+				for filename in subset or self.files}
+		try:
+			while pending:
+				done, _ = await asyncio.wait(
+						pending, return_when=asyncio.FIRST_COMPLETED)
+				for future in done:
+					yield pending.pop(future), future.result()
+		finally:
+			for future in pending:
+				future.cancel()
+
+
+__all__ = ['AsyncSearcherMixin']
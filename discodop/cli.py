@@ -214,7 +214,7 @@ where input and output are treebanks; standard in/output is used if not given.
 	options = ('inputfmt= outputfmt= inputenc= outputenc= slice= ensureroot= '
 			'punct= headrules= functions= morphology= lemmas= factor= fmt= '
 			'markorigin= maxlen= enc= transforms= markovthreshold= labelfun= '
-			'transforms= reversetransforms= filterlabels= ').split()
+			'transforms= reversetransforms= filterlabels= cachedir= numproc= ').split()
 	try:
 		origopts, args = gnu_getopt(argv[2:], 'h:v:H:', flags + options)
 		if len(args) > 2:
@@ -247,7 +247,9 @@ where input and output are treebanks; standard in/output is used if not given.
 			punct=opts.get('--punct'),
 			functions=opts.get('--functions'),
 			morphology=opts.get('--morphology'),
-			lemmas=opts.get('--lemmas'))
+			lemmas=opts.get('--lemmas'),
+			cachedir=opts.get('--cachedir'),
+			numproc=int(opts.get('--numproc', 1)))
 	start, end = opts.get('--slice', ':').split(':')
 	start, end = (int(start) if start else None), (int(end) if end else None)
 	trees = corpus.itertrees(start, end)
@@ -431,7 +433,8 @@ or: discodop grammar merge (rules|lexicon|fragments) \
 		trees, sents, train_tagged_sents = loadtraincorpus(
 				prm.corpusfmt, prm.traincorpus, prm.binarization, prm.punct,
 				prm.functions, prm.morphology, prm.removeempty, prm.ensureroot,
-				prm.transformations, prm.relationalrealizational)
+				prm.transformations, prm.relationalrealizational,
+				prm.corpuscache, prm.numproc)
 		simplelexsmooth = False
 		if prm.postagging and prm.postagging.method == 'unknownword':
 			sents, lexmodel = getposmodel(prm.postagging, train_tagged_sents)
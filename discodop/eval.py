@@ -11,19 +11,35 @@ from __future__ import division, print_function, absolute_import, \
 		unicode_literals
 import io
 import sys
+import copy
+import multiprocessing
+from contextlib import redirect_stdout
 from getopt import gnu_getopt, GetoptError
 from decimal import Decimal, InvalidOperation
 from collections import defaultdict, Counter  # == multiset
-from itertools import count, zip_longest
+from itertools import count, islice, zip_longest
 from . import grammar
-from .tree import Tree, DrawTree, isdisc, bitfanout
+from .tree import Tree, DrawTree, isdisc
 from .treebank import READERS, dependencies, handlefunctions
 from .treetransforms import getbits
 from .treebanktransforms import functions
 from .treedist import treedist, newtreedist
+from .util import workerfunc, batches, PersistentCache
+from .evalutil import EvalAccumulator, treepairs, evalcachekey, \
+		bracketarray, stackbrackets, matchingbrackets, unmatchedbrackets, \
+		spanfanout, recall, precision, f_measure, countscores, accuracy, \
+		mostcommon, harmean, mean, intervals, nozerodiv, editdistance, \
+		pyintbitcount
 
 SHORTUSAGE = 'Usage: discodop eval <gold> <parses> [param] [options]'
 
+# maximum number of tree pairs sent to a worker process at a time
+EVALCHUNKSIZE = 256
+# number of chunks per worker process that are read ahead
+EVALWINDOW = 4
+# parameters for evaluation in worker processes
+EVALPARAMS = None
+
 HEADER = '''
    Sentence                 Matched   Brackets            Corr   POS
   ID Length  Recall  Precis Bracket   gold   cand  Words  POS  Accur.\
@@ -33,14 +49,19 @@ HEADER = '''
 class Evaluator(object):
 	"""Incremental evaluator for syntactic trees."""
 
-	def __init__(self, param, keylen=8):
+	def __init__(self, param, keylen=8, cache=None):
 		"""Initialize evaluator object with given parameters.
 
 		:param param: a dictionary of parameters, as read by ``readparam``.
 		:param keylen: the length of the longest sentence ID, for padding
-			purposes."""
+			purposes.
+		:param cache: a mapping in which results for pairs of trees are
+			stored and looked up, e.g., a ``util.PersistentCache``; keys are
+			produced by ``evalcachekey()``. Not used with ``DEBUG > 1``,
+			since the debug output requires the trees."""
 		self.param = param
 		self.keylen = keylen
+		self.cache = cache
 		self.acc = EvalAccumulator(param['DISC_ONLY'])
 		self.acc40 = None
 		if param['CUTOFF_LEN'] is not None:
@@ -59,8 +80,33 @@ class Evaluator(object):
 		:param n: a unique identifier for this sentence.
 		:param gtree, ctree: ParentedTree objects (will be modified in-place)
 		:param gsent, csent: lists of tokens.
-		:returns: a ``TreePairResult`` object."""
-		treepair = TreePairResult(n, gtree, gsent, ctree, csent, self.param)
+		:returns: a ``TreePairResult`` object; when it is retrieved from the
+			cache, it does not contain trees."""
+		if self.cache is None or self.param['DEBUG'] > 1:
+			treepair = TreePairResult(n, gtree, gsent, ctree, csent,
+					self.param)
+			return self.addresult(treepair)
+		# the key must be computed before the trees are modified
+		key = evalcachekey(gtree, gsent, ctree, csent, self.param)
+		try:
+			treepair = self.cache[key]
+		except KeyError:
+			treepair = TreePairResult(n, gtree, gsent, ctree, csent,
+					self.param)
+			result = copy.copy(treepair).discardtrees()
+			result.param = None  # restored when it is looked up
+			self.cache[key] = result
+		else:
+			treepair.n = n
+			treepair.param = self.param
+		return self.addresult(treepair)
+
+	def addresult(self, treepair):
+		"""Add a ``TreePairResult`` object to the evaluation.
+
+		Useful when the pair of trees was evaluated in another process.
+
+		:returns: ``treepair``."""
 		self.acc.add(treepair)
 		if (self.param['CUTOFF_LEN'] is not None
 				and treepair.lengpos <= self.param['CUTOFF_LEN']):
@@ -74,15 +120,25 @@ class Evaluator(object):
 			treepair.info('%%%ds  ' % self.keylen)
 		return treepair
 
+	def merge(self, other):
+		"""Add the results of another Evaluator with the same parameters.
+
+		Sentences in ``other`` should not have been added to this Evaluator;
+		results are the same as when the sentences had been added to this
+		Evaluator in order."""
+		self.acc.merge(other.acc)
+		if self.acc40 is not None:
+			self.acc40.merge(other.acc40)
+
 	def breakdowns(self):
 		"""Print breakdowns for the most frequent rules, labels, tags."""
 		limit = 10 if self.param['DEBUG'] <= 0 else None
 		self.rulebreakdowns(limit)
 		self.catbreakdown(limit)
-		if self.acc.candfun:
+		if self.acc.funccounts()[2]:
 			self.funcbreakdown(limit)
 		try:
-			acc = accuracy(self.acc.goldpos, self.acc.candpos)
+			acc = self.acc.tagaccuracy()
 		except InvalidOperation:
 			pass
 		else:
@@ -93,32 +149,18 @@ class Evaluator(object):
 	def rulebreakdowns(self, limit=10):
 		"""Print breakdowns for the most frequent rule mismatches."""
 		acc = self.acc
-		# NB: unary nodes not handled properly
-		gmismatch = {(n, indices): rule
-					for n, indices, rule in acc.goldrule - acc.candrule}
-		wrong = Counter((rule, gmismatch[n, indices]) for n, indices, rule
-				in acc.candrule - acc.goldrule
-				if pyintbitcount(indices) > 1 and (n, indices) in gmismatch)
 		print('\n Rewrite rule mismatches (for given span)')
 		print('   count   cand / gold rules')
-		for (crule, grule), cnt in wrong.most_common(limit):
+		for (crule, grule), cnt in mostcommon(acc.wrongrules, limit):
 			print(' %7d  %s' % (cnt, grammar.printrule(*crule)))
 			print(' %7s  %s' % (' ', grammar.printrule(*grule)))
-		gspans = {(n, indices) for n, indices, _ in acc.goldrule}
-		wrong = Counter(rule for n, indices, rule
-				in acc.candrule - acc.goldrule
-				if pyintbitcount(indices) > 1 and (n, indices) not in gspans)
 		print('\n Rewrite rules (span not in gold trees)')
 		print('   count   rule in candidate parses')
-		for crule, cnt in wrong.most_common(limit):
+		for crule, cnt in mostcommon(acc.extrarules, limit):
 			print(' %7d  %s' % (cnt, grammar.printrule(*crule)))
-		cspans = {(n, indices) for n, indices, _ in acc.candrule}
-		wrong = Counter(rule for n, indices, rule
-				in acc.goldrule - acc.candrule
-				if pyintbitcount(indices) > 1 and (n, indices) not in cspans)
 		print('\n Rewrite rules (span missing from candidate parses)')
 		print('   count   rule in gold standard set')
-		for grule, cnt in wrong.most_common(limit):
+		for grule, cnt in mostcommon(acc.missingrules, limit):
 			print(' %7d  %s' % (cnt, grammar.printrule(*grule)))
 
 	def catbreakdown(self, limit=10):
@@ -127,12 +169,8 @@ class Evaluator(object):
 		print('\n Attachment errors (correct labeled bracketing, wrong parent)')
 		print('  label     cand     gold    count')
 		print(' ' + 33 * '_')
-		gmismatch = dict(acc.goldbatt - acc.candbatt)
-		wrong = Counter((label, cparent, gmismatch[n, label, indices])
-					for (n, label, indices), cparent
-					in acc.candbatt - acc.goldbatt
-					if (n, label, indices) in gmismatch)
-		for (cat, gparent, cparent), cnt in wrong.most_common(limit):
+		for (cat, gparent, cparent), cnt in mostcommon(
+				acc.wrongparents, limit):
 			print('%s  %s  %s  %7d' % (cat.rjust(7), gparent.rjust(7),
 					cparent.rjust(7), cnt))
 		print('\n Category Statistics (%s categories / errors)' % (
@@ -140,27 +178,22 @@ class Evaluator(object):
 		print('  label  % gold  recall    prec.     F1',
 				'          cand gold       count')
 		print(' ' + 38 * '_' + 8 * ' ' + 24 * '_')
-		gmismatch = {(n, indices): label
-					for n, (label, indices) in acc.goldb - acc.candb}
-		wrong = Counter((label, gmismatch[n, indices])
-					for n, (label, indices) in acc.candb - acc.goldb
-					if (n, indices) in gmismatch)
-		freqcats = sorted(set(acc.goldbcat) | set(acc.candbcat),
-				key=lambda x: len(acc.goldbcat[x]), reverse=True)
+		numgoldb, _ = acc.bracketcounts()
+		bylabel = acc.labelcounts()
+		freqcats = sorted(bylabel, key=lambda x: (-bylabel[x][0], x))
 		for cat, mismatch in zip_longest(freqcats[:limit],
-				wrong.most_common(limit)):
+				mostcommon(acc.labelmismatches(), limit)):
 			if cat is None:
 				print(39 * ' ', end='')
 			else:
+				_, numgold, numcand, matched = bylabel[cat]
+				lr, lp, lf = countscores(matched, numgold, numcand)
 				print('%s  %6.2f  %s  %s  %s' % (
 					cat.rjust(7),
-					100 * sum(acc.goldbcat[cat].values()) / len(acc.goldb),
-					nozerodiv(lambda: recall(
-							acc.goldbcat[cat], acc.candbcat[cat])),
-					nozerodiv(lambda: precision(
-							acc.goldbcat[cat], acc.candbcat[cat])),
-					nozerodiv(lambda: f_measure(
-							acc.goldbcat[cat], acc.candbcat[cat])),
+					100 * numgold / numgoldb,
+					nozerodiv(lambda: lr),
+					nozerodiv(lambda: lp),
+					nozerodiv(lambda: lf),
 					), end='')
 			if mismatch is not None:
 				print('       %s %7d' % (' '.join((mismatch[0][0].rjust(8),
@@ -175,27 +208,22 @@ class Evaluator(object):
 		print('  func.  % gold  recall    prec.     F1',
 				'          cand gold       count')
 		print(' ' + 38 * '_' + 8 * ' ' + 24 * '_')
-		gmismatch = {(n, span): tag
-					for n, (span, tag) in acc.goldfun - acc.candfun}
-		wrong = Counter((tag, gmismatch[n, span])
-					for n, (span, tag) in acc.candfun - acc.goldfun
-					if (n, span) in gmismatch)
-		freqcats = sorted(set(acc.goldbfunc) | set(acc.candbfunc),
-				key=lambda x: len(acc.goldbfunc[x]), reverse=True)
+		bytag = acc.funcstats
+		numgoldfun = acc.funccounts()[0]
+		freqcats = sorted(bytag, key=lambda x: (-bytag[x][0], x))
 		for cat, mismatch in zip_longest(freqcats[:limit],
-				wrong.most_common(limit)):
+				mostcommon(acc.wrongfuncs, limit)):
 			if cat is None:
 				print(39 * ' ', end='')
 			else:
+				_, numgold, numcand, matched = bytag[cat]
+				lr, lp, lf = countscores(matched, numgold, numcand)
 				print('%s  %6.2f  %s  %s  %s' % (
 					cat.rjust(7),
-					100 * sum(acc.goldbfunc[cat].values()) / len(acc.goldfun),
-					nozerodiv(lambda: recall(
-							acc.goldbfunc[cat], acc.candbfunc[cat])),
-					nozerodiv(lambda: precision(
-							acc.goldbfunc[cat], acc.candbfunc[cat])),
-					nozerodiv(lambda: f_measure(
-							acc.goldbfunc[cat], acc.candbfunc[cat])),
+					100 * numgold / numgoldfun,
+					nozerodiv(lambda: lr),
+					nozerodiv(lambda: lp),
+					nozerodiv(lambda: lf),
 					), end='')
 			if mismatch is not None:
 				print('       %s %7d' % (' '.join((mismatch[0][0].rjust(8),
@@ -210,26 +238,24 @@ class Evaluator(object):
 		print('\n    tag  % gold  recall   prec.      F1',
 				'          cand gold   count')
 		print(' ' + 38 * '_' + 12 * ' ' + 20 * '_')
-		tags = Counter(acc.goldpos)
-		wrong = Counter((c, g) for c, g
-				in zip(acc.candpos, acc.goldpos) if c != g)
-		for tag, mismatch in zip_longest(tags.most_common(limit),
-				wrong.most_common(limit)):
+		tags, candtags, wrong = Counter(), Counter(), Counter()
+		for (ctag, gtag), cnt in acc.tagpairs.items():
+			tags[gtag] += cnt
+			candtags[ctag] += cnt
+			if ctag != gtag:
+				wrong[ctag, gtag] += cnt
+		numtags = sum(tags.values())
+		for tag, mismatch in zip_longest(mostcommon(tags, limit),
+				mostcommon(wrong, limit)):
 			if tag is None:
 				print(''.rjust(40), end='')
 			else:
-				# only one tag per index may occur, but multiset is required by
-				# metrics
-				goldtag = Counter(n for n, t in enumerate(acc.goldpos)
-						if t == tag[0])
-				candtag = Counter(n for n, t in enumerate(acc.candpos)
-						if t == tag[0])
+				lr, lp, lf = countscores(acc.tagpairs[tag[0], tag[0]],
+						tag[1], candtags[tag[0]])
 				print('%s  %6.2f  %6.2f  %6.2f  %6.2f' % (
 						tag[0].rjust(7),
-						100 * len(goldtag) / len(acc.goldpos),
-						100 * recall(goldtag, candtag),
-						100 * precision(goldtag, candtag),
-						100 * f_measure(goldtag, candtag)), end='')
+						100 * tag[1] / numtags,
+						100 * lr, 100 * lp, 100 * lf), end='')
 			if mismatch is not None:
 				print('       %s %7d' % (' '.join((mismatch[0][0].rjust(8),
 						mismatch[0][1].ljust(8))).rjust(12), mismatch[1]),
@@ -240,10 +266,8 @@ class Evaluator(object):
 		""":returns: a string with an overview of scores for all sentences."""
 		acc = self.acc
 		acc40 = self.acc40
-		discbrackets = sum(1 for _, (_, a) in acc.candb.elements()
-				if bitfanout(a) > 1)
-		gdiscbrackets = sum(1 for _, (_, a) in acc.goldb.elements()
-				if bitfanout(a) > 1)
+		numgoldb, gdiscbrackets = acc.bracketcounts()
+		numcandb, discbrackets = acc.bracketcounts(cand=True)
 
 		if acc.maxlenseen <= self.param['CUTOFF_LEN']:
 			msg = ['%s' % ' Summary (ALL) '.center(35, '_'),
@@ -251,41 +275,39 @@ class Evaluator(object):
 				'longest sentence:          %6d' % (acc.maxlenseen)]
 			if gdiscbrackets or discbrackets:
 				msg.extend(['gold brackets (disc.):     %6d (%d)' % (
-							len(acc.goldb), gdiscbrackets),
+							numgoldb, gdiscbrackets),
 						'cand. brackets (disc.):    %6d (%d)' % (
-							len(acc.candb), discbrackets)])
+							numcandb, discbrackets)])
 			else:
-				msg.extend(['gold brackets:             %6d' % len(acc.goldb),
-					'cand. brackets:            %6d' % len(acc.candb)])
+				msg.extend(['gold brackets:             %6d' % numgoldb,
+					'cand. brackets:            %6d' % numcandb])
+			lr, lp, lf = acc.bracketscores()
 			msg.extend([
-					'labeled recall:            %s' % (
-						nozerodiv(lambda: recall(acc.goldb, acc.candb))),
-					'labeled precision:         %s' % (
-						nozerodiv(lambda: precision(acc.goldb, acc.candb))),
-					'labeled f-measure:         %s' % (
-						nozerodiv(lambda: f_measure(acc.goldb, acc.candb))),
+					'labeled recall:            %s' % nozerodiv(lambda: lr),
+					'labeled precision:         %s' % nozerodiv(lambda: lp),
+					'labeled f-measure:         %s' % nozerodiv(lambda: lf),
 					'exact match:               %s' % (
 						nozerodiv(lambda: acc.exact / acc.sentcount))])
 			if self.param['LA']:
 				msg.append('leaf-ancestor:             %s' % (
-						nozerodiv(lambda: mean(acc.lascores))))
+						nozerodiv(acc.meanlascore)))
 			if self.param['TED']:
 				msg.append('tree-dist (Dice micro avg) %s' % (
 						nozerodiv(lambda: 1 - acc.dicenoms / acc.dicedenoms)))
 			if self.param['DEP']:
 				msg.append('unlabeled dependencies:    %s' % (
-						nozerodiv(lambda: accuracy(acc.golddep, acc.canddep))))
-			if acc.candfun:
+						nozerodiv(acc.depaccuracy)))
+			if acc.funccounts()[2]:
 				msg.append('function tags:             %s' %
-						nozerodiv(lambda: f_measure(acc.goldfun, acc.candfun)))
+						nozerodiv(lambda: acc.funcscores()[2]))
 			msg.append('pos accuracy:              %s' % (
-					nozerodiv(lambda: accuracy(acc.goldpos, acc.candpos))))
+					nozerodiv(acc.tagaccuracy)))
 			return '\n'.join(msg)
 
-		discbrackets40 = sum(1 for _, (_, a) in acc40.candb.elements()
-				if bitfanout(a) > 1)
-		gdiscbrackets40 = sum(1 for _, (_, a) in acc40.goldb.elements()
-				if bitfanout(a) > 1)
+		numgoldb40, gdiscbrackets40 = acc40.bracketcounts()
+		numcandb40, discbrackets40 = acc40.bracketcounts(cand=True)
+		lr40, lp40, lf40 = acc40.bracketscores()
+		lr, lp, lf = acc.bracketscores()
 		msg = ['%s <= %d ______ ALL' % (
 				' Summary '.center(27, '_'), self.param['CUTOFF_LEN']),
 			'number of sentences:       %6d     %6d' % (
@@ -293,47 +315,40 @@ class Evaluator(object):
 			'longest sentence:          %6d     %6d' % (
 					acc40.maxlenseen, acc.maxlenseen),
 			'gold brackets:             %6d     %6d' % (
-					len(acc40.goldb), len(acc.goldb)),
+					numgoldb40, numgoldb),
 			'cand. brackets:            %6d     %6d' % (
-					len(acc40.candb), len(acc.candb))]
+					numcandb40, numcandb)]
 		if gdiscbrackets or discbrackets:
 			msg.extend(['disc. gold brackets:       %6d     %6d' % (
 					gdiscbrackets40, gdiscbrackets),
 					'disc. cand. brackets:      %6d     %6d' % (
 					discbrackets40, discbrackets)])
 		msg.extend(['labeled recall:            %s     %s' % (
-				nozerodiv(lambda: recall(acc40.goldb, acc40.candb)),
-				nozerodiv(lambda: recall(acc.goldb, acc.candb))),
+				nozerodiv(lambda: lr40), nozerodiv(lambda: lr)),
 			'labeled precision:         %s     %s' % (
-				nozerodiv(lambda: precision(acc40.goldb, acc40.candb)),
-				nozerodiv(lambda: precision(acc.goldb, acc.candb))),
+				nozerodiv(lambda: lp40), nozerodiv(lambda: lp)),
 			'labeled f-measure:         %s     %s' % (
-				nozerodiv(lambda: f_measure(acc40.goldb, acc40.candb)),
-				nozerodiv(lambda: f_measure(acc.goldb, acc.candb))),
+				nozerodiv(lambda: lf40), nozerodiv(lambda: lf)),
 			'exact match:               %s     %s' % (
 				nozerodiv(lambda: acc40.exact / acc40.sentcount),
 				nozerodiv(lambda: acc.exact / acc.sentcount))])
 		if self.param['LA']:
 			msg.append('leaf-ancestor:             %s     %s' % (
-				nozerodiv(lambda: mean(acc40.lascores)),
-				nozerodiv(lambda: mean(acc.lascores))))
+				nozerodiv(acc40.meanlascore), nozerodiv(acc.meanlascore)))
 		if self.param['TED']:
 			msg.append('tree-dist (Dice micro avg) %s     %s' % (
 				nozerodiv(lambda: (1 - acc40.dicenoms / acc40.dicedenoms)),
 				nozerodiv(lambda: (1 - acc.dicenoms / acc.dicedenoms))))
 		if self.param['DEP']:
 			msg.append('unlabeled dependencies:    %s     %s  (%d / %d)' % (
-					nozerodiv(lambda: accuracy(acc40.golddep, acc40.canddep)),
-					nozerodiv(lambda: accuracy(acc.golddep, acc.canddep)),
-					sum(a[0] == a[1] for a in zip(acc.golddep, acc.canddep)),
-					len(acc.golddep)))
-		if acc.candfun:
+					nozerodiv(acc40.depaccuracy), nozerodiv(acc.depaccuracy),
+					acc.depmatched, acc.numdep))
+		if acc.funccounts()[2]:
 			msg.append('function tags:             %s     %s' % (
-					nozerodiv(lambda: f_measure(acc40.goldfun, acc40.candfun)),
-					nozerodiv(lambda: f_measure(acc.goldfun, acc.candfun))))
+					nozerodiv(lambda: acc40.funcscores()[2]),
+					nozerodiv(lambda: acc.funcscores()[2])))
 		msg.append('pos accuracy:              %s     %s' % (
-				nozerodiv(lambda: accuracy(acc40.goldpos, acc40.candpos)),
-				nozerodiv(lambda: accuracy(acc.goldpos, acc.candpos))))
+				nozerodiv(acc40.tagaccuracy), nozerodiv(acc.tagaccuracy)))
 		return '\n'.join(msg)
 
 
@@ -492,6 +507,18 @@ class TreePairResult(object):
 				POS=nozerodiv(lambda: accuracy(self.gpos, self.cpos)),
 				FUN=nozerodiv(lambda: f_measure(self.goldfun, self.candfun)))
 
+	def discardtrees(self):
+		"""Remove the trees to make this object smaller.
+
+		The trees are only needed for ``debug()`` and ``visualize()``;
+		without them, this object is cheaper to send to another process or
+		to store in a cache.
+
+		:returns: this object."""
+		self.ctree = self.gtree = None
+		self.csentorig = self.gsentorig = None
+		return self
+
 	def bracketings(self):
 		"""Return a string representation of bracketing errors."""
 		msg = ''
@@ -529,84 +556,12 @@ class TreePairResult(object):
 				funcsep='-' if self.candfun else None)
 
 
-class EvalAccumulator(object):
-	"""Collect scores of evaluation."""
-
-	def __init__(self, disconly=False):
-		""":param disconly: if True, only collect discontinuous bracketings."""
-		self.disconly = disconly
-		self.maxlenseen, self.sentcount = Decimal(0), Decimal(0)
-		self.exact = Decimal(0)
-		self.dicenoms, self.dicedenoms = Decimal(0), Decimal(0)
-		self.goldb, self.candb = Counter(), Counter()  # all brackets
-		self.goldfun, self.candfun = Counter(), Counter()
-		self.lascores = []
-		self.golddep, self.canddep = [], []
-		self.goldpos, self.candpos = [], []
-		# extra accounting for breakdowns:
-		self.goldbcat = defaultdict(Counter)  # brackets per category
-		self.candbcat = defaultdict(Counter)
-		self.goldbfunc = defaultdict(Counter)  # brackets by function tag
-		self.candbfunc = defaultdict(Counter)
-		self.goldbatt, self.candbatt = set(), set()  # attachments per category
-		self.goldrule, self.candrule = Counter(), Counter()
-
-	def add(self, pair):
-		"""Add scores from given TreePairResult object."""
-		if not self.disconly or pair.cbrack or pair.gbrack:
-			self.sentcount += 1
-		if self.maxlenseen < pair.lengpos:
-			self.maxlenseen = pair.lengpos
-		self.candb.update((pair.n, a) for a in pair.cbrack.elements())
-		self.goldb.update((pair.n, a) for a in pair.gbrack.elements())
-		if pair.cbrack == pair.gbrack:
-			if not self.disconly or pair.cbrack or pair.gbrack:
-				self.exact += 1
-		self.goldpos.extend(pair.gpos)
-		self.candpos.extend(pair.cpos)
-		self.goldfun.update((pair.n, a) for a in pair.goldfun.elements())
-		self.candfun.update((pair.n, a) for a in pair.candfun.elements())
-		if pair.lascore is not None:
-			self.lascores.append(pair.lascore)
-		if pair.ted is not None:
-			self.dicenoms += pair.ted
-			self.dicedenoms += pair.denom
-		if pair.gdep is not None:
-			self.golddep.extend(pair.gdep)
-			self.canddep.extend(pair.cdep)
-		# extra bookkeeping for breakdowns
-		for a, n in pair.gbrack.items():
-			self.goldbcat[a[0]][(pair.n, a)] += n
-		for a, n in pair.cbrack.items():
-			self.candbcat[a[0]][(pair.n, a)] += n
-		for a, n in pair.goldfun.items():
-			self.goldbfunc[a[1]][(pair.n, a)] += n
-		for a, n in pair.candfun.items():
-			self.candbfunc[a[1]][(pair.n, a)] += n
-		for (label, indices), parent in pair.pgbrack:
-			self.goldbatt.add(((pair.n, label, indices), parent))
-		for (label, indices), parent in pair.pcbrack:
-			self.candbatt.add(((pair.n, label, indices), parent))
-		self.goldrule.update((pair.n, indices, rule)
-				for indices, rule in pair.grule.elements())
-		self.candrule.update((pair.n, indices, rule)
-				for indices, rule in pair.crule.elements())
-
-	def scores(self):
-		"""Return a dictionary with running scores for all added sentences."""
-		return dict(lr=nozerodiv(lambda: recall(self.goldb, self.candb)),
-				lp=nozerodiv(lambda: precision(self.goldb, self.candb)),
-				lf=nozerodiv(lambda: f_measure(self.goldb, self.candb)),
-				ex=nozerodiv(lambda: self.exact / self.sentcount),
-				tag=nozerodiv(lambda: accuracy(self.goldpos, self.candpos)),
-				fun=nozerodiv(lambda: f_measure(self.goldfun, self.candfun)))
-
-
 def main():
 	"""Command line interface for evaluation."""
 	flags = {'help', 'verbose', 'debug', 'disconly', 'ted', 'la'}
 	options = {'goldenc=', 'parsesenc=', 'goldfmt=', 'parsesfmt=', 'fmt=',
-			'cutofflen=', 'headrules=', 'functions=', 'morphology='}
+			'cutofflen=', 'headrules=', 'functions=', 'morphology=',
+			'numproc=', 'cache='}
 	try:
 		opts, args = gnu_getopt(sys.argv[2:], 'h', flags | options)
 	except GetoptError as err:
@@ -628,6 +583,7 @@ def main():
 	param['TED'] |= '--ted' in opts
 	param['LA'] |= '--la' in opts
 	param['DEP'] = '--headrules' in opts
+	numproc = int(opts.get('--numproc', 1)) or multiprocessing.cpu_count()
 	if '--fmt' in opts:
 		opts['--goldfmt'] = opts['--parsesfmt'] = opts['--fmt']
 	goldreader = READERS[opts.get('--goldfmt', 'export')]
@@ -636,29 +592,90 @@ def main():
 			encoding=opts.get('--goldenc', 'utf8'),
 			functions=opts.get('--functions', 'remove'),
 			morphology=opts.get('--morphology'),
-			headrules=opts.get('--headrules'))
+			headrules=opts.get('--headrules'),
+			numproc=numproc)
 	parses = parsesreader(parsesfile,
 			encoding=opts.get('--parsesenc', 'utf8'),
 			functions=opts.get('--functions', 'remove'),
 			morphology=opts.get('--morphology'),
-			headrules=opts.get('--headrules'))
-	goldtrees, goldsents = gold.trees(), gold.sents()
-	candtrees, candsents = parses.trees(), parses.sents()
-	if not goldtrees:
-		raise ValueError('no trees in gold file')
-	if not candtrees:
-		raise ValueError('no trees in parses file')
+			headrules=opts.get('--headrules'),
+			numproc=numproc)
 	if param['DEBUG'] >= 2:
 		print('gold:', goldfile)
 		print('parses:', parsesfile, '\n')
-	evaluator = Evaluator(param, max(len(str(key)) for key in candtrees))
-	for n, ctree in candtrees.items():
-		evaluator.add(n, goldtrees[n], goldsents[n], ctree, candsents[n])
+	# only needed to align the per sentence output and to divide the
+	# sentences over processes; read without parsing trees, and without
+	# storing an offset index next to the parses.
+	keys = None
+	if parsesfile != '-' and (param['DEBUG'] >= 1 or numproc > 1):
+		keys = parses.keys(writeindex=False)
+	keylen = max(len(str(key)) for key in keys) if keys else 8
+	cachefile = opts.get('--cache')
+	cache = PersistentCache(cachefile) if cachefile else None
+	evaluator = Evaluator(param, keylen, cache)
+	pairs = treepairs(gold, parses)
+	numpairs = 0
+	if numproc == 1:
+		for n, gitem, citem in pairs:
+			evaluator.add(n, gitem.tree, gitem.sent, citem.tree, citem.sent)
+			numpairs += 1
+	else:
+		chunksize = EVALCHUNKSIZE
+		if keys:
+			chunksize = max(1, min(chunksize, len(keys) // numproc))
+		chunks = batches(((n, gitem.tree, gitem.sent, citem.tree, citem.sent)
+				for n, gitem, citem in pairs), chunksize)
+		pool = multiprocessing.Pool(processes=numproc,
+				initializer=_initevalworker,
+				initargs=(param, keylen, cachefile))
+		# submit a limited number of chunks at a time, since imap() would
+		# read all tree pairs into memory ahead of the workers.
+		try:
+			window = list(islice(chunks, EVALWINDOW * numproc))
+			while window:
+				for result, output in pool.imap(_evalworker, window):
+					sys.stdout.write(output)
+					evaluator.merge(result)
+				numpairs += sum(len(chunk) for chunk in window)
+				window = list(islice(chunks, EVALWINDOW * numproc))
+		finally:
+			pool.terminate()
+	if not numpairs:
+		raise ValueError('no trees in parses file')
+	if cache is not None:
+		cache.close()
 	if param['LABELED'] and param['DEBUG'] != -1:
 		evaluator.breakdowns()
 	print(evaluator.summary())
 
 
+def _initevalworker(param, keylen, cachefile=None):
+	"""Set global parameters for evaluation in worker processes."""
+	global EVALPARAMS
+	EVALPARAMS = (param, keylen,
+			PersistentCache(cachefile) if cachefile else None)
+
+
+@workerfunc
+def _evalworker(pairs):
+	"""Evaluate a list of tree pairs in a worker process.
+
+	:returns: a tuple ``(evaluator, output)`` with an Evaluator to be merged
+		with ``Evaluator.merge()``, and the per-sentence output it printed."""
+	param, keylen, cache = EVALPARAMS
+	# disable debug output while initializing, to skip the header
+	evaluator = Evaluator(dict(param, DEBUG=-1), keylen, cache)
+	evaluator.param = param
+	output = io.StringIO()
+	with redirect_stdout(output):
+		for n, gtree, gsent, ctree, csent in pairs:
+			evaluator.add(n, gtree, gsent, ctree, csent)
+	if cache is not None:  # the pool is terminated without closing it
+		cache.flush()
+	evaluator.cache = None  # stays open in this process; cannot be pickled
+	return evaluator, output.getvalue()
+
+
 def readparam(filename):
 	"""Read an EVALB-style parameter file and return a dictionary."""
 	param = defaultdict(list)
@@ -713,13 +730,12 @@ def transitiveclosure(eqpairs):
 
 	Given a sequence of pairs denoting an equivalence relation,
 	produce a dictionary with equivalence classes as values and
-	arbitrary members of those classes as keys.
+	the smallest member of each class as key.
 
 	>>> result = transitiveclosure({('A', 'B'), ('B', 'C')})
 	>>> len(result)
 	1
-	>>> k, v = result.popitem()
-	>>> k in ('A', 'B', 'C') and v == {'A', 'B', 'C'}
+	>>> result['A'] == {'A', 'B', 'C'}
 	True"""
 	edges = defaultdict(set)
 	for a, b in eqpairs:
@@ -727,7 +743,7 @@ def transitiveclosure(eqpairs):
 		edges[b].add(a)
 	eqclasses = {}
 	seen = set()
-	for elem in set(edges):
+	for elem in sorted(edges):
 		if elem in seen:
 			continue
 		eqclasses[elem] = set()
@@ -934,151 +950,12 @@ def treedisteval(a, b, includeroot=False, debug=False):
 	return ted, denom
 
 
-# If the goldfile contains n constituents for the same span, and the parsed
-# file contains m constituents with that nonterminal, the scorer works as
-# follows:
-#
-# i) If m>n, then the precision is n/m, recall is 100%
-# ii) If n>m, then the precision is 100%, recall is m/n.
-# iii) If n==m, recall and precision are both 100%.
-def recall(reference, candidate):
-	"""Get recall score for two multisets."""
-	if not reference:
-		return Decimal('NaN')
-	return Decimal(sum(min(reference[a], candidate[a])
-			for a in reference & candidate)) / sum(reference.values())
-
-
-def precision(reference, candidate):
-	"""Get precision score for two multisets."""
-	if not candidate:
-		return Decimal('NaN')
-	return Decimal(sum(min(reference[a], candidate[a])
-			for a in reference & candidate)) / sum(candidate.values())
-
-
-def f_measure(reference, candidate, alpha=Decimal(0.5)):
-	"""Get F-measure of precision and recall for two multisets.
-
-	The default weight ``alpha=0.5`` corresponds to the F_1-measure."""
-	p = precision(reference, candidate)
-	r = recall(reference, candidate)
-	if p == 0 or r == 0:
-		return Decimal('NaN')
-	return Decimal(1) / (alpha / p + (1 - alpha) / r)
-
-
-def accuracy(reference, candidate):
-	"""Compute fraction of equivalent pairs in two sequences.
-
-	In particular, return the fraction of indices
-	``0<i<=len(test)`` such that ``test[i] == reference[i]``."""
-	if len(reference) != len(candidate):
-		raise ValueError('Sequences must have the same length.')
-	return Decimal(sum(a == b for a, b in zip(reference, candidate))
-			) / len(reference)
-
-
-def harmean(seq):
-	"""Compute harmonic mean of a sequence of numbers.
-
-	Returns NaN when ``seq`` contains zero."""
-	numerator = denominator = Decimal(0)
-	for a in seq:
-		if not a:
-			return Decimal('NaN')
-		numerator += 1
-		denominator += Decimal(1) / a
-	if not denominator:
-		return Decimal('NaN')
-	return numerator / denominator
-
-
-def mean(seq):
-	"""Compute arithmetic mean of a sequence.
-
-	Returns NaN when ``seq`` is empty."""
-	numerator = denominator = Decimal(0)
-	for a in seq:
-		numerator += a
-		denominator += 1
-	if not denominator:
-		return Decimal('NaN')
-	return numerator / denominator
-
-
-def intervals(bitset):
-	"""Return a sequence of intervals corresponding to contiguous ranges.
-
-	``seq`` is an integer representing a bitvector. An interval is a pair
-	``(a, b)``, with ``a <= b`` denoting a contiguous range of one bits ``x``
-	in ``seq`` such that ``a <= x <= b``.
-
-	>>> list(intervals(0b111011011))  # NB: read from right to left
-	[(0, 1), (3, 4), (6, 8)]"""
-	start = prev = None
-	for a in getbits(bitset):
-		if start is None:
-			start = prev = a
-		elif a == prev + 1:
-			prev = a
-		else:
-			yield start, prev
-			start = prev = a
-	if start is not None:
-		yield start, prev
-
-
-def nozerodiv(func):
-	"""Return ``func()`` as 6-character string but catch zero division."""
-	try:
-		result = func()
-	except (ZeroDivisionError, InvalidOperation):
-		return ' 0DIV!'
-	return '  None' if result is None else '%6.2f' % (100 * result)
-
-
-def editdistance(seq1, seq2):
-	"""Calculate the Levenshtein edit-distance between two strings.
-
-	The edit distance is the number of characters that need to be substituted,
-	inserted, or deleted, to transform seq1 into seq2.  For example,
-	transforming 'rain' to 'shine' requires three steps, consisting of two
-	substitutions and one insertion: 'rain' -> 'sain' -> 'shin' -> 'shine'.
-	These operations could have been done in other orders, but at least three
-	steps are needed."""
-	# initialize 2-D array to zero
-	len1, len2 = len(seq1), len(seq2)
-	lev = [[0] * (len2 + 1) for _ in range(len1 + 1)]
-	for i in range(len1 + 1):
-		lev[i][0] = i           # column 0: 0,1,2,3,4,...
-	for j in range(len2 + 1):
-		lev[0][j] = j           # row 0: 0,1,2,3,4,...
-	# iterate over the array
-	for i in range(len1):
-		for j in range(len2):
-			a = lev[i][j + 1] + 1               # skip seq1[i]
-			b = lev[i][j] + (seq1[i] != seq2[j])  # match seq1[i] with seq2[j]
-			c = lev[i + 1][j] + 1               # skip seq2[j]
-			lev[i + 1][j + 1] = min(a, b, c)    # pick the cheapest
-	return lev[len1][len2]
-
-
-def pyintbitcount(a):
-	"""Return number of set bits (1s) in a Python integer.
-
-	>>> pyintbitcount(0b0011101)
-	4"""
-	cnt = 0
-	while a:
-		a &= a - 1
-		cnt += 1
-	return cnt
-
-
 __all__ = ['Evaluator', 'TreePairResult', 'EvalAccumulator', 'main',
-		'readparam', 'transitiveclosure', 'alignsent', 'transform',
-		'parentedbracketings', 'bracketings', 'bracketing', 'strbracketings',
+		'treepairs', 'evalcachekey', 'readparam', 'transitiveclosure',
+		'alignsent', 'transform', 'parentedbracketings', 'bracketings',
+		'bracketing', 'strbracketings', 'bracketarray', 'stackbrackets',
+		'matchingbrackets', 'unmatchedbrackets', 'spanfanout',
 		'leafancestorpaths', 'pathscore', 'leafancestor', 'treedisteval',
-		'recall', 'precision', 'f_measure', 'accuracy', 'harmean', 'mean',
-		'intervals', 'nozerodiv', 'editdistance', 'pyintbitcount']
+		'recall', 'precision', 'f_measure', 'countscores', 'accuracy',
+		'mostcommon', 'harmean', 'mean', 'intervals',
+		'nozerodiv', 'editdistance', 'pyintbitcount']
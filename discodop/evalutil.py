@@ -0,0 +1,637 @@
+"""Accumulation of evaluation scores, and pairing of gold and parse trees.
+
+Also provides the bracket arrays used to compare the bracketings of many
+sentences at once, and scoring functions for multisets. Used by
+:mod:`discodop.eval`, which exports the public objects."""
+from __future__ import division, print_function, absolute_import, \
+		unicode_literals
+import pickle
+import hashlib
+from decimal import Decimal, InvalidOperation
+from collections import Counter  # == multiset
+from itertools import islice
+import numpy as np
+from .treebank import READERBATCHSIZE, encodetree
+from .treetransforms import getbits
+
+# number of sentences of which the brackets are compared at a time
+BRACKETBATCHSIZE = 1024
+# increment when TreePairResult or the way it is computed changes,
+# to invalidate cached results.
+EVALCACHEVERSION = 1
+# parameters which only affect aggregation and output, not TreePairResult
+AGGREGATIONPARAMS = ('DEBUG', 'MAX_ERROR', 'CUTOFF_LEN')
+
+
+class EvalAccumulator(object):
+	"""Collect scores of evaluation.
+
+	Each sentence is reduced to counts when it is added, so that memory use
+	does not grow with the number of sentences; only the breakdowns grow
+	with the number of distinct labels, tags, and rules."""
+
+	def __init__(self, disconly=False):
+		""":param disconly: if True, only collect discontinuous bracketings."""
+		self.disconly = disconly
+		self.maxlenseen, self.sentcount = Decimal(0), Decimal(0)
+		self.exact = Decimal(0)
+		self.dicenoms, self.dicedenoms = Decimal(0), Decimal(0)
+		# brackets of sentences added since the last call to _flush(), as
+		# arrays produced by bracketarray().
+		self.goldpending, self.candpending = [], []
+		self.labelids = {}  # bracket labels mapped to integer IDs
+		self.numgoldb = self.numcandb = self.matchedb = 0
+		self.distinctb = [0, 0]  # distinct gold and candidate brackets
+		self.discb = [0, 0]  # discontinuous gold and candidate brackets
+		self.lasum, self.numla = Decimal(0), 0
+		self.depmatched = self.numdep = 0
+		self.tagpairs = Counter()  # pairs of POS tags (cand, gold)
+		# lists [distinct gold, gold, cand, matched] of counts per bracket
+		# label and function tag; cf. labelcounts()
+		self.labelstats, self.funcstats = {}, {}
+		# extra accounting for breakdowns:
+		self.wronglabels = Counter()  # (cand, gold) labels for a gold span
+		self.wrongfuncs = Counter()  # (cand, gold) function tags
+		self.wrongparents = Counter()  # (label, cand, gold) parent labels
+		self.wrongrules = Counter()  # (cand, gold) rules for a gold span
+		self.extrarules = Counter()  # cand rules for spans not in gold
+		self.missingrules = Counter()  # gold rules for spans not in cand
+
+	def add(self, pair):
+		"""Add scores from given TreePairResult object."""
+		if not self.disconly or pair.cbrack or pair.gbrack:
+			self.sentcount += 1
+		if self.maxlenseen < pair.lengpos:
+			self.maxlenseen = pair.lengpos
+		self.goldpending.append(bracketarray(
+				pair.gbrack, self.labelids, len(self.goldpending)))
+		self.candpending.append(bracketarray(
+				pair.cbrack, self.labelids, len(self.candpending)))
+		if len(self.goldpending) >= BRACKETBATCHSIZE:
+			self._flush()
+		if pair.cbrack == pair.gbrack:
+			if not self.disconly or pair.cbrack or pair.gbrack:
+				self.exact += 1
+		self.tagpairs.update(zip(pair.cpos, pair.gpos))
+		if pair.lascore is not None:
+			self.lasum += pair.lascore
+			self.numla += 1
+		if pair.ted is not None:
+			self.dicenoms += pair.ted
+			self.dicedenoms += pair.denom
+		if pair.gdep is not None:
+			self.depmatched += sum(a == b for a, b in zip(pair.gdep, pair.cdep))
+			self.numdep += len(pair.gdep)
+		for a, cnt in pair.goldfun.items():
+			_addcounts(self.funcstats, a[1],
+					(1, cnt, 0, min(cnt, pair.candfun[a])))
+		for a, cnt in pair.candfun.items():
+			_addcounts(self.funcstats, a[1], (0, 0, cnt, 0))
+		# extra bookkeeping for breakdowns
+		gmismatch = {span: tag for span, tag in pair.goldfun - pair.candfun}
+		self.wrongfuncs.update((tag, gmismatch[span])
+				for span, tag in pair.candfun - pair.goldfun
+				if span in gmismatch)
+		goldatt, candatt = set(pair.pgbrack), set(pair.pcbrack)
+		gmismatch = dict(goldatt - candatt)
+		self.wrongparents.update((label, cparent, gmismatch[label, indices])
+				for (label, indices), cparent in candatt - goldatt
+				if (label, indices) in gmismatch)
+		# NB: unary nodes not handled properly
+		goldrule, candrule = pair.grule - pair.crule, pair.crule - pair.grule
+		gmismatch = {indices: rule for indices, rule in goldrule}
+		gspans = {indices for indices, _ in pair.grule}
+		cspans = {indices for indices, _ in pair.crule}
+		for indices, rule in candrule:
+			if pyintbitcount(indices) > 1:
+				if indices in gmismatch:
+					self.wrongrules[rule, gmismatch[indices]] += 1
+				if indices not in gspans:
+					self.extrarules[rule] += 1
+		self.missingrules.update(rule for indices, rule in goldrule
+				if pyintbitcount(indices) > 1 and indices not in cspans)
+
+	def merge(self, other):
+		"""Add the scores collected by another EvalAccumulator."""
+		self.sentcount += other.sentcount
+		self.maxlenseen = max(self.maxlenseen, other.maxlenseen)
+		self.exact += other.exact
+		self.dicenoms += other.dicenoms
+		self.dicedenoms += other.dicedenoms
+		self._flush()
+		other._flush()
+		self.numgoldb += other.numgoldb
+		self.numcandb += other.numcandb
+		self.matchedb += other.matchedb
+		for n in range(2):
+			self.distinctb[n] += other.distinctb[n]
+			self.discb[n] += other.discb[n]
+		self.lasum += other.lasum
+		self.numla += other.numla
+		self.depmatched += other.depmatched
+		self.numdep += other.numdep
+		for attr in ('tagpairs', 'wronglabels', 'wrongfuncs', 'wrongparents',
+				'wrongrules', 'extrarules', 'missingrules'):
+			getattr(self, attr).update(getattr(other, attr))
+		for attr in ('labelstats', 'funcstats'):
+			mine = getattr(self, attr)
+			for key, counts in getattr(other, attr).items():
+				_addcounts(mine, key, counts)
+
+	def _flush(self):
+		"""Count the brackets of sentences added since the last call.
+
+		The pending arrays are stacked and compared in one go; afterwards,
+		only the counts are kept."""
+		if not self.goldpending:
+			return
+		gold = stackbrackets(self.goldpending)
+		cand = stackbrackets(self.candpending)
+		self.goldpending, self.candpending = [], []
+		matched, _ = matchingbrackets(gold, cand)
+		self.numgoldb += len(gold)
+		self.numcandb += len(cand)
+		self.matchedb += len(matched)
+		for n, brackets in enumerate((gold, cand)):
+			self.distinctb[n] += int((brackets[:, 2] == 0).sum())
+			self.discb[n] += int((spanfanout(brackets) > 1).sum())
+		labels = sorted(self.labelids, key=self.labelids.get)
+		goldlabels = gold[:, 1].astype(np.intp)
+		counts = zip(
+				np.bincount(goldlabels[gold[:, 2] == 0],
+					minlength=len(labels)),
+				np.bincount(goldlabels, minlength=len(labels)),
+				np.bincount(cand[:, 1].astype(np.intp), minlength=len(labels)),
+				np.bincount(goldlabels[matched], minlength=len(labels)))
+		for label, cnt in zip(labels, counts):
+			if any(cnt):
+				_addcounts(self.labelstats, label, [int(a) for a in cnt])
+		# rows are in the order of bracketings(), i.e., preorder
+		gold, cand = unmatchedbrackets(gold, cand)
+		gmismatch = {(row[0], tuple(row[3:])): labels[row[1]]
+				for row in gold.tolist()}
+		self.wronglabels.update(
+				(labels[row[1]], gmismatch[row[0], tuple(row[3:])])
+				for row in cand.tolist()
+				if (row[0], tuple(row[3:])) in gmismatch)
+
+	def bracketscores(self):
+		"""Return labeled recall, precision, and F-measure of all brackets.
+
+		:returns: a tuple of Decimals, which are NaN when undefined."""
+		self._flush()
+		return countscores(self.matchedb, self.numgoldb, self.numcandb)
+
+	def bracketcounts(self, cand=False):
+		"""Count gold or candidate brackets.
+
+		:returns: a tuple ``(distinct, disc)`` with the number of distinct
+			brackets (brackets occurring more than once in a tree are
+			counted once), and the number of discontinuous brackets."""
+		self._flush()
+		return self.distinctb[int(cand)], self.discb[int(cand)]
+
+	def labelcounts(self):
+		"""Count brackets per label.
+
+		:returns: a dictionary mapping each label to a tuple
+			``(distinct, numgold, numcand, matched)``, with the number of
+			distinct gold brackets, gold and candidate brackets, and
+			matching brackets with that label."""
+		self._flush()
+		return {label: tuple(cnt) for label, cnt in self.labelstats.items()}
+
+	def labelmismatches(self):
+		"""Count candidate brackets with the wrong label for a gold span.
+
+		A candidate bracket is counted if a gold bracket in the same
+		sentence has the same span but a different label. Only brackets
+		which are not matched are considered, and each distinct bracketing
+		is counted once. When several unmatched gold brackets have the same
+		span, the label of the last one in preorder is used.
+
+		:returns: a Counter with pairs of labels ``(cand, gold)``."""
+		self._flush()
+		return self.wronglabels
+
+	def funccounts(self):
+		"""Count function tags of brackets and POS tags in all sentences.
+
+		:returns: a tuple ``(distinct, numgold, numcand, matched)``, cf.
+			``labelcounts()``; ``self.funcstats`` has these counts per
+			function tag."""
+		return tuple(sum(a) for a in zip((0, 0, 0, 0),
+				*self.funcstats.values()))
+
+	def funcscores(self):
+		"""Return recall, precision, and F-measure of function tags."""
+		_, numgold, numcand, matched = self.funccounts()
+		return countscores(matched, numgold, numcand)
+
+	def tagaccuracy(self):
+		"""Return the fraction of correct POS tags."""
+		return Decimal(sum(cnt for (ctag, gtag), cnt in self.tagpairs.items()
+				if ctag == gtag)) / sum(self.tagpairs.values())
+
+	def depaccuracy(self):
+		"""Return the fraction of correct unlabeled dependencies."""
+		return Decimal(self.depmatched) / self.numdep
+
+	def meanlascore(self):
+		"""Return the mean leaf-ancestor score; NaN without sentences."""
+		if not self.numla:
+			return Decimal('NaN')
+		return self.lasum / self.numla
+
+	def scores(self):
+		"""Return a dictionary with running scores for all added sentences."""
+		lr, lp, lf = self.bracketscores()
+		return dict(lr=nozerodiv(lambda: lr),
+				lp=nozerodiv(lambda: lp),
+				lf=nozerodiv(lambda: lf),
+				ex=nozerodiv(lambda: self.exact / self.sentcount),
+				tag=nozerodiv(self.tagaccuracy),
+				fun=nozerodiv(lambda: self.funcscores()[2]))
+
+
+def treepairs(gold, parses):
+	"""Pair each parse tree with the gold tree of the same sentence.
+
+	Neither corpus is read into memory; both are read in lockstep with
+	``itertrees()``. When the keys differ, e.g., because the parses are a
+	subset or in a different order, the gold sentence is located with an
+	offset index. If it comes later in the gold corpus, reading continues
+	from there; an earlier sentence is looked up with
+	``CorpusReader.item()``. If the gold corpus cannot be indexed, e.g.,
+	because it is a compressed file, it is read into memory instead. Gold
+	trees read from standard input must be in the same order as the parses.
+
+	:param gold, parses: ``CorpusReader`` objects.
+	:yields: tuples ``(key, golditem, parseitem)``."""
+	golditems = gold.itertrees()
+	nextgold = next(golditems, None)
+	if nextgold is None:
+		raise ValueError('no trees in gold file')
+	goldpos = 0  # position of nextgold in the gold corpus
+	for n, citem in parses.itertrees():
+		if nextgold is None or nextgold[0] != n:
+			pos = gold.position(n)
+			if pos is None:
+				gold.trees()  # item() will use the trees kept in memory
+				yield n, gold.item(n), citem
+				continue
+			elif pos < goldpos:
+				yield n, gold.item(n), citem
+				continue
+			elif pos - goldpos > READERBATCHSIZE:  # seek instead of parsing
+				golditems = gold.itertrees(start=pos)
+				nextgold = next(golditems)
+			else:
+				nextgold = next(islice(golditems, pos - goldpos - 1, None))
+			goldpos = pos
+		yield n, nextgold[1], citem
+		nextgold = next(golditems, None)
+		goldpos += 1
+
+
+def evalcachekey(gtree, gsent, ctree, csent, param):
+	"""Return a key identifying the ``TreePairResult`` of a pair of trees.
+
+	The key is a SHA-1 digest of the trees including function tags and head
+	marking, the sentences, and the parameters that affect the result; the
+	sentence identifier is not part of the key, so that identical tree pairs
+	in different files share results.
+
+	:param gtree, ctree: the trees, before they are modified by
+		``TreePairResult``."""
+	paramkey = []
+	for key, value in sorted(param.items()):
+		if key not in AGGREGATIONPARAMS:
+			if isinstance(value, dict):
+				value = sorted(value.items())
+			elif isinstance(value, (set, frozenset)):
+				value = sorted(value)
+			paramkey.append((key, value))
+	# hashed here, so that the cache only has to hash a short string for
+	# both the lookup and the store
+	return hashlib.sha1(pickle.dumps((EVALCACHEVERSION, encodetree(gtree),
+			tuple(gsent), encodetree(ctree), tuple(csent), tuple(paramkey)),
+			protocol=2)).digest()
+
+
+def bracketarray(brackets, labelids, sentno=0):
+	"""Encode a multiset of bracketings as an array of integers.
+
+	Each row represents a bracketing with the columns: sentence number, label
+	ID, occurrence (to distinguish a bracketing that occurs more than once),
+	and the span as a bitset split into 64-bit words, least significant word
+	first. Rows are unique, which allows comparing bracketings with set
+	operations on sorted arrays; cf. ``matchingbrackets()``.
+
+	:param brackets: a multiset of bracketings ``(label, span)``, as returned
+		by ``bracketings()``.
+	:param labelids: a dictionary mapping labels to integer IDs; labels not
+		in the dictionary are added to it.
+	:param sentno: the sentence number.
+	:returns: an array of type uint64 with shape ``(len(brackets), 3 + w)``,
+		where ``w`` is the number of words needed for the widest span.
+
+	>>> labelids = {}
+	>>> print(bracketarray(Counter({('S', 0b111): 1, ('VP', 0b101): 2}),
+	... labelids, 3).tolist())
+	[[3, 0, 0, 7], [3, 1, 0, 5], [3, 1, 1, 5]]
+	>>> labelids
+	{'S': 0, 'VP': 1}"""
+	numwords = max([(span.bit_length() + 63) // 64
+			for _, span in brackets] + [1])
+	rows = []
+	for (label, span), cnt in brackets.items():
+		labelid = labelids.setdefault(label, len(labelids))
+		words = [(span >> (64 * n)) & 0xffffffffffffffff
+				for n in range(numwords)]
+		rows.extend([sentno, labelid, occurrence] + words
+				for occurrence in range(cnt))
+	return np.array(rows, dtype=np.uint64).reshape(-1, 3 + numwords)
+
+
+def stackbrackets(arrays):
+	"""Concatenate arrays produced by ``bracketarray()``.
+
+	Spans are padded with zero words to the widest span."""
+	if not arrays:
+		return np.zeros((0, 4), dtype=np.uint64)
+	width = max(a.shape[1] for a in arrays)
+	return np.concatenate([_widen(a, width) for a in arrays])
+
+
+def matchingbrackets(gold, cand):
+	"""Find the bracketings which occur in both arrays.
+
+	The arrays are compared by sorting their rows and intersecting them;
+	with the sentence number in each row, the brackets of a whole test set
+	can be compared at once.
+
+	:param gold, cand: arrays produced by ``bracketarray()`` or
+		``stackbrackets()``.
+	:returns: a tuple of arrays with the indices of the matching rows in
+		``gold`` and ``cand``.
+
+	>>> labelids = {}
+	>>> gold = bracketarray(Counter({('S', 0b111): 1, ('VP', 0b101): 2}),
+	... labelids)
+	>>> cand = bracketarray(Counter({('S', 0b111): 1, ('VP', 0b101): 1,
+	... ('NP', 0b110): 1}), labelids)
+	>>> len(matchingbrackets(gold, cand)[0])
+	2"""
+	width = max(gold.shape[1], cand.shape[1])
+	_, goldidx, candidx = np.intersect1d(
+			_rowkeys(_widen(gold, width)), _rowkeys(_widen(cand, width)),
+			assume_unique=True, return_indices=True)
+	return goldidx, candidx
+
+
+def unmatchedbrackets(gold, cand):
+	"""Find the distinct bracketings which occur more often in one array.
+
+	:param gold, cand: arrays produced by ``bracketarray()`` or
+		``stackbrackets()``.
+	:returns: a tuple of arrays with the rows of ``gold`` and ``cand`` which
+		are not matched in the other array, in their original order; the
+		occurrence column is set to zero and duplicate rows are removed.
+
+	>>> labelids = {}
+	>>> gold = bracketarray(Counter({('S', 0b111): 1, ('VP', 0b101): 3}),
+	... labelids)
+	>>> cand = bracketarray(Counter({('S', 0b111): 1, ('VP', 0b101): 1,
+	... ('NP', 0b110): 1}), labelids)
+	>>> [a.tolist() for a in unmatchedbrackets(gold, cand)]
+	[[[0, 1, 0, 5]], [[0, 2, 0, 6]]]"""
+	width = max(gold.shape[1], cand.shape[1])
+	gold, cand = _widen(gold, width), _widen(cand, width)
+	goldidx, candidx = matchingbrackets(gold, cand)
+	result = []
+	for brackets, matched in ((gold, goldidx), (cand, candidx)):
+		brackets = np.delete(brackets, matched, axis=0)
+		brackets[:, 2] = 0
+		_, idx = np.unique(_rowkeys(brackets), return_index=True)
+		result.append(brackets[np.sort(idx)])
+	return tuple(result)
+
+
+def spanfanout(brackets):
+	"""Return the fan-out of the span of each row in an array of brackets.
+
+	>>> labelids = {}
+	>>> print(spanfanout(bracketarray(Counter({('S', 0b111): 1,
+	... ('VP', 0b101): 1, ('X', 0b1011 << 62): 1}), labelids)).tolist())
+	[1, 2, 2]"""
+	words = brackets[:, 3:]
+	# a component starts at each set bit of which the preceding bit is unset;
+	# the preceding bit of the first bit in a word is the last bit of the
+	# previous word.
+	carry = np.zeros_like(words)
+	carry[:, 1:] = words[:, :-1] >> np.uint64(63)
+	starts = np.ascontiguousarray(words & ~((words << np.uint64(1)) | carry))
+	return np.unpackbits(starts.view(np.uint8), axis=1).sum(axis=1)
+
+
+def _widen(brackets, width):
+	"""Pad the spans in an array of brackets with zero words."""
+	if brackets.shape[1] == width:
+		return brackets
+	result = np.zeros((len(brackets), width), dtype=np.uint64)
+	result[:, :brackets.shape[1]] = brackets
+	return result
+
+
+def _rowkeys(brackets):
+	"""View each row of a 2D array as a single opaque value."""
+	brackets = np.ascontiguousarray(brackets)
+	return brackets.view(np.dtype((np.void,
+			brackets.dtype.itemsize * brackets.shape[1]))).ravel()
+
+
+# If the goldfile contains n constituents for the same span, and the parsed
+# file contains m constituents with that nonterminal, the scorer works as
+# follows:
+#
+# i) If m>n, then the precision is n/m, recall is 100%
+# ii) If n>m, then the precision is 100%, recall is m/n.
+# iii) If n==m, recall and precision are both 100%.
+def recall(reference, candidate):
+	"""Get recall score for two multisets."""
+	if not reference:
+		return Decimal('NaN')
+	return Decimal(sum(min(reference[a], candidate[a])
+			for a in reference & candidate)) / sum(reference.values())
+
+
+def precision(reference, candidate):
+	"""Get precision score for two multisets."""
+	if not candidate:
+		return Decimal('NaN')
+	return Decimal(sum(min(reference[a], candidate[a])
+			for a in reference & candidate)) / sum(candidate.values())
+
+
+def f_measure(reference, candidate, alpha=Decimal(0.5)):
+	"""Get F-measure of precision and recall for two multisets.
+
+	The default weight ``alpha=0.5`` corresponds to the F_1-measure."""
+	p = precision(reference, candidate)
+	r = recall(reference, candidate)
+	if p == 0 or r == 0:
+		return Decimal('NaN')
+	return Decimal(1) / (alpha / p + (1 - alpha) / r)
+
+
+def countscores(matched, numgold, numcand, alpha=Decimal(0.5)):
+	"""Get recall, precision, and F-measure from counts.
+
+	Gives the same results as ``recall()``, ``precision()``, and
+	``f_measure()`` for multisets ``reference`` and ``candidate`` with
+	``sum(reference.values()) == numgold``,
+	``sum(candidate.values()) == numcand``,
+	and ``sum((reference & candidate).values()) == matched``.
+
+	:returns: a tuple of Decimals ``(recall, precision, fmeasure)``."""
+	r = (Decimal(matched) / numgold) if numgold else Decimal('NaN')
+	p = (Decimal(matched) / numcand) if numcand else Decimal('NaN')
+	if p == 0 or r == 0:
+		return r, p, Decimal('NaN')
+	return r, p, Decimal(1) / (alpha / p + (1 - alpha) / r)
+
+
+def accuracy(reference, candidate):
+	"""Compute fraction of equivalent pairs in two sequences.
+
+	In particular, return the fraction of indices
+	``0<i<=len(test)`` such that ``test[i] == reference[i]``."""
+	if len(reference) != len(candidate):
+		raise ValueError('Sequences must have the same length.')
+	return Decimal(sum(a == b for a, b in zip(reference, candidate))
+			) / len(reference)
+
+
+def _addcounts(counts, key, values):
+	"""Add a sequence of counts to the list of counts for ``key``."""
+	if key in counts:
+		counts[key] = [a + b for a, b in zip(counts[key], values)]
+	else:
+		counts[key] = list(values)
+
+
+def mostcommon(counts, limit=None):
+	"""Return the most common elements of a Counter with their counts.
+
+	Like ``Counter.most_common()``, but elements with the same count are
+	sorted, so that the result does not depend on the order in which
+	elements were added.
+
+	>>> mostcommon(Counter('abracadabra'), 3)
+	[('a', 5), ('b', 2), ('r', 2)]"""
+	return sorted(counts.items(), key=lambda x: (-x[1], x[0]))[:limit]
+
+
+def harmean(seq):
+	"""Compute harmonic mean of a sequence of numbers.
+
+	Returns NaN when ``seq`` contains zero."""
+	numerator = denominator = Decimal(0)
+	for a in seq:
+		if not a:
+			return Decimal('NaN')
+		numerator += 1
+		denominator += Decimal(1) / a
+	if not denominator:
+		return Decimal('NaN')
+	return numerator / denominator
+
+
+def mean(seq):
+	"""Compute arithmetic mean of a sequence.
+
+	Returns NaN when ``seq`` is empty."""
+	numerator = denominator = Decimal(0)
+	for a in seq:
+		numerator += a
+		denominator += 1
+	if not denominator:
+		return Decimal('NaN')
+	return numerator / denominator
+
+
+def intervals(bitset):
+	"""Return a sequence of intervals corresponding to contiguous ranges.
+
+	``seq`` is an integer representing a bitvector. An interval is a pair
+	``(a, b)``, with ``a <= b`` denoting a contiguous range of one bits ``x``
+	in ``seq`` such that ``a <= x <= b``.
+
+	>>> list(intervals(0b111011011))  # NB: read from right to left
+	[(0, 1), (3, 4), (6, 8)]"""
+	start = prev = None
+	for a in getbits(bitset):
+		if start is None:
+			start = prev = a
+		elif a == prev + 1:
+			prev = a
+		else:
+			yield start, prev
+			start = prev = a
+	if start is not None:
+		yield start, prev
+
+
+def nozerodiv(func):
+	"""Return ``func()`` as 6-character string but catch zero division."""
+	try:
+		result = func()
+	except (ZeroDivisionError, InvalidOperation):
+		return ' 0DIV!'
+	return '  None' if result is None else '%6.2f' % (100 * result)
+
+
+def editdistance(seq1, seq2):
+	"""Calculate the Levenshtein edit-distance between two strings.
+
+	The edit distance is the number of characters that need to be substituted,
+	inserted, or deleted, to transform seq1 into seq2.  For example,
+	transforming 'rain' to 'shine' requires three steps, consisting of two
+	substitutions and one insertion: 'rain' -> 'sain' -> 'shin' -> 'shine'.
+	These operations could have been done in other orders, but at least three
+	steps are needed."""
+	# initialize 2-D array to zero
+	len1, len2 = len(seq1), len(seq2)
+	lev = [[0] * (len2 + 1) for _ in range(len1 + 1)]
+	for i in range(len1 + 1):
+		lev[i][0] = i           # column 0: 0,1,2,3,4,...
+	for j in range(len2 + 1):
+		lev[0][j] = j           # row 0: 0,1,2,3,4,...
+	# iterate over the array
+	for i in range(len1):
+		for j in range(len2):
+			a = lev[i][j + 1] + 1               # skip seq1[i]
+			b = lev[i][j] + (seq1[i] != seq2[j])  # match seq1[i] with seq2[j]
+			c = lev[i + 1][j] + 1               # skip seq2[j]
+			lev[i + 1][j + 1] = min(a, b, c)    # pick the cheapest
+	return lev[len1][len2]
+
+
+def pyintbitcount(a):
+	"""Return number of set bits (1s) in a Python integer.
+
+	>>> pyintbitcount(0b0011101)
+	4"""
+	cnt = 0
+	while a:
+		a &= a - 1
+		cnt += 1
+	return cnt
+
+
+__all__ = ['EvalAccumulator', 'treepairs', 'evalcachekey', 'bracketarray',
+		'stackbrackets', 'matchingbrackets', 'unmatchedbrackets',
+		'spanfanout', 'recall', 'precision', 'f_measure', 'countscores',
+		'accuracy', 'mostcommon', 'harmean', 'mean', 'intervals',
+		'nozerodiv', 'editdistance', 'pyintbitcount']
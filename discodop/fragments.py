@@ -13,12 +13,21 @@ import io
 import os
 import re
 import sys
+import math
+import time
 import codecs
+import struct
+import pickle
+import hashlib
+import heapq
+import shutil
 import logging
 import tempfile
 if sys.version_info[0] == 2:
 	from itertools import imap as map  # pylint: disable=E0611,W0622
 import multiprocessing
+from array import array
+from datetime import timedelta
 from collections import defaultdict
 from getopt import gnu_getopt, GetoptError
 from .tree import brackettree
@@ -26,7 +35,7 @@ from .treebank import writetree
 from .treetransforms import unbinarize
 from . import _fragments
 from .util import workerfunc
-from .containers import Vocabulary
+from .containers import Vocabulary, FixedVocabulary, Ctrees
 
 SHORTUSAGE = '''\
 Usage: discodop fragments <treebank1> [treebank2] [options]
@@ -34,8 +43,13 @@ Usage: discodop fragments <treebank1> [treebank2] [options]
 FLAGS = ('approx', 'indices', 'nofreq', 'complete', 'alt',
 		'relfreq', 'adjacent', 'debin', 'debug', 'quiet', 'help')
 OPTIONS = ('fmt=', 'numproc=', 'numtrees=', 'encoding=', 'batch=', 'cover=',
-		'twoterms=')
+		'twoterms=', 'approx-sketch=', 'checkpoint=', 'restrict=')
 PARAMS = {}
+# default number of fragments kept with --approx-sketch
+SKETCHTOP = 100000
+# number of trees per interval of work when reporting progress or writing
+# checkpoints
+INTERVALSIZE = 200
 FRONTIERRE = re.compile(r'\(([^ ()]+) \)')  # for altrepr()
 TERMRE = re.compile(r'\(([^ ()]+) ([^ ()]+)\)')  # for altrepr()
 
@@ -69,6 +83,14 @@ def main(argv=None):
 	elif '--cover' in opts:
 		PARAMS['cover'] = int(opts.get('--cover', 0)), 999
 	PARAMS['twoterms'] = opts.get('--twoterms')
+	PARAMS['sketchbudget'] = PARAMS['sketchtop'] = None
+	if '--approx-sketch' in opts:
+		mb, _, top = opts['--approx-sketch'].partition(',')
+		PARAMS['sketchbudget'] = int(float(mb) * 1024 ** 2)
+		PARAMS['sketchtop'] = int(top or SKETCHTOP)
+		PARAMS['approx'] = True
+	PARAMS['checkpoint'] = opts.get('--checkpoint')
+	PARAMS['restrict'] = opts.get('--restrict')
 	encoding = opts.get('--encoding', 'utf8')
 	batchdir = opts.get('--batch')
 
@@ -82,6 +104,8 @@ def main(argv=None):
 		if numproc != 1:
 			raise ValueError('Batch mode only supported in single-process '
 				'mode. Use the xargs command for multi-processing.')
+		if PARAMS['restrict']:
+			raise ValueError('--restrict is not supported in batch mode.')
 	tmp = None
 	for n, fname in enumerate(args):
 		if fname == '-':
@@ -96,6 +120,11 @@ def main(argv=None):
 				args[n] = tmp.name
 		elif not os.path.exists(fname):
 			raise ValueError('not found: %r' % fname)
+	if PARAMS['sketchbudget']:
+		if (batchdir or PARAMS['complete'] or PARAMS['indices']
+				or PARAMS['nofreq']):
+			raise ValueError('--approx-sketch is incompatible with --batch, '
+					'--complete, --indices, and --nofreq.')
 	if PARAMS['complete']:
 		if len(args) < 2:
 			raise ValueError('need at least two treebanks with --complete.')
@@ -135,7 +164,13 @@ def main(argv=None):
 def regular(filenames, numproc, limit, encoding):
 	"""non-batch processing. multiprocessing optional."""
 	mult = 1
-	if PARAMS['approx']:
+	sketch = None
+	if PARAMS.get('sketchbudget'):
+		# counts go in the sketch; only a bounded number of fragments with
+		# the highest estimated counts is kept.
+		sketch = CountMinSketch.frombudget(PARAMS['sketchbudget'])
+		fragments = HeavyHitters(sketch, PARAMS['sketchtop'])
+	elif PARAMS['approx']:
 		fragments = defaultdict(int)
 	else:
 		fragments = {}
@@ -144,73 +179,123 @@ def regular(filenames, numproc, limit, encoding):
 			filenames[0],
 			filenames[1] if len(filenames) == 2 else None,
 			limit, encoding)
-	if numproc == 1:
-		mymap, myworker = map, worker
-	else:  # multiprocessing, start worker processes
-		pool = multiprocessing.Pool(
-				processes=numproc, initializer=initworker,
-				initargs=(filenames[0], filenames[1] if len(filenames) == 2
-					else None, limit, encoding))
-		mymap, myworker = pool.imap, mpworker
-	numtrees = (PARAMS['trees1'].len if limit is None
-			else min(PARAMS['trees1'].len, limit))
-
-	if PARAMS['complete']:
-		trees1, trees2 = PARAMS['trees1'], PARAMS['trees2']
-		fragmentkeys, bitsets = _fragments.completebitsets(
-				trees1, PARAMS['vocab'],
-				max(trees1.maxnodes, trees2.maxnodes), PARAMS['disc'])
-	else:
-		if len(filenames) == 1:
-			work = workload(numtrees, mult, numproc)
+	tmpdir = pool = None
+	try:
+		if numproc == 1:
+			mymap, myworker = map, worker
+		else:  # multiprocessing, start worker processes
+			# workers map the indexed treebanks read by this process,
+			# instead of reading and indexing them again.
+			tmpdir = tempfile.mkdtemp(prefix='fragments')
+			pool = multiprocessing.Pool(
+					processes=numproc, initializer=initworkermmap,
+					initargs=writectrees(tmpdir))
+			mymap, myworker = pool.imap, mpworker
+		numtrees = (PARAMS['trees1'].len if limit is None
+				else min(PARAMS['trees1'].len, limit))
+
+		if PARAMS['complete']:
+			trees1, trees2 = PARAMS['trees1'], PARAMS['trees2']
+			fragmentkeys, bitsets = _fragments.completebitsets(
+					trees1, PARAMS['vocab'],
+					max(trees1.maxnodes, trees2.maxnodes), PARAMS['disc'])
 		else:
-			chunk = numtrees // (mult * numproc) + 1
-			work = [(a, a + chunk) for a in range(0, numtrees, chunk)]
-		if numproc != 1:
-			logging.info('work division:\n%s', '\n'.join('    %s:\t%r' % kv
-				for kv in sorted(dict(numchunks=len(work), mult=mult).items())))
-		dowork = mymap(myworker, work)
-		for results in dowork:
-			if PARAMS['approx']:
-				for frag, x in results.items():
-					fragments[frag] += x
+			if PARAMS.get('checkpoint') or not PARAMS.get('quiet'):
+				# many small intervals, such that progress is reported and
+				# checkpoints are written regularly.
+				work = workload(numtrees, mult, numproc, INTERVALSIZE)
+			elif len(filenames) == 1:
+				work = workload(numtrees, mult, numproc)
 			else:
-				fragments.update(results)
-		fragmentkeys = list(fragments)
-		bitsets = [fragments[a] for a in fragmentkeys]
-	if PARAMS['nofreq']:
-		counts = None
-	elif PARAMS['approx']:
-		counts = [fragments[a] for a in fragmentkeys]
-	else:
-		task = 'indices' if PARAMS['indices'] else 'counts'
-		logging.info('dividing work for exact %s', task)
-		countchunk = len(bitsets) // numproc + 1
-		work = list(range(0, len(bitsets), countchunk))
-		work = [(n, len(work), bitsets[a:a + countchunk])
-				for n, a in enumerate(work)]
-		counts = []
-		logging.info('getting exact %s', task)
-		for a in mymap(
-				exactcountworker if numproc == 1 else mpexactcountworker, work):
-			counts.extend(a)
-	if PARAMS['cover']:
-		maxdepth, maxfrontier = PARAMS['cover']
-		before = len(fragmentkeys)
-		cover = _fragments.allfragments(PARAMS['trees1'], PARAMS['vocab'],
-				maxdepth, maxfrontier, PARAMS['disc'], PARAMS['indices'])
-		for a in cover:
-			if a not in fragments:
-				fragmentkeys.append(a)
-				counts.append(cover[a])
-		logging.info('merged %d cover fragments '
-				'up to depth %d with max %d frontier non-terminals.',
-				len(fragmentkeys) - before, maxdepth, maxfrontier)
-	if numproc != 1:
-		pool.close()
-		pool.join()
-		del dowork, pool
-	return fragmentkeys, counts
+				chunk = numtrees // (mult * numproc) + 1
+				work = [(a, a + chunk) for a in range(0, numtrees, chunk)]
+			if numproc != 1:
+				logging.info('work division:\n%s', '\n'.join(
+						'    %s:\t%r' % kv for kv in sorted(
+							dict(numchunks=len(work), mult=mult).items())))
+			done = set()
+			if PARAMS.get('checkpoint'):
+				done = readcheckpoints(PARAMS['checkpoint'], filenames, limit)
+				logging.info('resuming; %d of %d intervals already done.',
+						len(done & set(work)), len(work))
+			numtrees2 = len(PARAMS['trees2']) if len(filenames) == 2 else None
+			totalpairs = sum(numpairs(a, numtrees, numtrees2) for a in work)
+			pairsdone = pairscomputed = 0
+			begin = time.time()
+			dowork = mymap(myworker, [a for a in work if a not in done])
+			for n, interval in enumerate(work, 1):
+				if interval in done:
+					results = loadcheckpoint(PARAMS['checkpoint'], interval)
+				else:
+					results = next(dowork)
+					pairscomputed += numpairs(interval, numtrees, numtrees2)
+					if PARAMS.get('checkpoint'):
+						writecheckpoint(
+								PARAMS['checkpoint'], interval, results)
+				pairsdone += numpairs(interval, numtrees, numtrees2)
+				if sketch is not None:
+					fragments.update(results)
+				elif PARAMS['approx']:
+					for frag, x in results.items():
+						fragments[frag] += x
+				else:
+					fragments.update(results)
+				logprogress('extracted fragments from interval %d of %d; '
+						'%d of %d tree pairs; %d fragments' % (n, len(work),
+						pairsdone, totalpairs, len(fragments)),
+						time.time() - begin, pairscomputed,
+						totalpairs - pairsdone)
+			fragmentkeys = list(fragments)
+			bitsets = [fragments[a] for a in fragmentkeys]
+		if PARAMS['nofreq']:
+			counts = None
+		elif sketch is not None:
+			counts = [sketch[a] for a in fragmentkeys]
+			maxerror, delta = sketch.errorbound()
+			logging.info('count-min sketch with %d x %d counters (%d bytes); '
+					'with probability %g, counts are overestimated by at most '
+					'%g (total count: %d); kept %d most frequent fragments.',
+					sketch.depth, sketch.width,
+					len(sketch.table) * sketch.table.itemsize,
+					1 - delta, maxerror, sketch.total, len(fragmentkeys))
+		elif PARAMS['approx']:
+			counts = [fragments[a] for a in fragmentkeys]
+		else:
+			task = 'indices' if PARAMS['indices'] else 'counts'
+			logging.info('dividing work for exact %s', task)
+			countchunk = len(bitsets) // numproc + 1
+			work = list(range(0, len(bitsets), countchunk))
+			work = [(n, len(work), bitsets[a:a + countchunk])
+					for n, a in enumerate(work)]
+			counts = []
+			logging.info('getting exact %s', task)
+			begin = time.time()
+			for a in mymap(exactcountworker if numproc == 1
+					else mpexactcountworker, work):
+				counts.extend(a)
+				logprogress('exact %s for %d of %d fragments' % (
+						task, len(counts), len(bitsets)),
+						time.time() - begin, len(counts),
+						len(bitsets) - len(counts))
+		if PARAMS['cover']:
+			maxdepth, maxfrontier = PARAMS['cover']
+			before = len(fragmentkeys)
+			cover = _fragments.allfragments(PARAMS['trees1'], PARAMS['vocab'],
+					maxdepth, maxfrontier, PARAMS['disc'], PARAMS['indices'])
+			for a in cover:
+				if a not in fragments:
+					fragmentkeys.append(a)
+					counts.append(cover[a])
+			logging.info('merged %d cover fragments '
+					'up to depth %d with max %d frontier non-terminals.',
+					len(fragmentkeys) - before, maxdepth, maxfrontier)
+		return fragmentkeys, counts
+	finally:
+		if pool is not None:
+			pool.terminate()
+			pool.join()
+		if tmpdir is not None:
+			shutil.rmtree(tmpdir)
 
 
 def batch(outputdir, filenames, limit, encoding, debin):
@@ -298,8 +383,8 @@ def read2ndtreebank(filename2, vocab, fmt='bracket',
 def initworker(filename1, filename2, limit, encoding):
 	"""Read treebanks for this worker.
 
-	We do this separately for each process under the assumption that this is
-	advantageous with a NUMA architecture."""
+	Only used in the main process; worker processes map the result
+	with :func:`initworkermmap`."""
 	PARAMS.update(readtreebanks(filename1, filename2,
 			limit=limit, fmt=PARAMS['fmt'], encoding=encoding))
 	trees1 = PARAMS['trees1']
@@ -327,6 +412,11 @@ def initworker(filename1, filename2, limit, encoding):
 		m += 'treebank2: %d trees; %d nodes (max %d); %d word tokens.\n' % (
 				trees2.len, trees2.numnodes, trees2.maxnodes, trees2.numwords)
 	logging.info('%s%r', m, PARAMS['vocab'])
+	selecttrees()
+	if PARAMS['subset1'] is not None:
+		logging.info('restricted to %d trees in treebank1%s',
+				len(PARAMS['subset1']), '' if filename2 is None
+				else ' and %d in treebank2' % len(PARAMS['subset2']))
 
 
 def initworkersimple(trees, sents, trees2=None, sents2=None):
@@ -334,6 +424,57 @@ def initworkersimple(trees, sents, trees2=None, sents2=None):
 	PARAMS.update(_fragments.getctrees(zip(trees, sents),
 			None if trees2 is None else zip(trees2, sents2)))
 	assert PARAMS['trees1'], PARAMS['trees1']
+	selecttrees()
+
+
+def writectrees(directory):
+	"""Write the indexed treebanks and vocabulary in ``PARAMS`` to files.
+
+	:param directory: the directory in which files will be created.
+	:returns: a tuple ``(ctfile1, ctfile2, vocabfile)`` with the arguments
+		for :func:`initworkermmap`; ``ctfile2`` is ``None`` when there is
+		no second treebank."""
+	ctfile1 = os.path.join(directory, 'treebank1.ct')
+	PARAMS['trees1'].tofile(ctfile1)
+	ctfile2 = None
+	if PARAMS.get('trees2') is not None:
+		ctfile2 = os.path.join(directory, 'treebank2.ct')
+		PARAMS['trees2'].tofile(ctfile2)
+	vocabfile = os.path.join(directory, 'vocab.idx')
+	PARAMS['vocab'].tofile(vocabfile)
+	return ctfile1, ctfile2, vocabfile
+
+
+def initworkermmap(ctfile1, ctfile2, vocabfile):
+	"""Initialization for a worker by memory-mapping files.
+
+	The files are mapped read-only, such that the pages are shared among
+	all workers, and worker startup does not depend on the treebank size.
+
+	:param ctfile1, ctfile2, vocabfile: filenames as returned by
+		:func:`writectrees`."""
+	PARAMS['trees1'] = Ctrees.fromfile(ctfile1)
+	PARAMS['trees2'] = None if ctfile2 is None else Ctrees.fromfile(ctfile2)
+	PARAMS['vocab'] = FixedVocabulary.fromfile(vocabfile)
+	if PARAMS['twoterms']:  # needs number of productions
+		PARAMS['vocab'].makeindex()
+	selecttrees()
+
+
+def selecttrees():
+	"""Select subsets of trees in ``PARAMS`` for the ``--restrict`` option.
+
+	Sets ``PARAMS['subset1']`` and ``PARAMS['subset2']`` to the trees of
+	each treebank with a label or production matching the pattern, or to
+	``None`` when the option is not used. For a single treebank, both refer
+	to the same subset."""
+	PARAMS['subset1'] = PARAMS['subset2'] = None
+	if PARAMS.get('restrict'):
+		PARAMS['subset1'] = PARAMS['subset2'] = _fragments.selecttrees(
+				PARAMS['trees1'], PARAMS['vocab'], PARAMS['restrict'])
+		if PARAMS['trees2'] is not None:
+			PARAMS['subset2'] = _fragments.selecttrees(
+					PARAMS['trees2'], PARAMS['vocab'], PARAMS['restrict'])
 
 
 @workerfunc
@@ -353,7 +494,8 @@ def worker(interval):
 			PARAMS['vocab'], trees2, approx=PARAMS['approx'],
 			disc=PARAMS['disc'],
 			debug=PARAMS['debug'], twoterms=PARAMS['twoterms'],
-			adjacent=PARAMS['adjacent'])
+			adjacent=PARAMS['adjacent'], subset1=PARAMS.get('subset1'),
+			subset2=PARAMS.get('subset2'))
 	logging.debug('finished %d--%d', offset, end)
 	return result
 
@@ -370,11 +512,12 @@ def exactcountworker(args):
 	trees1 = PARAMS['trees1']
 	if PARAMS['complete']:
 		results = _fragments.exactcounts(trees1, PARAMS['trees2'], bitsets,
-				indices=PARAMS['indices'])
+				indices=PARAMS['indices'], subset=PARAMS.get('subset2'))
 		logging.debug('complete matches chunk %d of %d', n + 1, m)
 		return results
 	results = _fragments.exactcounts(
-			trees1, trees1, bitsets, indices=PARAMS['indices'])
+			trees1, trees1, bitsets, indices=PARAMS['indices'],
+			subset=PARAMS.get('subset1'))
 	if PARAMS['indices']:
 		logging.debug('exact indices chunk %d of %d', n + 1, m)
 	else:
@@ -382,7 +525,7 @@ def exactcountworker(args):
 	return results
 
 
-def workload(numtrees, mult, numproc):
+def workload(numtrees, mult, numproc, size=None):
 	"""Calculate an even workload.
 
 	When *n* trees are compared against themselves, ``n * (n - 1)`` total
@@ -390,10 +533,17 @@ def workload(numtrees, mult, numproc):
 	such that ``m < x <= n``
 	(meaning there are more comparisons for lower *n*).
 
+	:param size: if given, return intervals of ``size`` trees each instead.
 	:returns: a sequence of ``(start, end)`` intervals such that
-		the number of comparisons is approximately balanced."""
+		the number of comparisons is approximately balanced.
+
+	>>> workload(5, 1, 1, size=2)
+	[(0, 2), (2, 4), (4, 5)]"""
 	# could base on number of nodes as well.
-	if numproc == 1:
+	if size is not None:
+		return [(a, min(a + size, numtrees))
+				for a in range(0, numtrees, size)]
+	elif numproc == 1:
 		return [(0, numtrees)]
 	# here chunk is the number of tree pairs that will be compared
 	goal = togo = total = 0.5 * numtrees * (numtrees - 1)
@@ -412,6 +562,88 @@ def workload(numtrees, mult, numproc):
 	return result
 
 
+def numpairs(interval, numtrees1, numtrees2=None):
+	"""Return the number of tree pairs compared for an interval.
+
+	:param interval: a ``(start, end)`` interval of the first treebank.
+	:param numtrees1, numtrees2: the number of trees in the treebanks;
+		``numtrees2`` is ``None`` for a single treebank.
+
+	>>> numpairs((0, 4), 4), numpairs((2, 4), 4)
+	(6, 1)"""
+	start, end = interval
+	if PARAMS.get('adjacent'):
+		return end - start
+	elif numtrees2 is not None:
+		return (end - start) * numtrees2
+	# tree n is compared to trees n + 1, ..., numtrees1 - 1
+	return (2 * numtrees1 - start - end - 1) * (end - start) // 2
+
+
+def logprogress(msg, elapsed, done, togo):
+	"""Log a progress message with the estimated time remaining.
+
+	:param elapsed: seconds spent on ``done`` units of work.
+	:param togo: units of work remaining."""
+	eta = '?'
+	if done:
+		eta = str(timedelta(seconds=int(elapsed / done * togo)))
+	logging.info('%s; elapsed %s; ETA %s', msg,
+			timedelta(seconds=int(elapsed)), eta)
+
+
+def readcheckpoints(directory, filenames, limit):
+	"""Prepare directory with checkpoints for resuming an interrupted run.
+
+	The directory is created if necessary. A description of the run is
+	stored, and a ``ValueError`` is raised if the directory contains
+	checkpoints of a run with different treebanks or parameters.
+
+	:returns: the set of ``(start, end)`` intervals for which results have
+		been stored with :func:`writecheckpoint`."""
+	run = dict(
+			treebanks=[(os.path.abspath(a), os.stat(a).st_size,
+				os.stat(a).st_mtime) for a in filenames],
+			limit=limit,
+			params={a: PARAMS.get(a) for a in ('fmt', 'disc', 'approx',
+				'twoterms', 'adjacent', 'restrict')})
+	runfile = os.path.join(directory, 'run.pkl')
+	if not os.path.exists(directory):
+		os.makedirs(directory)
+	if os.path.exists(runfile):
+		with open(runfile, 'rb') as inp:
+			if pickle.load(inp) != run:
+				raise ValueError('checkpoint directory %r contains results '
+						'with other treebanks or parameters.' % directory)
+	else:
+		with open(runfile, 'wb') as out:
+			pickle.dump(run, out, protocol=-1)
+	result = set()
+	for filename in os.listdir(directory):
+		match = re.match(r'^interval([0-9]+)-([0-9]+)\.pkl$', filename)
+		if match:
+			result.add((int(match.group(1)), int(match.group(2))))
+	return result
+
+
+def loadcheckpoint(directory, interval):
+	"""Load results for an interval stored with :func:`writecheckpoint`."""
+	with open(os.path.join(directory,
+			'interval%d-%d.pkl' % interval), 'rb') as inp:
+		return pickle.load(inp)
+
+
+def writecheckpoint(directory, interval, results):
+	"""Store results for an interval of :func:`workload`.
+
+	The file is renamed after writing it, so that an interrupted write does
+	not leave an incomplete checkpoint."""
+	filename = os.path.join(directory, 'interval%d-%d.pkl' % interval)
+	with open(filename + '.tmp', 'wb') as out:
+		pickle.dump(results, out, protocol=-1)
+	os.rename(filename + '.tmp', filename)
+
+
 def recurringfragments(trees, sents, numproc=1, disc=True,
 		indices=True, maxdepth=1,
 		maxfrontier=999):
@@ -445,58 +677,63 @@ def recurringfragments(trees, sents, numproc=1, disc=True,
 	trees = trees[:]
 	work = workload(numtrees, mult, numproc)
 	PARAMS.update(disc=disc, indices=indices, approx=False, complete=False,
-			debug=False, adjacent=False, twoterms=None)
+			debug=False, adjacent=False, twoterms=None, restrict=None)
 	initworkersimple(trees, list(sents))
-	if numproc == 1:
-		mymap, myworker = map, worker
-	else:
-		logging.info('work division:\n%s', '\n'.join('    %s: %r' % kv
-				for kv in sorted(dict(numchunks=len(work),
-					numproc=numproc).items())))
-		# start worker processes
-		pool = multiprocessing.Pool(
-				processes=numproc, initializer=initworkersimple,
-				initargs=(trees, list(sents)))
-		mymap, myworker = pool.map, mpworker
-	# collect recurring fragments
-	logging.info('extracting recurring fragments')
-	for a in mymap(myworker, work):
-		fragments.update(a)
-	fragmentkeys = list(fragments)
-	bitsets = [fragments[a] for a in fragmentkeys]
-	countchunk = len(bitsets) // numproc + 1
-	work = list(range(0, len(bitsets), countchunk))
-	work = [(n, len(work), bitsets[a:a + countchunk])
-			for n, a in enumerate(work)]
-	logging.info('getting exact counts for %d fragments', len(bitsets))
-	counts = []
-	for a in mymap(
-			exactcountworker if numproc == 1 else mpexactcountworker, work):
-		counts.extend(a)
-	# add all fragments up to a given depth
-	if maxdepth:
-		cover = _fragments.allfragments(PARAMS['trees1'], PARAMS['vocab'],
-				maxdepth, maxfrontier, disc, indices)
-		before = len(fragmentkeys)
-		for a in cover:
-			if a not in fragments:
-				fragmentkeys.append(a)
-				counts.append(cover[a])
-		logging.info('merged %d cover fragments '
-				'up to depth %d with max %d frontier non-terminals.',
-				len(fragmentkeys) - before, maxdepth, maxfrontier)
-	if numproc != 1:
-		pool.close()
-		pool.join()
-		del pool
-	logging.info('found %d fragments', len(fragmentkeys))
-	return dict(zip(fragmentkeys, counts))
+	tmpdir = pool = None
+	try:
+		if numproc == 1:
+			mymap, myworker = map, worker
+		else:
+			logging.info('work division:\n%s', '\n'.join('    %s: %r' % kv
+					for kv in sorted(dict(numchunks=len(work),
+						numproc=numproc).items())))
+			# start worker processes
+			tmpdir = tempfile.mkdtemp(prefix='fragments')
+			pool = multiprocessing.Pool(
+					processes=numproc, initializer=initworkermmap,
+					initargs=writectrees(tmpdir))
+			mymap, myworker = pool.map, mpworker
+		# collect recurring fragments
+		logging.info('extracting recurring fragments')
+		for a in mymap(myworker, work):
+			fragments.update(a)
+		fragmentkeys = list(fragments)
+		bitsets = [fragments[a] for a in fragmentkeys]
+		countchunk = len(bitsets) // numproc + 1
+		work = list(range(0, len(bitsets), countchunk))
+		work = [(n, len(work), bitsets[a:a + countchunk])
+				for n, a in enumerate(work)]
+		logging.info('getting exact counts for %d fragments', len(bitsets))
+		counts = []
+		for a in mymap(exactcountworker if numproc == 1
+				else mpexactcountworker, work):
+			counts.extend(a)
+		# add all fragments up to a given depth
+		if maxdepth:
+			cover = _fragments.allfragments(PARAMS['trees1'], PARAMS['vocab'],
+					maxdepth, maxfrontier, disc, indices)
+			before = len(fragmentkeys)
+			for a in cover:
+				if a not in fragments:
+					fragmentkeys.append(a)
+					counts.append(cover[a])
+			logging.info('merged %d cover fragments '
+					'up to depth %d with max %d frontier non-terminals.',
+					len(fragmentkeys) - before, maxdepth, maxfrontier)
+		logging.info('found %d fragments', len(fragmentkeys))
+		return dict(zip(fragmentkeys, counts))
+	finally:
+		if pool is not None:
+			pool.terminate()
+			pool.join()
+		if tmpdir is not None:
+			shutil.rmtree(tmpdir)
 
 
 def allfragments(trees, sents, maxdepth, maxfrontier=999):
 	"""Return all fragments up to a certain depth, # frontiers."""
 	PARAMS.update(disc=True, indices=True, approx=False, complete=False,
-			debug=False, adjacent=False, twoterms=None)
+			debug=False, adjacent=False, twoterms=None, restrict=None)
 	initworkersimple(trees, list(sents))
 	return _fragments.allfragments(PARAMS['trees1'],
 			PARAMS['vocab'], maxdepth, maxfrontier,
@@ -592,6 +829,139 @@ def printfragments(fragments, counts, out=None):
 				raise ValueError('invalid fragment--frequency=1: %r' % a)
 
 
+class CountMinSketch(object):
+	"""Approximate counts of strings using a fixed amount of memory.
+
+	Estimates are never lower than the counts that were added; with
+	probability ``1 - delta``, an estimate exceeds the actual count by at most
+	``epsilon * total``, where ``total`` is the sum of all counts added,
+	``epsilon = e / width``, and ``delta = exp(-depth)``. Counts are added
+	with conservative update: only the counters that are lower than the new
+	estimate are increased, which reduces the overestimation in practice.
+
+	:param width: the number of counters in each row of the table.
+	:param depth: the number of rows (hash functions).
+
+	>>> sketch = CountMinSketch(1000, 4)
+	>>> sketch.add('(S (NP ) (VP ))', 3)
+	3
+	>>> sketch.add('(NP (DT the) (NN ))')
+	1
+	>>> sketch['(S (NP ) (VP ))'], sketch['(NP (DT the) (NN ))']
+	(3, 1)
+	"""
+	def __init__(self, width, depth=4):
+		if width < 1 or depth < 1:
+			raise ValueError('width and depth should be positive integers.')
+		self.width, self.depth = width, depth
+		self.total = 0
+		self.table = array('I', [0]) * (width * depth)
+
+	@classmethod
+	def frombudget(cls, nbytes, depth=4):
+		"""Create a sketch with at most ``nbytes`` bytes worth of counters."""
+		return cls(max(1, nbytes // (depth * array('I').itemsize)), depth)
+
+	def _indices(self, key):
+		"""Return the index of the counter for ``key`` in each row.
+
+		Uses a stable hash function such that results do not depend on the
+		process in which they were computed."""
+		h1, h2 = struct.unpack('<QQ', hashlib.md5(key.encode('utf8')).digest())
+		return [row * self.width + (h1 + row * h2) % self.width
+				for row in range(self.depth)]
+
+	def add(self, key, count=1):
+		"""Add ``count`` occurrences of ``key``; return the new estimate."""
+		table = self.table
+		indices = self._indices(key)
+		new = min(table[idx] for idx in indices) + count
+		for idx in indices:
+			if table[idx] < new:
+				table[idx] = new
+		self.total += count
+		return new
+
+	def update(self, counts):
+		"""Add counts from a dictionary with strings as keys."""
+		for key, count in counts.items():
+			self.add(key, count)
+
+	def __getitem__(self, key):
+		"""Return estimated count for ``key``."""
+		table = self.table
+		return min(table[idx] for idx in self._indices(key))
+
+	def errorbound(self):
+		"""Return maximum overestimation and probability of exceeding it.
+
+		:returns: a tuple ``(epsilon * total, delta)``."""
+		return math.e / self.width * self.total, math.exp(-self.depth)
+
+
+class HeavyHitters(object):
+	"""Keep track of the ``k`` keys with the highest counts in a sketch.
+
+	Counts are added to a ``CountMinSketch``; a key is only stored as a
+	candidate when its estimated count is among the highest ``k`` seen so
+	far, such that at most ``2 * k`` keys are kept in memory. Keys that
+	are pruned only return when they are added again.
+
+	:param sketch: a ``CountMinSketch`` instance.
+	:param k: the number of keys to keep.
+
+	>>> hh = HeavyHitters(CountMinSketch(1000, 4), 2)
+	>>> hh.update({'a': 5, 'b': 1, 'c': 3, 'd': 1, 'e': 1})
+	>>> sorted(hh)
+	['a', 'c']
+	>>> hh['a']
+	5
+	"""
+	def __init__(self, sketch, k):
+		if k < 1:
+			raise ValueError('k should be a positive integer.')
+		self.sketch, self.k = sketch, k
+		self.candidates = {}  # key => estimated count when last added
+		self.threshold = 0  # keys with an estimate below this are not stored
+
+	def add(self, key, count=1):
+		"""Add ``count`` occurrences of ``key``."""
+		estimate = self.sketch.add(key, count)
+		if estimate >= self.threshold:
+			self.candidates[key] = estimate
+			if len(self.candidates) > 2 * self.k:
+				self.prune()
+
+	def update(self, counts):
+		"""Add counts from a dictionary with strings as keys."""
+		for key, count in counts.items():
+			self.add(key, count)
+
+	def prune(self):
+		"""Discard all but the ``k`` candidates with the highest counts."""
+		sketch = self.sketch
+		top = heapq.nlargest(self.k, ((sketch[key], key)
+				for key in self.candidates))
+		self.candidates = {key: estimate for estimate, key in top}
+		self.threshold = top[-1][0]
+
+	def __getitem__(self, key):
+		"""Return estimated count for ``key``."""
+		return self.sketch[key]
+
+	def __contains__(self, key):
+		return key in self.candidates
+
+	def __len__(self):
+		return min(len(self.candidates), self.k)
+
+	def __iter__(self):
+		"""Iterate over the ``k`` keys with the highest counts."""
+		if len(self.candidates) > self.k:
+			self.prune()
+		return iter(self.candidates)
+
+
 def cpu_count():
 	"""Return number of CPUs or 1."""
 	try:
@@ -606,6 +976,8 @@ def test():
 
 
 __all__ = ['main', 'regular', 'batch', 'readtreebanks', 'read2ndtreebank',
-		'initworker', 'initworkersimple', 'worker', 'exactcountworker',
-		'workload', 'recurringfragments', 'allfragments', 'debinarize',
-		'printfragments', 'altrepr', 'cpu_count']
+		'initworker', 'initworkersimple', 'writectrees', 'initworkermmap',
+		'selecttrees', 'worker', 'exactcountworker', 'workload', 'numpairs',
+		'logprogress', 'readcheckpoints', 'loadcheckpoint', 'writecheckpoint',
+		'recurringfragments', 'allfragments', 'debinarize', 'printfragments',
+		'altrepr', 'CountMinSketch', 'HeavyHitters', 'cpu_count']
@@ -71,6 +71,7 @@ DEFAULTS = dict(
 	# other keys:
 		corpusfmt='export',  # choices: export, (disc)bracket, alpino, tiger
 		removeempty=False,  # whether to remove empty terminals
+		corpuscache=None,  # directory in which to cache parsed treebanks
 		ensureroot=None,  # ensure every tree has a root node with this label
 		punct=None,  # choices: None, 'move', 'remove', 'root'
 		functions=None,  # choices None, 'add', 'remove', 'replace'
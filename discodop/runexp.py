@@ -79,7 +79,8 @@ def startexp(
 		trees, sents, train_tagged_sents = loadtraincorpus(
 				prm.corpusfmt, prm.traincorpus, prm.binarization, prm.punct,
 				prm.functions, prm.morphology, prm.removeempty, prm.ensureroot,
-				prm.transformations, prm.relationalrealizational)
+				prm.transformations, prm.relationalrealizational,
+				prm.corpuscache, prm.numproc)
 	elif isinstance(prm.traincorpus.numsents, float):
 		raise ValueError('need to specify number of training set sentences, '
 				'not fraction, in rerun mode.')
@@ -88,7 +89,8 @@ def startexp(
 			prm.testcorpus.path, encoding=prm.testcorpus.encoding,
 			headrules=prm.binarization.headrules,
 			removeempty=prm.removeempty, morphology=prm.morphology,
-			functions=prm.functions, ensureroot=prm.ensureroot)
+			functions=prm.functions, ensureroot=prm.ensureroot,
+			cachedir=prm.corpuscache, numproc=prm.numproc)
 	if isinstance(prm.testcorpus.numsents, float):
 		prm.testcorpus.numsents = int(prm.testcorpus.numsents
 				* len(testsettb.blocks()))
@@ -226,12 +228,13 @@ def startexp(
 
 def loadtraincorpus(corpusfmt, traincorpus, binarization, punct, functions,
 		morphology, removeempty, ensureroot, transformations,
-		relationalrealizational):
+		relationalrealizational, cachedir=None, numproc=1):
 	"""Load the training corpus."""
 	train = treebank.READERS[corpusfmt](traincorpus.path,
 			encoding=traincorpus.encoding, headrules=binarization.headrules,
 			removeempty=removeempty, ensureroot=ensureroot, punct=punct,
-			functions=functions, morphology=morphology)
+			functions=functions, morphology=morphology, cachedir=cachedir,
+			numproc=numproc)
 	if isinstance(traincorpus.numsents, float):
 		traincorpus.numsents = int(traincorpus.numsents * len(train.sents()))
 	trainset = [item for _, item in train.itertrees(None, traincorpus.numsents)
@@ -575,7 +578,7 @@ def doparsing(**kwds):
 	# main parse loop over each sentence in test corpus
 	for nsent, data in enumerate(dowork, 1):
 		sentid, sent, sentresults = data
-		_sent, goldtree, goldsent, _ = params.testset[sentid]
+		_sent, _goldtree, goldsent, _ = params.testset[sentid]
 		goldsent = [w for w, _t in goldsent]
 		logging.debug('%d/%d (%s). [len=%d] %s\n',
 				nsent, len(params.testset), sentid, len(sent),
@@ -607,9 +610,7 @@ def doparsing(**kwds):
 			if result.noparse:
 				results[n].noparse += 1
 
-			sentmetrics = results[n].evaluator.add(
-					sentid, goldtree.copy(True), goldsent,
-					result.parsetree.copy(True), sent)
+			sentmetrics = results[n].evaluator.addresult(result.treepair)
 			msg = result.msg
 			scores = sentmetrics.scores()
 			msg += '\tPOS %(POS)s ' % scores
@@ -626,11 +627,7 @@ def doparsing(**kwds):
 							result.parsetree, err)
 			msg += '\n'
 			if n + 1 == len(sentresults):
-				try:
-					msg += sentmetrics.visualize()
-				except Exception as err:  # pylint: disable=broad-except
-					msg += 'PROBLEM drawing tree:\n%s\n%s' % (
-							sentmetrics.ctree, err)
+				msg += result.visualization
 			logging.debug(msg)
 		msg = ''
 		for n, result in enumerate(sentresults):
@@ -662,13 +659,27 @@ def worker(args):
 	"""Parse a sentence using global Parser object, and evaluate incrementally.
 
 	:returns: a string with diagnostic information, as well as a list of
-		DictObj instances with the results for each stage."""
-	nsent, (tagged_sent, goldtree, _, _) = args
+		DictObj instances with the results for each stage. The evaluation of
+		each stage is stored as a ``TreePairResult`` in the attribute
+		``treepair``, without trees, and a visualization of the last stage in
+		the attribute ``visualization``."""
+	nsent, (tagged_sent, goldtree, goldsent, _) = args
 	sent = [w for w, _ in tagged_sent]
+	goldsent = [w for w, _ in goldsent]
 	prm = INTERNALPARAMS
 	results = list(prm.parser.parse(sent,
 			tags=[t for _, t in tagged_sent] if prm.usetags else None,
 			goldtree=goldtree))  # only used to determine quality of pruning
+	for n, result in enumerate(results):
+		result.treepair = evalmod.TreePairResult(nsent, goldtree.copy(True),
+				goldsent, result.parsetree.copy(True), sent, prm.evalparam)
+		if n + 1 == len(results):
+			try:
+				result.visualization = result.treepair.visualize()
+			except Exception as err:  # pylint: disable=broad-except
+				result.visualization = 'PROBLEM drawing tree:\n%s\n%s' % (
+						result.treepair.ctree, err)
+		result.treepair.discardtrees()
 	return (nsent, sent, results)
 
 
@@ -0,0 +1,416 @@
+"""A native implementation of the core of the TGrep2 query language.
+
+Queries are evaluated over trees represented as a table of nodes in
+pre-order (cf. ``_fragments.treenodes()``), so that no external ``tgrep2``
+process or conversion of the corpus is needed.
+
+Supported syntax:
+
+- node descriptions: a label ``NP``, alternatives ``NP|PP``,
+  a regular expression ``/^NP/``, any node ``*`` or ``__``,
+  and negation of a node description ``!NP``.
+  Words are nodes as well, as the only child of their preterminal.
+- relations; all relations of a node must hold: ``NP < DT < NN``.
+  Use parentheses to add relations to the other node: ``NP < (PP < IN)``.
+- negation of a relation: ``NP !< PP``, disjunction ``NP < DT | < CD``,
+  grouping of relations with brackets: ``VP [< NP | < PP] < VB``.
+
+Supported operators::
+
+    A < B       A is the parent of (immediately dominates) B.
+    A > B       A is the child of B.
+    A <N B      B is the Nth child of A (the first child is <1).
+    A >N B      A is the Nth child of B (the first child is >1).
+    A <-N B     B is the Nth-to-last child of A (the last child is <-1).
+    A >-N B     A is the Nth-to-last child of B (the last child is >-1).
+    A <, B      Synonymous with A <1 B.
+    A >, B      Synonymous with A >1 B.
+    A <- B      B is the last child of A (synonymous with A <-1 B).
+    A >- B      A is the last child of B (synonymous with A >-1 B).
+    A <` B      B is the last child of A (also synonymous with A <-1 B).
+    A >` B      A is the last child of B (also synonymous with A >-1 B).
+    A <: B      B is the only child of A.
+    A >: B      A is the only child of B.
+    A << B      A dominates B (A is an ancestor of B).
+    A >> B      A is dominated by B (A is a descendant of B).
+    A <<, B     B is a left-most descendant of A.
+    A >>, B     A is a left-most descendant of B.
+    A <<` B     B is a right-most descendant of A.
+    A >>` B     A is a right-most descendant of B.
+    A <<: B     There is a single path of descent from A and B is on it.
+    A >>: B     There is a single path of descent from B and A is on it.
+    A . B       A immediately precedes B.
+    A , B       A immediately follows B.
+    A .. B      A precedes B.
+    A ,, B      A follows B.
+    A $ B       A is a sister of B (and A != B).
+    A $. B      A is a sister of and immediately precedes B.
+    A $, B      A is a sister of and immediately follows B.
+    A $.. B     A is a sister of and precedes B.
+    A $,, B     A is a sister of and follows B.
+
+Since labels may contain the characters ``.``, ``,``, and ``$``, operators
+starting with these characters should be separated from a preceding label
+by whitespace. Precedence is defined in terms of the first and last word
+dominated by a node, which also applies to discontinuous constituents."""
+
+from __future__ import division, print_function, absolute_import, \
+		unicode_literals
+import re
+from .tree import Tree
+
+LABEL = re.compile(r'!?[^\s()\[\]!<>|&=/]+(?:\|[^\s()\[\]!<>|&=/]+)*')
+REGEX = re.compile(r'!?/((?:[^/\\]|\\.)*)/')
+OPERATOR = re.compile(r'<<,|<<`|<<:|<<|>>,|>>`|>>:|>>'
+		r'|[<>]-?[0-9]+|[<>][,`:-]?'
+		r'|\$\.\.|\$,,|\$\.|\$,|\$|\.\.|,,|\.|,')
+
+
+class TgrepTree(object):
+	"""A tree represented as a table of nodes in pre-order.
+
+	:param labels: the label of each node; words are nodes as well.
+	:param parents: the index of the parent of each node; -1 for the root.
+	:param leaves: for words, the index in the sentence; -1 otherwise."""
+
+	def __init__(self, labels, parents, leaves):
+		self.labels = labels
+		self.parents = parents
+		self.leaves = leaves
+		numnodes = len(labels)
+		# the subtree of node i consists of nodes i, i + 1, ..., end[i] - 1
+		self.end = list(range(1, numnodes + 1))
+		self.minleaf = [numnodes] * numnodes
+		self.maxleaf = [-1] * numnodes
+		self.children = [[] for _ in range(numnodes)]
+		for i in range(numnodes - 1, -1, -1):
+			if leaves[i] >= 0:
+				self.minleaf[i] = self.maxleaf[i] = leaves[i]
+			parent = parents[i]
+			if parent >= 0:
+				self.children[parent].append(i)
+				self.end[parent] = max(self.end[parent], self.end[i])
+				self.minleaf[parent] = min(
+						self.minleaf[parent], self.minleaf[i])
+				self.maxleaf[parent] = max(
+						self.maxleaf[parent], self.maxleaf[i])
+		for children in self.children:
+			children.reverse()
+
+	def totree(self):
+		"""Convert to Tree object.
+
+		:returns: a tuple ``(tree, sent, nodes)`` where ``tree`` is a Tree
+			object with integer indices as leaves, ``sent`` the list of
+			words, and ``nodes`` maps node indices to Tree objects and
+			leaf indices."""
+		nodes = [None] * len(self.labels)
+		sent = [None] * (max(self.leaves) + 1)
+		for i in range(len(self.labels) - 1, -1, -1):
+			if self.leaves[i] >= 0:
+				sent[self.leaves[i]] = self.labels[i]
+				nodes[i] = self.leaves[i]
+			else:
+				nodes[i] = Tree(self.labels[i],
+						[nodes[j] for j in self.children[i]])
+		return nodes[0], sent, nodes
+
+	def tostring(self, i=0):
+		"""Return the subtree of node i as a string in bracket notation."""
+		if self.leaves[i] >= 0:
+			return self.labels[i]
+		return '(%s %s)' % (self.labels[i], ' '.join(
+				self.tostring(j) for j in self.children[i]))
+
+	def yieldof(self, i):
+		"""Return the sorted indices of the words dominated by node i."""
+		return sorted(self.leaves[j] for j in range(i, self.end[i])
+				if self.leaves[j] >= 0)
+
+	def ancestors(self, i):
+		"""Yield the ancestors of node i, starting with its parent."""
+		i = self.parents[i]
+		while i >= 0:
+			yield i
+			i = self.parents[i]
+
+
+class TgrepQuery(object):
+	"""A parsed tgrep2 query.
+
+	>>> tree = TgrepTree(['S', 'NP', 'DT', 'the', 'NN', 'cat', 'VP', 'VB',
+	...		'sat'], [-1, 0, 1, 2, 1, 4, 0, 6, 7], [-1, -1, -1, 0, -1, 1, -1,
+	...		-1, 2])
+	>>> TgrepQuery('NP < DT $. VP').findall(tree)
+	[1]
+	>>> TgrepQuery('* , (NN < cat)').findall(tree)
+	[6, 7, 8]
+	>>> TgrepQuery('/^[NV]/ !<< the').findall(tree)
+	[4, 6, 7]
+
+	:param query: a query string; cf. the module documentation.
+	:raises ValueError: if the query cannot be parsed.
+
+	After parsing, ``required`` is a list of functions that take a label and
+	return a bool; a tree can only match the query if for each function
+	there is a node with a label or word for which it returns True."""
+
+	def __init__(self, query):
+		self.query = query
+		self.pos = 0
+		self.match, self.required = self._pattern()
+		self._skipws()
+		if self.pos < len(query):
+			raise ValueError('unexpected %r at position %d in query: %r' % (
+					query[self.pos], self.pos, query))
+
+	def findall(self, tree):
+		"""Return the indices of nodes in tree matching the query."""
+		match = self.match
+		return [i for i in range(len(tree.labels)) if match(tree, i)]
+
+	def _skipws(self):
+		while self.pos < len(self.query) and self.query[self.pos].isspace():
+			self.pos += 1
+
+	def _peek(self):
+		self._skipws()
+		return self.query[self.pos:self.pos + 1]
+
+	def _expect(self, char):
+		if self._peek() != char:
+			raise ValueError('expected %r at position %d in query: %r' % (
+					char, self.pos, self.query))
+		self.pos += 1
+
+	def _pattern(self):
+		"""Parse a node description with its relations."""
+		if self._peek() == '(':
+			self.pos += 1
+			result = self._pattern()
+			self._expect(')')
+			return result
+		label, required = self._description()
+		alternatives = self._relations()
+		if len(alternatives) == 1:
+			required.extend(alternatives[0][1])
+
+		def match(tree, i):
+			"""Test whether node i matches the pattern."""
+			return label(tree.labels[i]) and any(
+					all(rel(tree, i) for rel in relations)
+					for relations, _ in alternatives)
+		return match, required
+
+	def _description(self):
+		"""Parse a node description; return a function to test labels."""
+		self._skipws()
+		match = REGEX.match(self.query, self.pos)
+		if match is not None:
+			label = re.compile(match.group(1)).search
+		else:
+			match = LABEL.match(self.query, self.pos)
+			if match is None:
+				raise ValueError('expected node at position %d in query: %r'
+						% (self.pos, self.query))
+			labels = frozenset(match.group().lstrip('!').split('|'))
+			if labels & {'*', '__'}:
+				self.pos = match.end()
+				return (lambda _: True), []
+			label = labels.__contains__
+		self.pos = match.end()
+		if match.group().startswith('!'):
+			return (lambda x: not label(x)), []
+		return label, [label]
+
+	def _relations(self):
+		"""Parse a disjunction of conjunctions of relations.
+
+		:returns: a list of tuples ``(relations, required)``."""
+		alternatives = [self._conjunction()]
+		while self._peek() == '|':
+			self.pos += 1
+			alternatives.append(self._conjunction())
+			if not alternatives[-1][0]:
+				raise ValueError('expected relation at position %d in '
+						'query: %r' % (self.pos, self.query))
+		return alternatives
+
+	def _conjunction(self):
+		"""Parse relations that must all hold."""
+		relations, required = [], []
+		while self._peek() not in ('', ')', ']', '|'):
+			if self._peek() == '&':
+				self.pos += 1
+				continue
+			rel, req = self._relation()
+			relations.append(rel)
+			required.extend(req)
+		return relations, required
+
+	def _relation(self):
+		"""Parse a single, possibly negated, relation or group of relations.
+
+		:returns: a tuple ``(rel, required)``, where ``rel(tree, i)`` tests
+			whether the relation holds for node i."""
+		negated = self._peek() == '!'
+		if negated:
+			self.pos += 1
+		if self._peek() == '[':
+			self.pos += 1
+			alternatives = self._relations()
+			self._expect(']')
+			required = alternatives[0][1] if len(alternatives) == 1 else []
+
+			def rel(tree, i):
+				"""Test a group of relations."""
+				return any(all(rel1(tree, i) for rel1 in relations)
+						for relations, _ in alternatives) != negated
+			return rel, [] if negated else required
+		self._skipws()
+		match = OPERATOR.match(self.query, self.pos)
+		if match is None:
+			raise ValueError('expected operator at position %d in query: %r'
+					% (self.pos, self.query))
+		self.pos = match.end()
+		op, num = operator(match.group())
+		related = RELATIONS[op]
+		target, required = self._target()
+
+		def rel(tree, i):
+			"""Test whether a node related to i matches the target."""
+			return any(target(tree, j)
+					for j in related(tree, i, num)) != negated
+		return rel, [] if negated else required
+
+	def _target(self):
+		"""Parse the node description on the right hand side of a relation."""
+		if self._peek() == '(':
+			return self._pattern()
+		label, required = self._description()
+		return (lambda tree, j: label(tree.labels[j])), required
+
+
+def operator(token):
+	"""Normalize an operator; return operator and optional argument.
+
+	>>> operator('<-'), operator('>2'), operator('$..')
+	(('<N', -1), ('>N', 2), ('$..', None))"""
+	if token in ('<,', '>,'):
+		return token[0] + 'N', 1
+	elif token in ('<-', '<`', '>-', '>`'):
+		return token[0] + 'N', -1
+	elif token[0] in '<>' and token[1:].lstrip('-').isdigit():
+		return token[0] + 'N', int(token[1:])
+	return token, None
+
+
+def _nthchild(tree, i, num):
+	children = tree.children[i]
+	if 0 < num <= len(children):
+		yield children[num - 1]
+	elif 0 < -num <= len(children):
+		yield children[num]
+
+
+def _nthchildof(tree, i, num):
+	parent = tree.parents[i]
+	if parent >= 0 and i in _nthchild(tree, parent, num):
+		yield parent
+
+
+def _parent(tree, i, _):
+	if tree.parents[i] >= 0:
+		yield tree.parents[i]
+
+
+def _onlychild(tree, i, _):
+	if len(tree.children[i]) == 1:
+		yield tree.children[i][0]
+
+
+def _onlychildof(tree, i, _):
+	parent = tree.parents[i]
+	if parent >= 0 and len(tree.children[parent]) == 1:
+		yield parent
+
+
+def _path(tree, i, which):
+	"""Yield descendants along first (0), last (-1), or single child (None).
+	"""
+	while tree.children[i] and (
+			which is not None or len(tree.children[i]) == 1):
+		i = tree.children[i][which or 0]
+		yield i
+
+
+def _pathof(tree, i, which):
+	"""Yield ancestors of which i is on the path defined as in _path()."""
+	parent = tree.parents[i]
+	while parent >= 0 and (tree.children[parent][which or 0] == i
+			if which is not None else len(tree.children[parent]) == 1):
+		yield parent
+		i, parent = parent, tree.parents[parent]
+
+
+def _sisters(tree, i, _):
+	parent = tree.parents[i]
+	if parent >= 0:
+		for j in tree.children[parent]:
+			if j != i:
+				yield j
+
+
+def _sisterspos(tree, i, offset):
+	"""Yield sisters of node ``i``.
+
+	:param offset: -1/1: immediately left/right of ``i``;
+		-2/2: any sister to the left/right of ``i``."""
+	parent = tree.parents[i]
+	if parent < 0:
+		return
+	children = tree.children[parent]
+	idx = children.index(i)
+	if offset == 1 and idx + 1 < len(children):
+		yield children[idx + 1]
+	elif offset == -1 and idx > 0:
+		yield children[idx - 1]
+	elif offset == 2:
+		for j in children[idx + 1:]:
+			yield j
+	elif offset == -2:
+		for j in children[:idx]:
+			yield j
+
+
+RELATIONS = {
+		'<': lambda tree, i, _: tree.children[i],
+		'>': _parent,
+		'<N': _nthchild,
+		'>N': _nthchildof,
+		'<:': _onlychild,
+		'>:': _onlychildof,
+		'<<': lambda tree, i, _: range(i + 1, tree.end[i]),
+		'>>': lambda tree, i, _: tree.ancestors(i),
+		'<<,': lambda tree, i, _: _path(tree, i, 0),
+		'<<`': lambda tree, i, _: _path(tree, i, -1),
+		'<<:': lambda tree, i, _: _path(tree, i, None),
+		'>>,': lambda tree, i, _: _pathof(tree, i, 0),
+		'>>`': lambda tree, i, _: _pathof(tree, i, -1),
+		'>>:': lambda tree, i, _: _pathof(tree, i, None),
+		'.': lambda tree, i, _: (j for j in range(len(tree.labels))
+				if tree.minleaf[j] == tree.maxleaf[i] + 1),
+		',': lambda tree, i, _: (j for j in range(len(tree.labels))
+				if tree.maxleaf[j] + 1 == tree.minleaf[i]),
+		'..': lambda tree, i, _: (j for j in range(len(tree.labels))
+				if tree.minleaf[j] > tree.maxleaf[i]),
+		',,': lambda tree, i, _: (j for j in range(len(tree.labels))
+				if tree.maxleaf[j] < tree.minleaf[i]),
+		'$': _sisters,
+		'$.': lambda tree, i, _: _sisterspos(tree, i, 1),
+		'$,': lambda tree, i, _: _sisterspos(tree, i, -1),
+		'$..': lambda tree, i, _: _sisterspos(tree, i, 2),
+		'$,,': lambda tree, i, _: _sisterspos(tree, i, -2),
+		}
+
+__all__ = ['TgrepTree', 'TgrepQuery', 'operator']
@@ -4,6 +4,11 @@ from __future__ import division, print_function, absolute_import, \
 import os
 import re
 import sys
+import copy
+import random
+import gc
+import hashlib
+import multiprocessing
 from glob import glob
 from itertools import count, chain, islice
 from collections import defaultdict
@@ -14,7 +19,10 @@ from .tree import Tree, ParentedTree, brackettree, escape, unescape, \
 from .treetransforms import removeemptynodes
 from .punctuation import applypunct
 from .heads import applyheadrules, readheadrules
-from .util import openread, ishead
+from .util import openread, ishead, batches
+from .treebankutil import encodetree, decodetree, readoffsets, scanlines, \
+		scanexport, scantigerxml, writetreecache, readtreecache, \
+		_decodeitem
 
 FIELDS = tuple(range(6))
 WORD, LEMMA, TAG, MORPH, FUNC, PARENT = FIELDS
@@ -23,6 +31,15 @@ EXPORTNONTERMINAL = re.compile(r'^#([5-9][0-9][0-9])$')
 POSRE = re.compile(r'\(([^() ]+)\s+[^ ()]+\s*\)')
 TERMINALSRE = re.compile(r' ([^ ()]+)\s*\)')
 LEAVESRE = re.compile(r' ([^ ()]*)\s*\)')
+# increment when the format of cached treebanks changes
+CACHEVERSION = 2
+# punctuation strategies for which the tree cache is used
+CACHEDPUNCT = ('move', 'moveall', 'prune')
+# number of blocks sent to a worker process at a time
+READERBATCHSIZE = 256
+# the corpus reader used by worker processes
+READER = None
+XMLDECLRE = re.compile(br'<\?xml[^>]*\?>')
 
 
 class Item(object):
@@ -41,7 +58,8 @@ class CorpusReader(object):
 
 	def __init__(self, path, encoding='utf8', ensureroot=None, punct=None,
 			headrules=None, removeempty=False,
-			functions=None, morphology=None, lemmas=None):
+			functions=None, morphology=None, lemmas=None, cachedir=None,
+			numproc=1):
 		"""
 		:param path: filename or pattern of corpus files; e.g., ``wsj*.mrg``.
 		:param ensureroot: add root node with given label if necessary.
@@ -83,7 +101,15 @@ class CorpusReader(object):
 			:None: ignore lemmas [default].
 			:'add': concatenate lemma to terminals, e.g., men/man.
 			:'replace': use lemmas as terminals.
-			:'between': insert lemma as node between POS tag and word."""
+			:'between': insert lemma as node between POS tag and word.
+		:param cachedir: if given, a directory in which parsed and transformed
+			trees are cached; the cache is used when the corpus files and
+			the options above are unchanged, and only with expensive
+			transformations (``punct`` in ``CACHEDPUNCT``, ``headrules``).
+		:param numproc: number of processes to use for parsing and
+			transforming trees; blocks are distributed over the processes in
+			batches, while results are returned in the original order.
+			``None``: use all CPUs."""
 		self.removeempty = removeempty
 		self.ensureroot = ensureroot
 		self.functions = functions
@@ -112,8 +138,11 @@ class CorpusReader(object):
 		if not self._filenames:
 			raise ValueError("no files matched pattern '%s' in %s" % (
 					path, os.getcwd()))
+		self.cachedir = cachedir if self._filenames != ['-'] else None
+		self.numproc = numproc or multiprocessing.cpu_count()
 		self._block_cache = None
 		self._trees_cache = None
+		self._offsets = {}
 
 	def itertrees(self, start=None, end=None):
 		"""
@@ -121,35 +150,35 @@ class CorpusReader(object):
 			of sentences in corpus, where ``item`` is an :py:class:Item
 			instance with ``tree``, ``sent``, and ``comment`` attributes.
 			Useful when the dictionary of all trees in corpus would not fit in
-			memory."""
-		for n, a in islice(self._read_blocks(), start, end):
-			yield n, self._parsetree(a)
+			memory. If ``start`` is given and the corpus files support it,
+			the first block is located with an offset index, instead of
+			reading all preceding blocks."""
+		if start and self._indexable():
+			blocks = self._indexedblocks(
+					count(start) if end is None else range(start, end))
+		else:
+			blocks = islice(self._read_blocks(), start, end)
+		if self._usecache():
+			return self._readcache(blocks, start or 0)
+		return self._parseblocks(blocks)
 
 	def trees(self):
 		"""
 		:returns: an ordered dictionary of parse trees
 			(``Tree`` objects with integer indices as leaves)."""
-		if not self._trees_cache:
-			self._trees_cache = OrderedDict((n, self._parsetree(a))
-					for n, a in self._read_blocks())
-		return OrderedDict((n, a.tree) for n, a in self._trees_cache.items())
+		return OrderedDict((n, a.tree) for n, a in self._items().items())
 
 	def sents(self):
 		"""
 		:returns: an ordered dictionary of sentences,
 			each sentence being a list of words."""
-		if not self._trees_cache:
-			self._trees_cache = OrderedDict((n, self._parsetree(a))
-					for n, a in self._read_blocks())
-		return OrderedDict((n, a.sent) for n, a in self._trees_cache.items())
+		return OrderedDict((n, a.sent) for n, a in self._items().items())
 
 	def tagged_sents(self):
 		"""
 		:returns: an ordered dictionary of tagged sentences,
 			each tagged sentence being a list of (word, tag) pairs."""
-		if not self._trees_cache:
-			self._trees_cache = OrderedDict((n, self._parsetree(a))
-					for n, a in self._read_blocks())
+		self._items()
 		return OrderedDict(
 				(n, [(w, t) for w, (_, t) in zip(a.sent, sorted(a.tree.pos()))])
 				for n, a in self._trees_cache.items())
@@ -159,12 +188,233 @@ class CorpusReader(object):
 		:returns: a list of strings containing the raw representation of
 			trees in the original treebank."""
 
+	def item(self, key):
+		"""
+		:returns: the :py:class:`Item` for the sentence with the given key.
+
+		Uses an offset index to read only the requested sentence, unless the
+		corpus is read from standard input or a compressed file."""
+		if self._trees_cache:
+			return self._trees_cache[key]
+		return self._parsetree(self._getblock(key))
+
+	def keys(self, writeindex=True):
+		"""
+		:param writeindex: if False, offset indices that do not exist yet
+			are created in memory only, instead of being stored next to the
+			corpus files.
+		:returns: a list with the keys of all sentences in corpus order.
+
+		Uses offset indices when available; otherwise, blocks are read but
+		not parsed. Should not be used when the corpus is read from standard
+		input, since it is consumed."""
+		if self._trees_cache:
+			return list(self._trees_cache)
+		if self._indexable():
+			return [key for filename in self._filenames
+					for key in self._offsetindex(filename, writeindex)[0]]
+		return [n for n, _ in self._read_blocks()]
+
+	def position(self, key):
+		"""Return the 0-based position of a sentence in corpus order.
+
+		Uses offset indices; cf. ``itertrees(start=...)``.
+
+		:returns: the position, or None if the corpus cannot be indexed,
+			e.g., because it is read from standard input or a compressed
+			file.
+		:raises KeyError: if there is no sentence with the given key."""
+		if not self._indexable():
+			return None
+		offset = 0
+		for filename in self._filenames:
+			keys, _, _, positions = self._offsetindex(filename)
+			if key in positions:
+				return offset + positions[key]
+			offset += len(keys)
+		raise KeyError(key)
+
+	def sample(self, k, seed=None):
+		"""Select a random sample of sentences.
+
+		:param k: the number of sentences; if the corpus contains fewer
+			sentences, all sentences are returned.
+		:param seed: seed for the random number generator.
+		:returns: a list of tuples ``(key, item)`` in corpus order."""
+		rnd = random.Random(seed)
+		if self._indexable():
+			numblocks = self._numblocks()
+			blocks = self._indexedblocks(sorted(
+					rnd.sample(range(numblocks), min(k, numblocks))))
+		else:
+			blocks = list(self._read_blocks())
+			blocks = [blocks[n] for n in sorted(
+					rnd.sample(range(len(blocks)), min(k, len(blocks))))]
+		return list(self._parseblocks(blocks))
+
+	def _getblock(self, key):
+		""":returns: the block with the given key."""
+		if self._indexable():
+			for filename in self._filenames:
+				_, starts, ends, positions = self._offsetindex(filename)
+				if key in positions:
+					n = positions[key]
+					with open(filename, 'rb') as inp:
+						inp.seek(starts[n])
+						return self._blockfrombytes(
+								inp.read(ends[n] - starts[n]), filename)
+		else:
+			for n, block in self._read_blocks():
+				if n == key:
+					return block
+		raise KeyError(key)
+
+	def _indexable(self):
+		"""Return True if blocks can be located with offset indices."""
+		return (type(self)._scanoffsets is not CorpusReader._scanoffsets
+				and all(filename != '-' and not filename.endswith('.gz')
+					for filename in self._filenames))
+
+	def _numblocks(self):
+		"""Return the number of blocks in the corpus, using offset indices."""
+		return sum(len(self._offsetindex(filename)[0])
+				for filename in self._filenames)
+
+	def _indexedblocks(self, positions):
+		"""Read blocks at the given positions using offset indices.
+
+		:param positions: an increasing sequence of 0-based positions of
+			blocks in the corpus; positions past the end are ignored.
+		:yields: ``(key, block)`` tuples."""
+		positions = iter(positions)
+		pos = next(positions, None)
+		offset = 0
+		for filename in self._filenames:
+			if pos is None:
+				break
+			keys, starts, ends, _ = self._offsetindex(filename)
+			if pos < offset + len(keys):
+				with open(filename, 'rb') as inp:
+					while pos is not None and pos < offset + len(keys):
+						n = pos - offset
+						inp.seek(starts[n])
+						yield keys[n], self._blockfrombytes(
+								inp.read(ends[n] - starts[n]), filename)
+						pos = next(positions, None)
+			offset += len(keys)
+
+	def _offsetindex(self, filename, write=True):
+		"""Return the index of a corpus file; cf. ``readoffsets()``."""
+		if filename not in self._offsets:
+			self._offsets[filename] = readoffsets(
+					filename, self._scanoffsets, write)
+		return self._offsets[filename]
+
+	def _scanoffsets(self, filename):
+		"""Yield tuples ``(key, start, end)`` for blocks in a corpus file."""
+		raise NotImplementedError
+
+	def _blockfrombytes(self, data, filename):
+		"""Convert the bytes of a block to the form of ``_read_blocks()``."""
+		return data.decode(self._encoding)
+
+	def _items(self):
+		"""Parse all trees once and keep them in memory."""
+		if not self._trees_cache:
+			if self._usecache():
+				self._trees_cache = OrderedDict(
+						self._readcache(self._read_blocks(), 0))
+			else:
+				self._trees_cache = OrderedDict(
+						self._parseblocks(self._read_blocks()))
+		return self._trees_cache
+
+	def _parseblocks(self, blocks):
+		"""Parse and transform an iterable of ``(key, block)`` tuples.
+
+		:returns: an iterator of ``(key, item)`` tuples in the same order."""
+		if self.numproc == 1:
+			for n, block in blocks:
+				yield n, self._parsetree(block)
+			return
+		reader = copy.copy(self)
+		reader._block_cache = reader._trees_cache = None
+		pool = multiprocessing.Pool(processes=self.numproc,
+				initializer=_initreader, initargs=(reader, ))
+		try:
+			for result in pool.imap(_parsebatch,
+					batches(blocks, READERBATCHSIZE)):
+				for n, tree, sent, comment, block in result:
+					yield n, Item(decodetree(tree), sent, comment, block)
+		finally:
+			pool.terminate()
+
+	def _cachefilename(self):
+		"""Return a filename identifying the corpus files and options."""
+		key = (CACHEVERSION, type(self).__name__, self._encoding,
+				self.removeempty, self.ensureroot, self.punct,
+				self.functions, self.morphology, self.lemmas,
+				sorted(self.headrules.items()),
+				[(os.path.abspath(filename), os.stat(filename).st_mtime,
+					os.stat(filename).st_size)
+					for filename in self._filenames])
+		return os.path.join(self.cachedir, '%s.treecache' % hashlib.sha1(
+				repr(key).encode('utf8')).hexdigest())
+
+	def _usecache(self):
+		"""Return True if parsed trees should be read from the cache.
+
+		Decoding cached trees is only faster than parsing the corpus when
+		expensive transformations (punctuation, head rules) are applied."""
+		return self.cachedir is not None and bool(
+				self.headrules or self.punct in CACHEDPUNCT)
+
+	def _readcache(self, blocks, start):
+		"""Decode cached items for blocks; create the cache if needed.
+
+		:param blocks: an iterable of blocks, starting at the block with
+			index ``start``; the blocks themselves are not cached.
+		:yields: ``(key, item)`` tuples."""
+		filename = self._cachefilename()
+		if not os.path.exists(filename):
+			self._writecache(filename)
+		strings, comments, offsets, data = readtreecache(filename)
+		blocks = iter(blocks)
+		for m in range(start, len(offsets), READERBATCHSIZE):
+			batch = list(islice(blocks, READERBATCHSIZE))
+			if not batch:
+				break
+			# the garbage collector would otherwise repeatedly traverse the
+			# new trees; this dominates the time spent decoding.
+			gcenabled = gc.isenabled()
+			gc.disable()
+			try:
+				result = [(n, Item(*_decodeitem(strings, offsets, data, m + i),
+						comment=comments[m + i], block=self._itemblock(block)))
+						for i, (n, block) in enumerate(batch)]
+			finally:
+				if gcenabled:
+					gc.enable()
+			for n, item in result:
+				yield n, item
+
+	def _writecache(self, filename):
+		"""Parse all trees and write them to the cache."""
+		if not os.path.isdir(self.cachedir):
+			os.makedirs(self.cachedir)
+		writetreecache(filename, (item for _, item
+				in self._parseblocks(self._read_blocks())))
+
 	def _read_blocks(self):
 		"""Iterate over blocks in corpus file corresponding to parse trees."""
 
 	def _parse(self, block):
 		""":returns: a parse tree given a string from the treebank file."""
 
+	def _itemblock(self, block):
+		""":returns: the block in the form stored in :py:class:`Item`."""
+		return block
+
 	def _parsetree(self, block):
 		""":returns: a transformed parse tree and sentence."""
 		item = self._parse(block)
@@ -206,6 +456,12 @@ class BracketCorpusReader(CorpusReader):
 			with openread(filename, encoding=self._encoding) as inp:
 				yield from enumerate((line for line in inp if line), 1)
 
+	def _scanoffsets(self, filename):
+		return scanlines(filename)
+
+	def _blockfrombytes(self, data, filename):
+		return data.decode(self._encoding).replace('\r\n', '\n')
+
 	def _parse(self, block):
 		c = count()
 		block = SUPERFLUOUSSPACERE.sub(')', block)
@@ -306,9 +562,19 @@ class NegraCorpusReader(CorpusReader):
 						lines.append(line.strip())
 					# other lines are ignored: #FORMAT x, %% comments, ...
 
+	def _scanoffsets(self, filename):
+		return scanexport(filename, self._encoding)
+
+	def _blockfrombytes(self, data, filename):
+		return [line.strip() for line
+				in data.decode(self._encoding).splitlines()]
+
 	def _parse(self, block):
 		return exporttree(block, self.functions, self.morphology, self.lemmas)
 
+	def _itemblock(self, block):
+		return '\n'.join(block) + '\n'
+
 
 class TigerXMLCorpusReader(CorpusReader):
 	"""Corpus reader for the Tiger XML format."""
@@ -318,23 +584,41 @@ class TigerXMLCorpusReader(CorpusReader):
 		:returns: a list of strings containing the raw representation of
 			trees in the treebank."""
 		if self._block_cache is None:
-			self._block_cache = OrderedDict(self._read_blocks())
-		return OrderedDict((n, ElementTree.tostring(a))
-				for n, a in self._block_cache.items())
+			self._block_cache = OrderedDict((n, ElementTree.tostring(a))
+					for n, a in self._read_blocks())
+		return self._block_cache
 
 	def _read_blocks(self):
 		for filename in self._filenames:
-			# iterator over elements in XML  file
-			context = ElementTree.iterparse(filename,
-					events=('start', 'end'))
-			_, root = next(context)  # event == 'start' of root element
-			for event, elem in context:
-				if event == 'end' and elem.tag == 's':
-					yield elem.get('id'), elem
-				root.clear()
+			with open(filename, 'rb') as inp:
+				# iterator over elements in XML file; keep a stack of open
+				# elements, so that each sentence can be detached from its
+				# parent after it has been consumed.
+				parents = []
+				for event, elem in ElementTree.iterparse(
+						inp, events=('start', 'end')):
+					if event == 'start':
+						parents.append(elem)
+						continue
+					parents.pop()
+					if elem.tag == 's':
+						yield elem.get('id'), elem
+						if parents:
+							parents[-1].remove(elem)
+
+	def _blockfrombytes(self, data, filename):
+		with open(filename, 'rb') as inp:
+			match = XMLDECLRE.match(inp.read(256))
+		# include XML declaration in case of a non-UTF-8 encoding
+		return ElementTree.fromstring(match.group() + data if match else data)
+
+	def _scanoffsets(self, filename):
+		return scantigerxml(filename)
 
 	def _parse(self, block):
 		"""Translate Tiger XML structure to the fields of export format."""
+		if not ElementTree.iselement(block):
+			block = ElementTree.fromstring(block)
 		nodes = OrderedDict()
 		root = block.find('graph').get('root')
 		for term in block.find('graph').find('terminals'):
@@ -378,9 +662,15 @@ class TigerXMLCorpusReader(CorpusReader):
 				+ ['#EOS ' + block.get('id')],
 				self.functions, self.morphology, self.lemmas)
 		item.tree.label = root.split('_', 1)[1]
-		item.block = ElementTree.tostring(block)
+		# NB: whitespace after </s> depends on how far the file has been read
+		item.block = ElementTree.tostring(block).rstrip()
 		return item
 
+	def _itemblock(self, block):
+		if not ElementTree.iselement(block):
+			block = ElementTree.fromstring(block)
+		return ElementTree.tostring(block).rstrip()
+
 
 class AlpinoCorpusReader(CorpusReader):
 	"""Corpus reader for the Dutch Alpino treebank in XML format.
@@ -402,12 +692,41 @@ class AlpinoCorpusReader(CorpusReader):
 			raise ValueError('Encoding specified in XML files, '
 					'cannot be overriden.')
 		for filename in self._filenames:
-			block = open(filename, 'rb').read()  # NB: store XML data as bytes
-			# ../path/dir/file.xml => dir/file
-			path, filename = os.path.split(filename)
-			_, lastdir = os.path.split(path)
-			n = os.path.join(lastdir, filename)[:-len('.xml')]
-			yield n, block
+			with open(filename, 'rb') as inp:
+				block = inp.read()  # NB: store XML data as bytes
+			yield _alpinokey(filename), block
+
+	def keys(self, writeindex=True):
+		if self._trees_cache:
+			return list(self._trees_cache)
+		return [_alpinokey(filename) for filename in self._filenames]
+
+	def position(self, key):
+		for n, filename in enumerate(self._filenames):
+			if _alpinokey(filename) == key:
+				return n
+		raise KeyError(key)
+
+	def _getblock(self, key):
+		for filename in self._filenames:
+			if _alpinokey(filename) == key:
+				with open(filename, 'rb') as inp:
+					return inp.read()
+		raise KeyError(key)
+
+	def _indexable(self):
+		return True  # each file contains a single sentence
+
+	def _numblocks(self):
+		return len(self._filenames)
+
+	def _indexedblocks(self, positions):
+		for pos in positions:
+			if pos >= len(self._filenames):
+				break
+			filename = self._filenames[pos]
+			with open(filename, 'rb') as inp:
+				yield _alpinokey(filename), inp.read()
 
 	def _parse(self, block):
 		""":returns: a parse tree given a string."""
@@ -424,6 +743,37 @@ class AlpinoCorpusReader(CorpusReader):
 		return alpinotree(
 				xmlblock, self.functions, self.morphology, self.lemmas)
 
+	def _itemblock(self, block):
+		if not ElementTree.iselement(block):
+			block = ElementTree.fromstring(block)
+		return ElementTree.tostring(block)
+
+
+def _alpinokey(filename):
+	"""Return key for an Alpino XML file: ../path/dir/file.xml => dir/file"""
+	path, filename = os.path.split(filename)
+	_, lastdir = os.path.split(path)
+	return os.path.join(lastdir, filename)[:-len('.xml')]
+
+
+def _initreader(reader):
+	"""Initialize a worker process for parsing blocks."""
+	global READER
+	READER = reader
+
+
+def _parsebatch(blocks):
+	"""Parse and transform a list of blocks in a worker process.
+
+	:returns: a list of tuples with encoded trees, to be decoded by
+		``decodetree()``; this is more compact than pickled Tree objects."""
+	result = []
+	for n, block in blocks:
+		item = READER._parsetree(block)
+		result.append((n, encodetree(item.tree), item.sent, item.comment,
+				item.block))
+	return result
+
 
 def exporttree(block, functions=None, morphology=None, lemmas=None):
 	"""Get tree, sentence from tree in export format given as list of lines.
@@ -841,7 +1191,7 @@ def incrementaltreereader(treeinput, morphology=None, functions=None,
 	:yields: tuples ``(tree, sent, comment)`` with a Tree object, a separate
 		lists of terminals, and a string with any other data following the
 		tree."""
-	treeinput = chain(iter(treeinput), ('(', None, None))  # hack
+	treeinput = chain(iter(treeinput), ('(', ))  # hack
 	line = next(treeinput)
 	# try the following readers on each line in this order
 	readers = [segmentexport(morphology, functions, strict),
@@ -849,16 +1199,16 @@ def incrementaltreereader(treeinput, morphology=None, functions=None,
 			segmentbrackets(strict, robust)]
 	for reader in readers:
 		reader.send(None)
-	while True:
+	while line is not None:
 		# status 0: line not consumed, not part of tree;
 		# status 1: line consumed, waiting for end of tree.
 		res, status = None, CONSUMED
 		for reader in readers:
-			while res is None:
+			while res is None and line is not None:
 				res, status = reader.send(line)
 				if status != CONSUMED:
 					break  # there was no tree, or a complete tree was read
-				line = next(treeinput)
+				line = next(treeinput, None)
 			if res is not None:
 				for tree, sent, rest in res:
 					x = -1 if rest is None else rest.find('\n')
@@ -868,10 +1218,11 @@ def incrementaltreereader(treeinput, morphology=None, functions=None,
 					else:
 						yield tree, sent, rest
 				break
-		if res is None:  # none of the readers accepted this line
+		if res is None and line is not None:
+			# none of the readers accepted this line
 			if othertext:
 				yield None, None, line.rstrip()
-			line = next(treeinput)
+			line = next(treeinput, None)
 
 
 def segmentbrackets(strict=False, robust=True):
@@ -1047,4 +1398,6 @@ __all__ = ['Item', 'CorpusReader', 'BracketCorpusReader',
 		'exportsplit', 'alpinotree', 'writetree', 'writeexporttree',
 		'writealpinotree', 'writedependencies', 'dependencies', 'deplen',
 		'handlefunctions', 'handlemorphology', 'incrementaltreereader',
-		'segmentbrackets', 'segmentexport', 'segmentalpino', 'numbase']
+		'segmentbrackets', 'segmentexport', 'segmentalpino', 'numbase',
+		'encodetree', 'decodetree', 'readoffsets', 'scanlines', 'scanexport',
+		'scantigerxml', 'writetreecache', 'readtreecache']
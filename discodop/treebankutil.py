@@ -0,0 +1,236 @@
+"""Offset indices and encoding of trees for corpus readers.
+
+Used by :mod:`discodop.treebank`, which exports the public objects."""
+from __future__ import division, print_function, absolute_import, \
+		unicode_literals
+import os
+import re
+import mmap
+import zlib
+import pickle
+from array import array
+from .tree import Tree, ParentedTree
+
+# increment when the format of offset index files changes
+OFFSETSVERSION = 1
+TIGERSENTRE = re.compile(br'<s\s[^>]*?\bid=["\']([^"\']*)["\']')
+
+
+def readoffsets(filename, scanoffsets, write=True):
+	"""Return an index of the blocks in a corpus file.
+
+	The index is stored in a file ``<filename>.offsets``, and recreated
+	when the corpus file is modified; if the index cannot be stored, or
+	``write`` is False, it is only kept in memory.
+
+	:param scanoffsets: a function that takes a filename and yields tuples
+		``(key, start, end)`` for the blocks in the file.
+	:returns: a tuple ``(keys, starts, ends, positions)`` with the key,
+		start and end byte offset of each block, and a dictionary
+		mapping keys to positions in these sequences."""
+	stat = os.stat(filename)
+	stamp = (OFFSETSVERSION, stat.st_mtime, stat.st_size)
+	indexfile = filename + '.offsets'
+	index = None
+	if os.path.exists(indexfile):
+		with open(indexfile, 'rb') as inp:
+			index = pickle.load(inp)
+		if index[0] != stamp:
+			index = None
+	if index is None:
+		keys, starts, ends = [], array('Q'), array('Q')
+		for key, start, end in scanoffsets(filename):
+			keys.append(key)
+			starts.append(start)
+			ends.append(end)
+		index = (stamp, keys, starts, ends)
+		if write:
+			tmp = '%s.%d.tmp' % (indexfile, os.getpid())
+			try:
+				with open(tmp, 'wb') as out:
+					pickle.dump(index, out, protocol=pickle.HIGHEST_PROTOCOL)
+				os.rename(tmp, indexfile)
+			except (IOError, OSError):  # e.g., read-only directory
+				pass
+	_, keys, starts, ends = index
+	return keys, starts, ends, {key: n for n, key in enumerate(keys)}
+
+
+def scanlines(filename):
+	"""Yield tuples ``(lineno, start, end)`` for each line in a file."""
+	offset = 0
+	with open(filename, 'rb') as inp:
+		for n, line in enumerate(inp, 1):
+			yield n, offset, offset + len(line)
+			offset += len(line)
+
+
+def scanexport(filename, encoding='utf8'):
+	"""Yield tuples ``(key, start, end)`` for sentences in export format."""
+	offset = start = 0
+	with open(filename, 'rb') as inp:
+		for line in inp:
+			if line.startswith(b'#BOS '):
+				start = offset
+			elif line.startswith(b'#EOS '):
+				yield (line.split()[1].decode(encoding), start,
+						offset + len(line))
+			offset += len(line)
+
+
+def scantigerxml(filename):
+	"""Yield tuples ``(key, start, end)`` for each ``<s>`` element."""
+	with open(filename, 'rb') as inp:
+		if os.fstat(inp.fileno()).st_size == 0:
+			return
+		data = mmap.mmap(inp.fileno(), 0, access=mmap.ACCESS_READ)
+		try:
+			for match in TIGERSENTRE.finditer(data):
+				end = data.find(b'</s>', match.end())
+				if end == -1:
+					raise ValueError('unterminated <s> element in %s'
+							% filename)
+				yield (match.group(1).decode('utf8'), match.start(),
+						end + len(b'</s>'))
+		finally:
+			data.close()
+
+
+def encodetree(tree):
+	"""Encode a tree as nested tuples of labels, attributes, and children.
+
+	The result can be pickled or hashed, and compared to test whether two
+	trees are identical, including their source fields and head marking."""
+	if tree is None:
+		return None
+	return (tree.label, tree.source, tree.head, tuple([
+			encodetree(child) if isinstance(child, Tree) else child
+			for child in tree]))
+
+
+def decodetree(data):
+	"""Inverse of ``encodetree()``; returns a ParentedTree."""
+	if data is None:
+		return None
+	label, source, head, children = data
+	tree = ParentedTree(label, [decodetree(child)
+			if isinstance(child, tuple) else child for child in children])
+	tree.source = source
+	tree.head = head
+	return tree
+
+
+def _encodeitem(item, data, strings, ids):
+	"""Append the sentence and tree of an item to an array of integers.
+
+	Strings are replaced by their index in ``strings``; ``ids`` maps strings
+	to these indices, and None is encoded as -1. The sentence is stored as
+	its length followed by its words; the tree as a flag for its presence,
+	followed by its nodes in preorder. Each node is stored as its label,
+	number of children, head marker, and the number of source fields (-1 for
+	no source) followed by the fields; a leaf is stored as ``-index - 1``."""
+	def getid(a):
+		if a is None:
+			return -1
+		elif a not in ids:
+			ids[a] = len(strings)
+			strings.append(a)
+		return ids[a]
+
+	def encodenode(node):
+		data.extend((getid(node.label), len(node), node.head))
+		if node.source is None:
+			data.append(-1)
+		else:
+			data.append(len(node.source))
+			data.extend([getid(a) for a in node.source])
+		for child in node:
+			if isinstance(child, Tree):
+				encodenode(child)
+			else:
+				data.append(-child - 1)
+
+	data.append(len(item.sent))
+	data.extend([getid(a) for a in item.sent])
+	data.append(item.tree is not None)
+	if item.tree is not None:
+		encodenode(item.tree)
+
+
+def _decodeitem(strings, offsets, data, m):
+	"""Decode the item with index ``m`` encoded by ``_encodeitem()``.
+
+	:returns: a tuple ``(tree, sent)``."""
+	pos = offsets[m]
+	sent = [strings[a] for a in data[pos + 1:pos + 1 + data[pos]]]
+	pos += 1 + data[pos]
+	tree = _decodenode(data, pos + 1, strings)[0] if data[pos] else None
+	return tree, sent
+
+
+def _decodenode(data, pos, strings):
+	"""Decode the node at ``data[pos]`` encoded by ``_encodeitem()``.
+
+	Nodes are created directly instead of through ``ParentedTree()``,
+	since the structure is known to be valid.
+
+	:returns: a tuple ``(node, pos)`` with a ParentedTree and the position
+		after the node."""
+	node = object.__new__(ParentedTree)
+	node.label = strings[data[pos]]
+	node.head = bool(data[pos + 2])
+	node._parent = None
+	arity, srclen = data[pos + 1], data[pos + 3]
+	pos += 4
+	if srclen == -1:
+		node.source = None
+	else:
+		node.source = tuple([strings[a] for a in data[pos:pos + srclen]])
+		pos += srclen
+	children = node.children = []
+	for _ in range(arity):
+		if data[pos] < 0:
+			children.append(-data[pos] - 1)
+			pos += 1
+		else:
+			child, pos = _decodenode(data, pos, strings)
+			child._parent = node
+			children.append(child)
+	return node, pos
+
+
+def writetreecache(filename, items):
+	"""Write items to a tree cache file.
+
+	The cache is a single compressed pickle of a table of strings, the
+	comments, and two arrays with the offsets and encoded sentences and
+	trees of the items; cf. ``_encodeitem()``.
+
+	:param items: an iterable of :py:class:`discodop.treebank.Item`
+		objects."""
+	strings, ids = [], {}
+	comments, offsets, data = [], array('i'), array('i')
+	for item in items:
+		comments.append(item.comment)
+		offsets.append(len(data))
+		_encodeitem(item, data, strings, ids)
+	strings.append(None)  # id -1 refers to None
+	tmp = '%s.%d.tmp' % (filename, os.getpid())
+	with open(tmp, 'wb') as out:
+		out.write(zlib.compress(pickle.dumps(
+				(strings, comments, offsets, data),
+				protocol=pickle.HIGHEST_PROTOCOL), 1))
+	os.rename(tmp, filename)
+
+
+def readtreecache(filename):
+	"""Load a tree cache file written by ``writetreecache()``.
+
+	:returns: a tuple ``(strings, comments, offsets, data)``; item ``m``
+		is decoded with ``_decodeitem(strings, offsets, data, m)``."""
+	with open(filename, 'rb') as inp:
+		return pickle.loads(zlib.decompress(inp.read()))
+
+
+__all__ = ['encodetree', 'decodetree', 'readoffsets', 'scanlines',
+		'scanexport', 'scantigerxml', 'writetreecache', 'readtreecache']
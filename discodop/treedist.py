@@ -38,7 +38,8 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 from __future__ import division, print_function, absolute_import
-from collections import deque
+from collections import deque, Counter
+import numpy
 from .tree import Tree
 
 
@@ -142,46 +143,39 @@ def strdist(a, b):
 	return 0 if a == b else 1
 
 
-def treedist(tree1, tree2, debug=False):
-	"""Zhang-Shasha tree edit distance."""
-	tree1 = AnnotatedTree(prepare(tree1))
-	tree2 = AnnotatedTree(prepare(tree2))
-	tree1lmd = tree1.leftmostdescendents
-	tree2lmd = tree2.leftmostdescendents
-	tree1nodes = tree1.nodes
-	tree2nodes = tree2.nodes
-	import numpy
-	treedists = numpy.zeros((len(tree1.nodes), len(tree2.nodes)), int)
-	for i in tree1.keyroots:
-		for j in tree2.keyroots:
-			m = i - tree1lmd[i] + 2
-			n = j - tree2lmd[j] + 2
-			table = numpy.zeros((m, n), int)
-			ioff = tree1lmd[i] - 1
-			joff = tree2lmd[j] - 1
-
-			for x in range(1, m):  # δ(l(i1)..i, θ) = δ(l(1i)..1-1, θ) + γ(v → λ)
-				table[x, 0] = table[x - 1, 0] + 1
-			for y in range(1, n):  # δ(θ, l(j1)..j) = δ(θ, l(j1)..j-1) + γ(λ → w)
-				table[0, y] = table[0, y - 1] + 1
+def _zhangshasha(lmd1, lmd2, labels1, labels2, keyroots1, keyroots2,
+		treedists):
+	"""Pure Python version of ``_treedist.zhangshasha()``."""
+	n2 = len(lmd2)
+	# a single table of forest distances, reused for every pair of keyroots
+	table = [[0] * (n2 + 1) for _ in range(len(lmd1) + 1)]
+	for i in keyroots1:
+		for j in keyroots2:
+			m = i - lmd1[i] + 2
+			n = j - lmd2[j] + 2
+			ioff = lmd1[i] - 1
+			joff = lmd2[j] - 1
+
+			for x in range(m):  # δ(l(i1)..i, θ) = δ(l(1i)..1-1, θ) + γ(v → λ)
+				table[x][0] = x
+			for y in range(n):  # δ(θ, l(j1)..j) = δ(θ, l(j1)..j-1) + γ(λ → w)
+				table[0][y] = y
 
 			for x in range(1, m):
+				row, prevrow = table[x], table[x - 1]
+				xlmd, xlabel = lmd1[x + ioff], labels1[x + ioff]
 				for y in range(1, n):
 					# only need to check if x is an ancestor of i
 					# and y is an ancestor of j
-					if (tree1lmd[i] == tree1lmd[x + ioff]
-							and tree2lmd[j] == tree2lmd[y + joff]):
+					if lmd1[i] == xlmd and lmd2[j] == lmd2[y + joff]:
 						#                 +-
 						#                 | δ(l(i1)..i-1, l(j1)..j) + γ(v → λ)
 						# δ(F1, F2) = min-+ δ(l(i1)..i , l(j1)..j-1) + γ(λ → w)
 						#                 | δ(l(i1)..i-1, l(j1)..j-1) + γ(v → w)
 						#                 +-
-						labeldist = strdist(tree1nodes[x + ioff].label,
-								tree2nodes[y + joff].label)
-						table[x, y] = min(table[x - 1, y] + 1,
-								table[x, y - 1] + 1,
-								table[x - 1, y - 1] + labeldist)
-						treedists[x + ioff, y + joff] = table[x, y]
+						row[y] = min(prevrow[y] + 1, row[y - 1] + 1,
+								prevrow[y - 1] + (xlabel != labels2[y + joff]))
+						treedists[x + ioff, y + joff] = row[y]
 					else:
 						#                 +-
 						#                 | δ(l(i1)..i-1, l(j1)..j) + γ(v → λ)
@@ -189,12 +183,53 @@ def treedist(tree1, tree2, debug=False):
 						#                 | δ(l(i1)..l(i)-1, l(j1)..l(j)-1)
 						#                 |                   + treedist(i1,j1)
 						#                 +-
-						a = tree1lmd[x + ioff] - 1 - ioff
-						b = tree2lmd[y + joff] - 1 - joff
-						table[x, y] = min(table[x - 1, y] + 1,
-								table[x, y - 1] + 1,
-								table[a, b] + treedists[x + ioff, y + joff])
-		if debug:
+						a = xlmd - 1 - ioff
+						b = lmd2[y + joff] - 1 - joff
+						row[y] = min(prevrow[y] + 1, row[y - 1] + 1,
+								table[a][b] + treedists[x + ioff, y + joff])
+	return treedists[len(lmd1) - 1, n2 - 1]
+
+
+try:
+	from ._treedist import zhangshasha
+except ImportError:
+	zhangshasha = _zhangshasha
+
+
+def treedist(tree1, tree2, debug=False, maxdist=None):
+	"""Zhang-Shasha tree edit distance.
+
+	:param maxdist: if given, the distance is not computed when a lower bound
+		shows that it is greater than ``maxdist``; this lower bound is
+		returned instead. The lower bound is based on the number of nodes
+		with the same label in both trees."""
+	tree1 = AnnotatedTree(prepare(tree1))
+	tree2 = AnnotatedTree(prepare(tree2))
+	tree1nodes = tree1.nodes
+	tree2nodes = tree2.nodes
+	labelids = {}
+	labels1 = [labelids.setdefault(node.label, len(labelids))
+			for node in tree1nodes]
+	labels2 = [labelids.setdefault(node.label, len(labelids))
+			for node in tree2nodes]
+	if maxdist is not None:
+		# every node that is not deleted, inserted, or relabeled is matched
+		# to a node with the same label.
+		lowerbound = max(len(labels1), len(labels2)) - sum(
+				(Counter(labels1) & Counter(labels2)).values())
+		if lowerbound > maxdist:
+			return lowerbound
+	treedists = numpy.zeros((len(tree1nodes), len(tree2nodes)), numpy.int32)
+	result = zhangshasha(
+			numpy.array(tree1.leftmostdescendents, numpy.int32),
+			numpy.array(tree2.leftmostdescendents, numpy.int32),
+			numpy.array(labels1, numpy.int32),
+			numpy.array(labels2, numpy.int32),
+			numpy.array(tree1.keyroots, numpy.int32),
+			numpy.array(tree2.keyroots, numpy.int32),
+			treedists)
+	if debug:
+		for i in tree1.keyroots:
 			if isinstance(tree1nodes[i], Tree):
 				astr = tree1nodes[i].label  # pprint()
 			else:
@@ -206,7 +241,7 @@ def treedist(tree1, tree2, debug=False):
 				bstr = str(tree2nodes[j])
 			if treedists[i, j]:
 				print("%s[%d] %s[%d] %d" % (astr, i, bstr, j, treedists[i, j]))
-	return treedists[len(tree1.nodes) - 1, len(tree2.nodes) - 1]
+	return int(result)
 # end Zhang-Shasha Tree Edit Distance Implementation.
 
 
@@ -323,7 +358,9 @@ def test():
 	result2 = newtreedist(a, b, debug=True)
 	assert result2 == 3
 	print('%s\n%s\ndistance: %d' % (a, b, result2))
+	assert treedist(a, b, maxdist=3) == 3
+	assert treedist(a, b, maxdist=0) == 1  # lower bound
 
 
-__all__ = ['Terminal', 'prepare', 'AnnotatedTree', 'strdist', 'treedist',
-		'newtreedist', 'EditStats', 'geteditstats']
+__all__ = ['Terminal', 'prepare', 'AnnotatedTree', 'strdist', 'zhangshasha',
+		'treedist', 'newtreedist', 'EditStats', 'geteditstats']
@@ -0,0 +1,366 @@
+"""Base class and shared helpers of the corpus searchers.
+
+Used by :mod:`discodop.treesearch`, which exports the public objects."""
+from __future__ import division, print_function, absolute_import, \
+		unicode_literals
+import os
+import re
+import sys
+import concurrent.futures
+import multiprocessing
+from collections import OrderedDict, namedtuple
+from .containers import FixedVocabulary, Ctrees
+from .treesearchutil import PagingSearcherMixin, DiskCache, \
+		FIFOOrederedDict, restrictkey
+if sys.version_info >= (3, 7):
+	from ._treesearchasync import AsyncSearcherMixin
+else:
+	AsyncSearcherMixin = object
+
+CACHESIZE = 32767
+GETLEAVES = re.compile(r' (?:[0-9]+=)?([^ ()]+)(?=[ )])')
+LEAFINDICES = re.compile(r' ([0-9]+)=')
+LEAFINDICESWORDS = re.compile(r' ([0-9]+)=([^ ()]+)\)')
+MORPH_TAGS = re.compile(r'([/*\w]+)(?:\[[^ ]*\]\d?)?((?:-\w+)?(?:\*\d+)? )')
+FUNC_TAGS = re.compile(r'-\w+')
+
+CorpusInfo = namedtuple('CorpusInfo',
+		['len', 'numwords', 'numnodes', 'maxnodes'])
+# Corpora and vocabularies loaded in this process, kept resident across
+# queries; maps filename to (mtime, object).
+_RESIDENT = {}
+
+
+class CorpusSearcher(AsyncSearcherMixin, PagingSearcherMixin):
+	"""Abstract base class to wrap corpus files that can be queried.
+
+	On Python 3.7+, the query methods have asynchronous counterparts
+	``acounts()``, ``abatchcounts()``, ``atrees()``, and ``asents()``;
+	cf. ``AsyncSearcherMixin``."""
+
+	def __init__(self, files, macros=None, numproc=None, diskcache=None):
+		"""
+		:param files: a sequence of filenames of corpora
+		:param macros: a filename with macros that can be used in queries.
+		:param numproc: the number of concurrent threads / processes to use;
+			pass 1 to use a single core.
+		:param diskcache: if given, the maximum size in bytes of a persistent
+			cache of query results, ``treesearchcache.db`` in the directory
+			of the corpus files; it can be shared by multiple processes.
+			By default, results are only cached in memory."""
+		if not isinstance(files, (list, tuple, set, dict)):
+			raise ValueError('"files" argument must be a sequence.')
+		for a in files:
+			if not os.path.isfile(a):
+				raise ValueError('filenames in "files" argument must exist. '
+						'%r not found.' % a)
+		self.files = OrderedDict.fromkeys(files)
+		self.macros = macros
+		self.numproc = numproc or cpu_count()
+		if diskcache:
+			self.cache = DiskCache(
+					self.__class__.__name__, os.path.join(
+						os.path.dirname(next(iter(sorted(files)))),
+						'treesearchcache.db'), diskcache, CACHESIZE)
+		else:
+			self.cache = FIFOOrederedDict(CACHESIZE)
+		self.pool = concurrent.futures.ThreadPoolExecutor(self.numproc)
+		if not self.files:
+			raise ValueError('no files found: %s' % files)
+
+	def counts(self, query, subset=None, start=None, end=None, indices=False,
+			breakdown=False, restrict=None):
+		"""Run query and return a dict of the form {corpus1: nummatches, ...}.
+
+		:param query: the search query
+		:param subset: an iterable of filenames to run the query on; by default
+			all filenames are used.
+		:param start, end: the interval of sentences to query in each corpus;
+			by default, all sentences are queried. 1-based, inclusive.
+		:param indices: if True, return a sequence of indices of matching
+			occurrences, instead of an integer count.
+		:param breakdown: if True, return a Counter mapping matches to counts.
+		:param restrict: a ``Subcorpus``; if given, only the sentences in it
+			are queried.
+		"""
+
+	def trees(self, query, subset=None, start=None, end=None, maxresults=10,
+			nofunc=False, nomorph=False, restrict=None):
+		"""Run query and return list of matching trees.
+
+		:param start, end: the interval of sentences to query in each corpus;
+			by default, all sentences are queried. 1-based, inclusive.
+		:param maxresults: the maximum number of matches to return.
+		:param nofunc, nomorph: whether to remove / add function tags and
+			morphological features from trees.
+		:param restrict: same as for ``counts()``.
+		:returns: list of tuples of the form
+			``(corpus, sentno, tree, sent, highlight)``
+			highlight is a list of matched Tree nodes from tree."""
+		return self._results('trees', query, subset, start, end, maxresults,
+				restrict, nofunc=nofunc, nomorph=nomorph)
+
+	def sents(self, query, subset=None, start=None, end=None, maxresults=100,
+			brackets=False, restrict=None):
+		"""Run query and return matching sentences.
+
+		:param start, end: the interval of sentences to query in each corpus;
+			by default, all sentences are queried. 1-based, inclusive.
+		:param maxresults: the maximum number of matches to return;
+			pass ``None`` for no limit.
+		:param brackets: if True, return trees as they appear in the treebank,
+			match1 and match2 are strings with the matching subtree.
+			If False (default), sentences are returned as a sequence of tokens.
+		:param restrict: same as for ``counts()``.
+		:returns: list of tuples of the form
+			``(corpus, sentno, sent, match1, match2)``
+			sent is a single string with space-separated tokens;
+			match1 and match2 are iterables of integer indices of characters
+			matched by the query. If the distinction is applicable, match2
+			contains the complete subtree, of which match1 is a subset."""
+		return self._results('sents', query, subset, start, end, maxresults,
+				restrict, brackets=brackets)
+
+	def _results(self, method, query, subset, start, end, maxresults,
+			restrict, **kwargs):
+		"""Run query for ``trees()`` or ``sents()``; results are cached.
+
+		:param method: ``'trees'`` or ``'sents'``.
+		:param kwargs: the options of ``method``, passed to the method of
+			the searcher that converts the results of a file."""
+		subset = subset or self.files
+		key, prepared = self._preparequery(query)
+		rkey = restrictkey(restrict)
+		options = tuple(value for _, value in sorted(kwargs.items()))
+		convert = self._treesresult if method == 'trees' else self._sentsresult
+		result = []
+		jobs = {}
+		for filename in subset:
+			try:
+				x, maxresults2 = self.cache[
+						(method, key, filename, start, end) + options + (rkey, )]
+			except KeyError:
+				x = None
+			if x is not None and (not maxresults2 or (
+					maxresults and maxresults <= maxresults2)):
+				result.extend(x[:maxresults])
+			else:
+				jobs[self._matchjob(prepared, filename, start, end,
+						maxresults, restrict)] = filename
+		for future in self._as_completed(jobs):
+			filename = jobs[future]
+			x = convert(prepared, filename, future.result(), **kwargs)
+			self.cache[(method, key, filename, start, end) + options
+					+ (rkey, )] = x, maxresults
+			result.extend(x)
+		return result
+
+	def _preparequery(self, query):
+		"""Prepare a query for ``_matchjob()``.
+
+		:returns: a tuple ``(key, prepared)``, where ``key`` identifies the
+			query in cache keys."""
+		raise NotImplementedError
+
+	def _matchjob(self, prepared, filename, start, end, maxresults,
+			restrict):
+		"""Submit a query on a single file, without using the cache.
+
+		:returns: a future with the matches, to be converted with
+			``_treesresult()`` or ``_sentsresult()``."""
+		raise NotImplementedError
+
+	def _treesresult(self, prepared, filename, matches, nofunc=False,
+			nomorph=False):
+		"""Convert the matches of ``_matchjob()`` to results of ``trees()``.
+		"""
+		raise NotImplementedError
+
+	def _sentsresult(self, prepared, filename, matches, brackets=False):
+		"""Convert the matches of ``_matchjob()`` to results of ``sents()``.
+		"""
+		raise NotImplementedError
+
+	def batchcounts(self, queries, subset=None, start=None, end=None,
+			restrict=None):
+		"""Like ``counts()``, but executes multiple queries on multiple files.
+
+		Useful in combination with ``pandas.DataFrame``; e.g.::
+
+			queries = ['NP < PP', 'VP < PP']
+			corpus = treesearch.TgrepSearcher(glob.glob('*.mrg'))
+			pandas.DataFrame.from_items(list(corpus.batchcounts(queries)),
+					orient='index', columns=queries)
+
+		:param queries: an iterable of strings.
+		:param start, end: the interval of sentences to query in each corpus;
+			by default, all sentences are queried. 1-based, inclusive.
+		:param restrict: same as for ``counts()``.
+		:yields: tuples of the form
+			``(corpus1, [count1, count2, ...])``.
+			where ``count1, count2, ...`` corresponds to ``queries``.
+			Order of queries and corpora is preserved.
+		"""
+		result = OrderedDict((name, [])
+				for name in subset or self.files)
+		for query in queries:
+			for filename, value in self.counts(
+					query, subset, start, end, restrict=restrict).items():
+				result[filename].append(value)
+		yield from result.items()
+
+	def batchsents(self, queries, subset=None, start=None, end=None,
+			maxresults=100, brackets=False):
+		"""Variant of sents() to run a batch of queries."""
+		result = OrderedDict((name, [])
+				for name in subset or self.files)
+		for query in queries:
+			for value in self.sents(
+					query, subset, start, end, maxresults, brackets):
+				result[value[0]].append(value[1:])
+		yield from result.items()
+
+	def _numsents(self, filename):
+		"""Return the number of sentences in a file."""
+		return self.getinfo(filename).len
+
+	def extract(self, filename, indices,
+			nofunc=False, nomorph=False, sents=False):
+		"""Extract a range of trees / sentences.
+
+		:param filename: one of the filenames in ``self.files``
+		:param indices: iterable of indices of sentences to extract
+			(1-based, excluding empty lines)
+		:param sents: if True, return sentences instead of trees.
+			Sentences are strings with space-separated tokens.
+		:param nofunc, nomorph: same as for ``trees()`` method.
+		:returns: a list of Tree objects or sentences."""
+
+	def getinfo(self, filename):
+		"""Return named tuple with members len, numnodes, and numwords."""
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, _type, _value, _traceback):
+		self.close()
+
+	def close(self):
+		"""Close files and free memory."""
+		asyncpool = getattr(self, '_asyncpool', None)
+		if asyncpool is not None:
+			asyncpool.shutdown(wait=False)
+			self._asyncpool = None
+		# worker processes exit, which releases the corpora they keep
+		# resident; cf. _getresident().
+		pool = getattr(self, 'pool', None)
+		if pool is not None:
+			pool.shutdown(wait=False)
+			self.pool = None
+		cache = getattr(self, 'cache', None)
+		if isinstance(cache, DiskCache):
+			cache.close()
+			self.cache = FIFOOrederedDict(CACHESIZE)
+
+	def _submit(self, func, *args, **kwargs):
+		"""Submit a job to the thread/process pool."""
+		if self.numproc == 1:
+			return NoFuture(func, *args, **kwargs)
+		return self.pool.submit(func, *args, **kwargs)
+
+	def _map(self, func, *args, **kwargs):
+		"""Map with thread/process pool.
+
+		``args`` is a sequence of iterables to map over;
+		the same ``kwargs`` are passed for each iteration."""
+		if self.numproc == 1:
+			return (func(*xargs, **kwargs) for xargs in zip(*args))
+		fs = [self.pool.submit(func, *xargs, **kwargs) for xargs in zip(*args)]
+
+		def result_iterator():
+			"""Yield results one by one."""
+			try:
+				for future in fs:
+					yield future.result()
+			finally:
+				for future_ in fs:
+					future_.cancel()
+
+		return result_iterator()
+
+	def _as_completed(self, jobs):
+		"""Return jobs as they are completed."""
+		if self.numproc == 1:
+			return jobs
+		return concurrent.futures.as_completed(jobs)
+
+
+class NoFuture(object):
+	"""A non-asynchronous version of concurrent.futures.Future."""
+
+	def __init__(self, func, *args, **kwargs):
+		self._result = func(*args, **kwargs)
+
+	def result(self, timeout=None):  # pylint: disable=unused-argument
+		"""Return the precomputed result."""
+		return self._result
+
+
+def filterlabels(line, nofunc, nomorph):
+	"""Remove morphological and/or grammatical function labels from tree(s)."""
+	if nofunc:
+		line = FUNC_TAGS.sub('', line)
+	if nomorph:
+		line = MORPH_TAGS.sub(lambda g: g.group(1) + g.group(2), line)
+	return line
+
+
+def charindices(sent, indices, indices2=None):
+	"""Project token indices to character indices.
+
+	>>> sorted(charindices(['The', 'cat', 'is', 'on', 'the', 'mat'], {0, 2, 4}))
+	[0, 1, 2, 3, 8, 9, 10, 14, 15, 16, 17]"""
+	cur = 0
+	ind = {}
+	for n, a in enumerate(sent):
+		ind[n] = range(cur, cur + len(a)
+				+ (n != len(sent) - 1))
+		cur += len(a) + 1
+	result = {a for n in indices for a in ind[n]}
+	if indices2 is not None:
+		return result, {a for n in indices2 for a in ind[n]}
+	return result
+
+
+def cpu_count():
+	"""Return number of CPUs or 1."""
+	try:
+		return multiprocessing.cpu_count()
+	except NotImplementedError:
+		return 1
+
+
+def _getresident(filename):
+	"""Load a ``.ct`` corpus or vocabulary once per process and keep it.
+
+	Worker processes of the pool persist across queries, so each worker
+	opens and parses the header of a file only the first time it serves a
+	query on it. The file is reloaded when its modification time changes.
+	Files stay resident until ``close()`` of the searcher removes them from
+	this process and shuts down the pool, ending its worker processes."""
+	mtime = os.stat(filename).st_mtime
+	try:
+		cachedmtime, result = _RESIDENT[filename]
+	except KeyError:
+		cachedmtime = None
+	if cachedmtime != mtime:
+		if filename.endswith('.ct'):
+			result = Ctrees.fromfile(filename)
+		else:
+			result = FixedVocabulary.fromfile(filename)
+		_RESIDENT[filename] = mtime, result
+	return result
+
+
+__all__ = ['CorpusSearcher', 'NoFuture', 'filterlabels', 'charindices',
+		'cpu_count']
@@ -0,0 +1,422 @@
+"""Search a corpus for tree fragments.
+
+Used by :mod:`discodop.treesearch`, which exports the public objects."""
+from __future__ import division, print_function, absolute_import, \
+		unicode_literals
+import io
+import os
+import concurrent.futures
+from collections import OrderedDict
+from . import treebank, treesearchbase, _fragments
+from .tree import brackettree, ptbunescape
+from .treetransforms import binarize, mergediscnodes, handledisc
+from .util import workerfunc, openread
+from .containers import Vocabulary, FixedVocabulary
+from .treesearchutil import FIFOOrederedDict, restrictkey, restriction
+from .treesearchbase import CorpusSearcher, CorpusInfo, GETLEAVES, \
+		LEAFINDICES, LEAFINDICESWORDS, _RESIDENT, _getresident, \
+		filterlabels, charindices
+
+
+class FragmentSearcher(CorpusSearcher):
+	"""Search for fragments in a bracket treebank.
+
+	Format of treebanks and queries can be bracket, discbracket, or
+	export (autodetected).
+	Each query consists of one or more tree fragments, and the results
+	will be merged together, except with batchcounts(), which returns
+	the results for each fragment separately.
+
+	Example queries::
+		(S (NP (DT The) (NN )) (VP ))
+		(NP (DT 0=The) (NN 1=queen))
+
+	:param inmemory: if True, load all corpora when the searcher is created;
+		otherwise, load them when they are first queried. Either way, each
+		worker process keeps the corpora and vocabulary it has loaded
+		resident for subsequent queries.
+	"""
+
+	# TODO: allow single terminals as queries: word
+	#       alternatively, allow wildcard: (* word)
+	# TODO: allow regex labels: /label/
+	# 		expand to multiple queries; feasible?
+	# TODO: interpret multiple fragments in a single query as AND query,
+	#       optionally with order constraint: (NN cat) (NN dog)
+	def __init__(self, files, macros=None, numproc=None, inmemory=True,
+			diskcache=None):
+		super(FragmentSearcher, self).__init__(
+				files, macros, numproc, diskcache)
+		self.compiled = FIFOOrederedDict(treesearchbase.CACHESIZE)
+		self.disc = False
+		newvocab = True
+		path = os.path.dirname(next(iter(sorted(files))))
+		self.vocabpath = os.path.join(path, 'treesearchvocab.idx')
+		if os.path.exists(self.vocabpath):
+			self.vocab = FixedVocabulary.fromfile(self.vocabpath)
+			mtime = os.stat(self.vocabpath).st_mtime
+			if all(os.path.exists(a + '.ct')
+						and mtime > os.stat(a + '.ct').st_mtime
+						> os.stat(a).st_mtime for a in files):
+				self.vocab.makeindex()
+				newvocab = False
+		if newvocab:
+			self.vocab = Vocabulary()
+		for filename in self.files:
+			self.disc = self.disc or not filename.endswith('.mrg')
+			if newvocab:
+				# get format from extension
+				ext = {'export': 'export',
+						'mrg': 'bracket',
+						'dbr': 'discbracket'}
+				fmt = ext[filename.rsplit('.', 1)[1]]
+				corpus = _fragments.readtreebank(filename, self.vocab, fmt=fmt)
+				corpus.indextrees(self.vocab)
+				corpus.tofile('%s.ct' % filename)
+				newvocab = True
+			if inmemory:
+				self.files[filename] = _getresident('%s.ct' % filename)
+		if newvocab:
+			self.vocab.tofile(self.vocabpath)
+		self.macros = None
+		if macros:
+			with openread(macros) as tmp:
+				self.macros = dict(line.strip().split('=', 1) for line in tmp)
+		self.pool = concurrent.futures.ProcessPoolExecutor(self.numproc)
+
+	def __del__(self):
+		if not hasattr(self, 'files'):
+			# __init__ didn't succeed, so don't bother closing
+			return
+		self.close()
+
+	def close(self):
+		super(FragmentSearcher, self).close()
+		if self.files is None:
+			return
+		for filename in self.files:
+			_RESIDENT.pop('%s.ct' % filename, None)
+		_RESIDENT.pop(self.vocabpath, None)
+		del self.vocab
+		del self.files
+		self.files = None
+
+	def counts(self, query, subset=None, start=None, end=None, indices=False,
+			breakdown=False, restrict=None):
+		if breakdown:
+			if indices:
+				raise NotImplementedError
+			cquery = self._compiled(query)
+			result = self.batchcounts(cquery, subset, start, end, restrict)
+			return OrderedDict(
+					(filename, OrderedDict(
+						(frag, a) for frag, a in zip(cquery.fragments, values)))
+					for filename, values in result)
+		subset = subset or self.files
+		cquery = self._compiled(query)
+		query = cquery.text
+		rkey = restrictkey(restrict)
+		result = OrderedDict()
+		jobs = {}
+		for filename in subset:
+			try:
+				tmp = self.cache[
+						'counts', query, filename, start, end, indices, rkey]
+				if indices:
+					result[filename] = [b for a in tmp for b in a]
+				else:
+					result[filename] = sum(tmp)
+			except KeyError:
+				jobs[self._submit(
+						_frag_query if self.numproc == 1 else _frag_query_mp,
+						cquery.ctrees, cquery.bitsets, cquery.maxnodes,
+						filename, self.vocabpath, start, end, None,
+						indices=indices, trees=False,
+						restrict=restriction(restrict, filename, True)
+						)] = filename
+		for future in self._as_completed(jobs):
+			filename = jobs[future]
+			tmp = future.result()
+			self.cache['counts', query, filename, start, end, indices,
+					rkey] = tmp
+			if indices:
+				result[filename] = [b for a in tmp for b in a]
+			else:
+				result[filename] = sum(tmp)
+		return result
+
+	def batchcounts(self, queries, subset=None, start=None, end=None,
+			restrict=None):
+		subset = subset or self.files
+		jobs = {}
+		cquery = self._compiled(
+				queries if isinstance(queries, FragmentQuery)
+				else list(queries))
+		for filename in subset:
+			# NB: not using cache.
+			jobs[self._submit(
+					_frag_batchcounts if self.numproc == 1
+					else _frag_batchcounts_mp, cquery.ctrees, cquery.bitsets,
+					cquery.maxnodes, filename, start, end,
+					restriction(restrict, filename, True))] = filename
+		for future in self._as_completed(jobs):
+			filename = jobs[future]
+			yield filename, future.result()
+
+	def _preparequery(self, query):
+		cquery = self._compiled(query)
+		return cquery.text, cquery
+
+	def _matchjob(self, prepared, filename, start, end, maxresults,
+			restrict):
+		return self._submit(
+				_frag_query if self.numproc == 1 else _frag_query_mp,
+				prepared.ctrees, prepared.bitsets, prepared.maxnodes,
+				filename, self.vocabpath, start, end, maxresults,
+				indices=True, trees=True,
+				restrict=restriction(restrict, filename, True))
+
+	def _treesresult(self, prepared, filename, matches, nofunc=False,
+			nomorph=False):
+		x = []
+		for fragmatches in matches:
+			for sentno, treestr, match in fragmatches:
+				treestr = filterlabels(treestr, nofunc, nomorph)
+				# NB: this highlights the whole subtree, of which
+				# frag may be a subgraph.
+				treestr = treestr.replace(
+						match,
+						'%s_HIGH %s' % tuple(match.split(None, 1)),
+						1)
+				tree, sent = brackettree(treestr)
+				tree = mergediscnodes(tree)
+				high = list(tree.subtrees(
+						lambda n: n.label.endswith("_HIGH")))
+				if high:
+					high = high.pop()
+					high.label = high.label.rsplit("_", 1)[0]
+					high = list(high.subtrees()) + high.leaves()
+				x.append((filename, sentno, tree, sent, high))
+		return x
+
+	def _sentsresult(self, prepared, filename, matches, brackets=False):
+		x = []
+		for frag, fragmatches in zip(prepared.fragments, matches):
+			for sentno, treestr, match in fragmatches:
+				if brackets:
+					sent = treestr
+					if not self.disc:
+						sent = LEAFINDICES.sub(' ', sent)
+						match = LEAFINDICES.sub(' ', match)
+					match1, match2 = match, ''
+				else:
+					_, xsent = brackettree(treestr)
+					sent = ' '.join(xsent)
+					fragwords = set(GETLEAVES.findall(frag))
+					match1 = {int(a) for a, b
+							in LEAFINDICESWORDS.findall(match)
+							if b in fragwords}
+					match2 = {int(a) for a, _
+							in LEAFINDICESWORDS.findall(match)}
+					match1, match2 = charindices(xsent, match1, match2)
+				x.append((filename, sentno, sent, match1, match2))
+		return x
+
+	def extract(self, filename, indices,
+			nofunc=False, nomorph=False, sents=False):
+		if self.files[filename] is not None:
+			corpus = self.files[filename]
+		else:
+			corpus = _getresident('%s.ct' % filename)
+		if sents:
+			return [' '.join(ptbunescape(token)
+					for token in corpus.extractsent(n - 1, self.vocab))
+					for n in indices]
+		result = []
+		for n in indices:
+			treestr = corpus.extract(n - 1, self.vocab)
+			tree, sent = brackettree(
+					filterlabels(treestr, nofunc, nomorph))
+			result.append((mergediscnodes(tree), sent))
+		return result
+
+	def getinfo(self, filename):
+		if self.files[filename] is not None:
+			corpus = self.files[filename]
+		else:
+			corpus = _getresident('%s.ct' % filename)
+		return CorpusInfo(len=corpus.len, numwords=corpus.numwords,
+				numnodes=corpus.numnodes, maxnodes=corpus.maxnodes)
+
+	def compile(self, queries):
+		"""Prepare fragment queries for repeated use.
+
+		:param queries: a string with one or more fragments, as accepted by
+			``counts()``, or a list of fragments, as for ``batchcounts()``.
+		:returns: a ``FragmentQuery`` object, which may be passed instead of
+			the query to ``counts()``, ``trees()``, ``sents()``, and
+			``batchcounts()``. It can be pickled and used with other
+			corpora; when their vocabulary differs, the parsed and
+			binarized fragments are reused, and only their labels and
+			productions are mapped to the other vocabulary."""
+		cquery = None
+		if isinstance(queries, FragmentQuery):
+			cquery, queries, text = queries, queries.query, queries.text
+		else:
+			if not isinstance(queries, (str, tuple)):
+				queries = tuple(queries)
+			text = queries
+			if self.macros is not None:
+				text = (text.format(**self.macros) if isinstance(text, str)
+						else tuple(query.format(**self.macros)
+							for query in text))
+		vocabkey = self._vocabkey()
+		try:
+			result = self.compiled[text]
+		except KeyError:
+			pass
+		else:
+			if result.vocabkey == vocabkey:
+				return result
+		if cquery is not None and cquery.disc == self.disc:
+			items = cquery.items
+		else:
+			items = self._parse_query(
+					list(text) if isinstance(text, tuple) else text,
+					disc=self.disc)
+		ctrees, bitsets, maxnodes = self._prepare_query(items)
+		result = self.compiled[text] = FragmentQuery(
+				queries, text, items, self.disc, ctrees, bitsets, maxnodes,
+				vocabkey)
+		return result
+
+	def _compiled(self, query):
+		"""Return compiled query, unless it already is one for this corpus."""
+		if (isinstance(query, FragmentQuery)
+				and query.vocabkey == self._vocabkey()):
+			return query
+		return self.compile(query)
+
+	def _vocabkey(self):
+		"""Identify the vocabulary to which production IDs of queries refer.
+		"""
+		stat = os.stat(self.vocabpath)
+		return self.vocabpath, stat.st_mtime, stat.st_size
+
+	@staticmethod
+	def _parse_query(query, disc=False):
+		"""Parse and binarize fragment query.
+
+		:returns: a list of ``(tree, sent)`` tuples."""
+		if isinstance(query, list):
+			qitems = (brackettree(a) for a in query)
+		else:
+			qitems = treebank.incrementaltreereader(
+					io.StringIO(query), strict=True, robust=False)
+		return [(binarize(handledisc(item[0]) if disc else item[0],
+				dot=True), item[1]) for item in qitems]
+
+	def _prepare_query(self, items):
+		"""Map parsed fragments to the productions of this vocabulary.
+
+		:returns: a tuple ``(ctrees, bitsets, maxnodes)``."""
+		# FIXME: this function could be parallelized.
+		queries = _fragments.getctrees(items, vocab=self.vocab, index=False)
+		if not queries['trees1']:
+			raise ValueError('no valid fragments in query.')
+		maxnodes = queries['trees1'].maxnodes
+		_fragmentkeys, bitsets = _fragments.completebitsets(
+				queries['trees1'], self.vocab, maxnodes, disc=self.disc,
+				tostring=False)
+		return queries['trees1'], bitsets, maxnodes
+
+
+class FragmentQuery(object):
+	"""A set of fragment queries prepared with ``FragmentSearcher.compile()``.
+
+	:ivar query: the query as passed to ``compile()``; a string, or a tuple
+		of strings.
+	:ivar text: the query after replacing macros.
+	:ivar fragments: a list with a string for each fragment.
+	:ivar items: the parsed and binarized fragments, as a list of
+		``(tree, sent)`` tuples; these do not depend on the vocabulary.
+	:ivar disc: whether the fragments were binarized as discontinuous trees.
+	:ivar ctrees, bitsets, maxnodes: the prepared fragments.
+	:ivar vocabkey: identifies the vocabulary of the production IDs used in
+		``ctrees`` and ``bitsets``."""
+
+	def __init__(self, query, text, items, disc, ctrees, bitsets, maxnodes,
+			vocabkey):
+		self.query = query
+		self.text = text
+		self.fragments = (text.splitlines() if isinstance(text, str)
+				else list(text))
+		self.items = items
+		self.disc = disc
+		self.ctrees = ctrees
+		self.bitsets = bitsets
+		self.maxnodes = maxnodes
+		self.vocabkey = vocabkey
+
+	def __repr__(self):
+		return '<FragmentQuery with %d fragments>' % len(self.bitsets)
+
+
+@workerfunc
+def _frag_query_mp(queries, bitsets, maxnodes, filename, vocabpath,
+		start=None, end=None, maxresults=None, indices=True, trees=False,
+		restrict=None):
+	"""Multiprocessing wrapper."""
+	return _frag_query(
+			queries, bitsets, maxnodes, filename, vocabpath, start, end,
+			maxresults, indices, trees, restrict)
+
+
+def _frag_query(queries, bitsets, maxnodes, filename, vocabpath,
+		start=None, end=None, maxresults=None, indices=True, trees=False,
+		restrict=None):
+	"""Run a prepared fragment query on a single file.
+
+	:param queries: a Ctrees object with the fragments.
+	:param restrict: if given, a RoaringBitmap with 0-based indices of the
+		trees to search."""
+	corpus = _getresident('%s.ct' % filename)
+	if start:
+		start -= 1
+	results = _fragments.exactcountsslice(queries, corpus,
+			bitsets, indices=indices + trees if indices else 0,
+			maxnodes=maxnodes, start=start, end=end,
+			maxresults=maxresults, subset=restrict)
+	if indices and trees:
+		vocab = _getresident(vocabpath)
+		results = [[(n + 1,
+					corpus.extract(n, vocab, disc=True),
+					corpus.extract(n, vocab, disc=True, node=m))
+					for n, m in zip(b, c)]
+				for b, c in results]
+	elif indices:
+		results = [[n + 1 for n in b] for b in results]
+	return results
+
+
+@workerfunc
+def _frag_batchcounts_mp(queries, bitsets, maxnodes, filename,
+		start=None, end=None, restrict=None):
+	"""Multiprocessing wrapper."""
+	return _frag_batchcounts(
+			queries, bitsets, maxnodes, filename, start, end, restrict)
+
+
+def _frag_batchcounts(queries, bitsets, maxnodes, filename,
+		start=None, end=None, restrict=None):
+	"""Count a batch of prepared fragment queries on a single file.
+
+	Each candidate tree is visited once for the whole batch."""
+	corpus = _getresident('%s.ct' % filename)
+	if start:
+		start -= 1
+	return _fragments.exactcountsbatch(queries, corpus, bitsets,
+			maxnodes=maxnodes, start=start, end=end, subset=restrict)
+
+
+__all__ = ['FragmentSearcher', 'FragmentQuery']
@@ -0,0 +1,380 @@
+"""Trigram filtering and batched matching for regex queries.
+
+Used by :mod:`discodop.treesearch`."""
+from __future__ import division, print_function, absolute_import, \
+		unicode_literals
+import re
+import mmap
+import array
+from collections import OrderedDict
+from itertools import islice, chain
+try:
+	from re import _parser as sre_parse
+except ImportError:
+	import sre_parse
+from roaringbitmap import RoaringBitmap, MultiRoaringBitmap
+
+# number of bytes from which trigram frequencies are estimated
+SAMPLESIZE = 1 << 16
+REGEXTYPE = type(re.compile(''))
+
+
+def _regex_run_batch(patterns, filename, fileno, lineidxpath,
+		start=None, end=None, maxresults=None, sents=False, restrict=None):
+	"""Run a batch of queries on a single file.
+
+	Instead of scanning the whole file for each pattern, the file is scanned
+	once for the trigrams that the patterns require (cf.
+	``_regex_trigrams()``), after which each pattern is only run on the lines
+	containing its trigrams. Patterns without such requirements, or with
+	requirements that are not selective, are run on the whole file.
+
+	:param restrict: if given, a RoaringBitmap with the line numbers to
+		which the search is restricted."""
+	mrb = MultiRoaringBitmap.fromfile(lineidxpath)
+	lineindex = mrb.get(fileno)
+	if sents:
+		result = []
+	else:
+		result = array.array('I')
+	if start and start >= len(lineindex):
+		return result
+	lastline = (end if end is not None and end < len(lineindex)
+			else len(lineindex) - 1)
+	with open(filename, 'rb') as tmp:
+		data = mmap.mmap(tmp.fileno(), 0, access=mmap.ACCESS_READ)
+		try:
+			startidx = lineindex.select(start - 1 if start else 0)
+			endidx = (lineindex.select(end) if end is not None
+					and end < len(lineindex) else len(data))
+			candidates = _regex_batchcandidates(
+					patterns, data, lineindex, startidx, endidx)
+			for pattern, lines in zip(patterns, candidates):
+				if restrict is not None:
+					lines = restrict if lines is None else lines & restrict
+				if lines is None:
+					spans = [(startidx, endidx)]
+				else:
+					spans = _candidatespans(
+							lines, lineindex, start or 1, lastline)
+				if sents:
+					for match in islice(chain.from_iterable(
+							pattern.finditer(data, a, b) for a, b in spans),
+							maxresults):
+						mstart = match.start()
+						mend = match.end()
+						lineno = lineindex.rank(mstart)
+						offset, nextoffset = _getoffsets(
+								lineno, lineindex, data)
+						sent = data[offset:nextoffset].decode('utf8')
+						mstart = len(data[offset:mstart].decode('utf8'))
+						mend = len(data[offset:mend].decode('utf8'))
+						# sentno, sent, high1, high2
+						result.append((lineno, sent, range(mstart, mend), ()))
+				else:
+					try:
+						result.append(sum(pattern.count(data, a, b)
+								for a, b in spans))
+					except AttributeError:
+						result.append(sum(len(pattern.findall(data, a, b))
+								for a, b in spans))
+		finally:
+			data.close()
+			del mrb
+	return result
+
+
+def _regex_batchcandidates(patterns, data, lineindex, start, end):
+	"""Find the candidate lines for a batch of patterns in a single pass.
+
+	For each conjunction of trigrams required by a pattern, the trigram that
+	is least frequent in a sample of the data is looked up.
+
+	:returns: a list with, for each pattern, a RoaringBitmap with the 1-based
+		numbers of the lines that may contain a match; or None if the
+		pattern should be run on all lines."""
+	requirements = [_regex_trigrams(pattern.pattern.decode('utf8'),
+				pattern.flags) if isinstance(pattern, REGEXTYPE) else None
+			for pattern in patterns]
+	sample = data[start:min(end, start + SAMPLESIZE)]
+	samplelines = sample.count(b'\n') + 1
+	freq = {}
+	anchors = []
+	for req in requirements:
+		if req is None or not all(req):
+			anchors.append(None)
+			continue
+		for trigram in chain.from_iterable(req):
+			if trigram not in freq:
+				freq[trigram] = sample.count(trigram)
+		anchor = {min(sorted(conjunction), key=freq.get)
+				for conjunction in req}
+		# when most lines are candidates, a single scan is faster
+		anchors.append(anchor if 4 * sum(freq[trigram] for trigram in anchor)
+				< samplelines else None)
+	trigrams = set().union(*(anchor for anchor in anchors
+			if anchor is not None))
+	if not trigrams:
+		return anchors
+	# a zero-width match at every position where a trigram starts
+	finder = re.compile(b'(?=(' + _regex_trie(trigrams) + b'))')
+	offsets = {}
+	for match in finder.finditer(data, start, end):
+		offsets.setdefault(match.group(1), []).append(match.start())
+	lines = {trigram: RoaringBitmap(lineindex.rank(offset)
+			for offset in offsets.get(trigram, ()))
+			for trigram in trigrams}
+	return [None if anchor is None
+			else RoaringBitmap().union(*(lines[trigram] for trigram in anchor))
+			for anchor in anchors]
+
+
+def _regex_trie(strings):
+	"""Return a regex matching any of a set of byte strings of equal length.
+
+	The alternatives are nested by common prefixes, so that a match is found
+	without trying each string separately.
+
+	>>> _regex_trie({b'cat', b'car', b'dog'})
+	b'(?:c(?:a(?:r|t))|d(?:o(?:g)))'"""
+	branches = OrderedDict()
+	for a in sorted(strings):
+		branches.setdefault(a[:1], []).append(a[1:])
+	return b'(?:' + b'|'.join(
+			re.escape(prefix) + (_regex_trie(suffixes) if suffixes[0] else b'')
+			for prefix, suffixes in branches.items()) + b')'
+
+
+def _getoffsets(lineno, lineindex, data):
+	"""Return the (start, end) byte offsets for a given 1-based line number."""
+	offset = 0
+	if 1 <= lineno < len(lineindex):
+		offset = lineindex.select(lineno - 1)
+	else:
+		raise IndexError
+	nextoffset = lineindex.select(lineno)
+	# there is at least one newline, but there may be more
+	# because empty lines are not indexed.
+	while data is not None and data[nextoffset - 1] == 10:  # b'\n':
+		nextoffset -= 1
+	return offset, nextoffset
+
+
+def _candidatespans(candidates, lineindex, start, end):
+	"""Merge runs of consecutive candidate lines into spans of byte offsets.
+
+	:param start, end: 1-based, inclusive interval of lines to consider.
+	:returns: a list of (startoffset, endoffset) tuples."""
+	spans = []
+	for lineno in candidates.clamp(start, end + 1):
+		offset, nextoffset = (lineindex.select(lineno - 1),
+				lineindex.select(lineno))
+		if spans and spans[-1][1] == offset:
+			spans[-1] = (spans[-1][0], nextoffset)
+		else:
+			spans.append((offset, nextoffset))
+	return spans
+
+
+def _regex_trigrams(query, flags):
+	r"""Determine trigrams that a line must contain to match a regex query.
+
+	:returns: a list of sets of trigrams (byte strings); a line can only
+		contain a match if it contains all trigrams of one of the sets.
+		None if no such requirement can be determined, or when a match
+		is not guaranteed to be confined to a single line.
+
+	>>> sorted(sorted(a) for a in _regex_trigrams(r'(?:a|an) cat', re.M))
+	[[b' ca', b'a c', b'cat'], [b' ca', b'an ', b'cat', b'n c']]
+	>>> _regex_trigrams(r'\w+ing', re.MULTILINE)
+	[frozenset({b'ing'})]
+	>>> _regex_trigrams(r'walk\s+ing', re.MULTILINE) is None
+	True"""
+	try:
+		parsed = sre_parse.parse(query.encode('utf8'), flags)
+	except (re.error, OverflowError, RuntimeError):
+		return None
+	state = getattr(parsed, 'state', None) or parsed.pattern
+	if (state.flags & (re.IGNORECASE | re.DOTALL)
+			or not state.flags & re.MULTILINE):
+		return None
+	try:
+		exact, result = _regex_requirements(parsed)
+	except ValueError:
+		return None
+	result = _trigramsand(result, _trigramsexact(exact))
+	if result == ANYTRIGRAMS:
+		return None
+	return result
+
+
+# Trigram requirements are a disjunction of conjunctions of trigrams;
+# this value expresses that there is no requirement.
+ANYTRIGRAMS = [frozenset()]
+# Limits on the size of alternatives and combinations that are tracked.
+MAXALTERNATIVES = 32
+
+
+def _trigramsexact(strings):
+	"""Trigram requirements for a set of alternative literal strings."""
+	if strings is None:
+		return ANYTRIGRAMS
+	result = []
+	for a in strings:
+		trigrams = frozenset(a[n:n + 3] for n in range(len(a) - 2))
+		if not trigrams:
+			return ANYTRIGRAMS
+		if trigrams not in result:
+			result.append(trigrams)
+	return result or ANYTRIGRAMS
+
+
+def _trigramsand(req1, req2):
+	"""Conjunction of two trigram requirements.
+
+	Requirements may be dropped to keep the result small; this is safe since
+	the result then merely selects more candidate lines."""
+	if req1 == ANYTRIGRAMS:
+		return req2
+	elif req2 == ANYTRIGRAMS:
+		return req1
+	elif len(req1) * len(req2) > MAXALTERNATIVES:
+		return req1 if len(req1) <= len(req2) else req2
+	result = []
+	for a in req1:
+		for b in req2:
+			if a | b not in result:
+				result.append(a | b)
+	return result
+
+
+def _trigramsor(reqs):
+	"""Disjunction of trigram requirements."""
+	result = []
+	for req in reqs:
+		if req == ANYTRIGRAMS:
+			return ANYTRIGRAMS
+		result.extend(a for a in req if a not in result)
+	if len(result) > MAXALTERNATIVES:
+		return ANYTRIGRAMS
+	return result
+
+
+def _regex_requirements(items):
+	"""Collect literal strings and trigram requirements of parsed regex.
+
+	:returns: a tuple ``(exact, req)`` where exact is a set of alternative
+		literal strings that the last part of ``items`` matches (or None),
+		and req are trigram requirements of the rest.
+	:raises ValueError: if ``items`` contains a construct that could match
+		a newline or that depends on the start or end of the whole file."""
+	exact, req = {b''}, ANYTRIGRAMS
+	for op, av in items:
+		xexact, xreq = _regex_node(op, av)
+		req = _trigramsand(req, xreq)
+		if xexact is None:
+			req = _trigramsand(req, _trigramsexact(exact))
+			exact = {b''}
+		elif len(exact) * len(xexact) <= MAXALTERNATIVES:
+			exact = {a + b for a in exact for b in xexact}
+		else:
+			req = _trigramsand(req, _trigramsexact(exact))
+			exact = xexact
+	return exact, req
+
+
+def _regex_node(op, av):
+	"""Requirements for a single node of a parsed regex; cf. above."""
+	if op is sre_parse.LITERAL:
+		if av == 10:
+			raise ValueError
+		return {bytes(bytearray([av]))}, ANYTRIGRAMS
+	elif op is sre_parse.NOT_LITERAL:
+		if av != 10:
+			raise ValueError
+		return None, ANYTRIGRAMS
+	elif op is sre_parse.ANY:
+		return None, ANYTRIGRAMS
+	elif op is sre_parse.IN:
+		literals, onlyliterals = set(), True
+		for op1, av1 in av:
+			if op1 is sre_parse.LITERAL and av1 != 10:
+				literals.add(bytes(bytearray([av1])))
+			elif op1 is sre_parse.RANGE and not av1[0] <= 10 <= av1[1]:
+				onlyliterals = False
+			elif op1 is sre_parse.CATEGORY and av1 in (
+					sre_parse.CATEGORY_DIGIT, sre_parse.CATEGORY_WORD):
+				onlyliterals = False
+			else:
+				raise ValueError
+		if not onlyliterals or len(literals) > MAXALTERNATIVES:
+			return None, ANYTRIGRAMS
+		return literals, ANYTRIGRAMS
+	elif op is sre_parse.AT:
+		if av in (sre_parse.AT_BEGINNING_STRING, sre_parse.AT_END_STRING):
+			raise ValueError
+		return {b''}, ANYTRIGRAMS
+	elif op is sre_parse.SUBPATTERN:
+		if len(av) == 4 and (av[1] & (re.IGNORECASE | re.DOTALL)
+				or av[2] & re.MULTILINE):
+			raise ValueError
+		return _regex_requirements(av[-1])
+	elif op is sre_parse.BRANCH:
+		alternatives = [_regex_requirements(a) for a in av[1]]
+		if all(exact is not None and req == ANYTRIGRAMS
+				for exact, req in alternatives):
+			exact = set().union(*(exact for exact, _ in alternatives))
+			if len(exact) <= MAXALTERNATIVES:
+				return exact, ANYTRIGRAMS
+		return None, _trigramsor(
+				_trigramsand(req, _trigramsexact(exact))
+				for exact, req in alternatives)
+	elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT,
+			getattr(sre_parse, 'POSSESSIVE_REPEAT', None)):
+		minrepeat, maxrepeat, items = av
+		exact, req = _regex_requirements(items)
+		if minrepeat == 0:
+			return None, ANYTRIGRAMS
+		elif minrepeat == maxrepeat == 1:
+			return exact, req
+		return None, _trigramsand(req, _trigramsexact(exact))
+	elif op is getattr(sre_parse, 'ATOMIC_GROUP', None):
+		return _regex_requirements(av)
+	elif op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+		_regex_requirements(av[1])
+		return {b''}, ANYTRIGRAMS
+	elif op is sre_parse.GROUPREF:
+		return None, ANYTRIGRAMS
+	elif op is sre_parse.GROUPREF_EXISTS:
+		_regex_requirements(av[1])
+		if av[2] is not None:
+			_regex_requirements(av[2])
+		return None, ANYTRIGRAMS
+	raise ValueError
+
+
+def _trigramindexfile(filename):
+	"""Map each trigram in a file to the numbers of the lines it occurs in.
+
+	Line numbers are 1-based and only count non-empty lines, as in the
+	line index; trigrams on a blank line are attributed to the preceding
+	non-empty line, which is how a match there would be reported."""
+	index = {}
+	lineno = 0
+	with open(filename, 'rb') as tmp:
+		for line in tmp:
+			if not line.isspace():
+				lineno += 1
+			elif lineno == 0:
+				continue
+			line = line.rstrip(b'\n')
+			for trigram in {line[n:n + 3] for n in range(len(line) - 2)}:
+				try:
+					index[trigram].append(lineno)
+				except KeyError:
+					index[trigram] = array.array('I', [lineno])
+	return OrderedDict((trigram, RoaringBitmap(lines))
+			for trigram, lines in sorted(index.items()))
+
+
+__all__ = []
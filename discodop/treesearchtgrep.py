@@ -0,0 +1,198 @@
+"""Search a corpus with tgrep2 queries, without the tgrep2 program.
+
+Used by :mod:`discodop.treesearch`, which exports the public objects."""
+from __future__ import division, print_function, absolute_import, \
+		unicode_literals
+from collections import Counter, OrderedDict
+from roaringbitmap import RoaringBitmap
+from . import _fragments
+from .tree import Tree
+from .tgrep import TgrepTree, TgrepQuery
+from .util import workerfunc
+from .treesearchutil import restrictkey, restriction
+from .treesearchbase import CorpusSearcher, _getresident, filterlabels, \
+		charindices
+from .treesearchfrag import FragmentSearcher
+
+
+class NativeTgrepSearcher(FragmentSearcher):
+	"""Search a corpus with tgrep2 queries, without the tgrep2 program.
+
+	Uses the same indexed corpus files as ``FragmentSearcher``; queries are
+	evaluated on the trees with binarization undone. The supported subset of
+	the query language is described in :mod:`discodop.tgrep`. Trees that
+	lack a node required by the query are skipped using the index of
+	productions.
+
+	Format of treebanks can be bracket, discbracket, or export
+	(autodetected).
+
+	:param macros: a file containing lines of the form ``'name=query'``;
+		an occurrence of ``'{name}'`` will be suitably replaced when it
+		appears in a query."""
+
+	def counts(self, query, subset=None, start=None, end=None, indices=False,
+			breakdown=False, restrict=None):
+		if breakdown and indices:
+			raise NotImplementedError
+		subset = subset or self.files
+		if self.macros is not None:
+			query = query.format(**self.macros)
+		rkey = restrictkey(restrict)
+		result = OrderedDict()
+		jobs = {}
+		prods = None
+		for filename in subset:
+			try:
+				result[filename] = self.cache[
+						'counts', query, filename, start, end, indices,
+						breakdown, rkey]
+			except KeyError:
+				if prods is None:
+					prods = self._tgrep_prods(query)
+				jobs[self._submit(
+						_tgrep_query if self.numproc == 1 else _tgrep_query_mp,
+						query, prods, filename, self.vocabpath, start, end,
+						None, 'breakdown' if breakdown else None,
+						restriction(restrict, filename, True))] = filename
+		for future in self._as_completed(jobs):
+			filename = jobs[future]
+			matches = future.result()
+			if indices:
+				tmp = [sentno for sentno, _, _ in matches]
+			elif breakdown:
+				tmp = Counter(match for _, _, match in matches)
+			else:
+				tmp = len(matches)
+			self.cache['counts', query, filename, start, end, indices,
+					breakdown, rkey] = result[filename] = tmp
+		return result
+
+	def batchcounts(self, queries, subset=None, start=None, end=None,
+			restrict=None):
+		return CorpusSearcher.batchcounts(
+				self, queries, subset, start, end, restrict)
+
+	def _preparequery(self, query):
+		if self.macros is not None:
+			query = query.format(**self.macros)
+		return query, (query, self._tgrep_prods(query))
+
+	def _matchjob(self, prepared, filename, start, end, maxresults,
+			restrict):
+		query, prods = prepared
+		return self._submit(
+				_tgrep_query if self.numproc == 1 else _tgrep_query_mp,
+				query, prods, filename, self.vocabpath, start, end,
+				maxresults, 'trees', restriction(restrict, filename, True))
+
+	def _treesresult(self, prepared, filename, matches, nofunc=False,
+			nomorph=False):
+		x = []
+		for sentno, i, (labels, parents, leaves) in matches:
+			if nofunc or nomorph:
+				labels = [filterlabels(label + ' ', nofunc, nomorph)[:-1]
+						if leaf == -1 else label
+						for label, leaf in zip(labels, leaves)]
+			tree, sent, nodes = TgrepTree(labels, parents, leaves).totree()
+			high = nodes[i]
+			if isinstance(high, Tree):
+				high = list(high.subtrees()) + high.leaves()
+			else:
+				high = [high]
+			x.append((filename, sentno, tree, sent, high))
+		return x
+
+	def _sentsresult(self, prepared, filename, matches, brackets=False):
+		x = []
+		for sentno, i, table in matches:
+			tree = TgrepTree(*table)
+			if brackets:
+				sent, match1 = tree.tostring(), tree.tostring(i)
+				match2 = ''
+			else:
+				_, xsent, _ = tree.totree()
+				sent = ' '.join(xsent)
+				match1 = charindices(xsent, tree.yieldof(i))
+				match2 = set()
+			x.append((filename, sentno, sent, match1, match2))
+		return x
+
+	def extract(self, filename, indices,
+			nofunc=False, nomorph=False, sents=False):
+		if sents:
+			return super(NativeTgrepSearcher, self).extract(
+					filename, indices, nofunc, nomorph, sents)
+		if self.files[filename] is not None:
+			corpus = self.files[filename]
+		else:
+			corpus = _getresident('%s.ct' % filename)
+		result = []
+		for n in indices:
+			labels, parents, leaves = _fragments.treenodes(
+					corpus, self.vocab, n - 1)
+			if nofunc or nomorph:
+				labels = [filterlabels(label + ' ', nofunc, nomorph)[:-1]
+						if leaf == -1 else label
+						for label, leaf in zip(labels, leaves)]
+			tree, sent, _ = TgrepTree(labels, parents, leaves).totree()
+			result.append((tree, sent))
+		return result
+
+	def _tgrep_prods(self, query):
+		"""Parse query and select productions of nodes it requires.
+
+		:returns: a list of arrays with production IDs; a tree can only
+			match if it contains a production from each array."""
+		return [_fragments.selectprods(self.vocab, match)
+				for match in TgrepQuery(query).required]
+
+
+@workerfunc
+def _tgrep_query_mp(query, prods, filename, vocabpath, start=None, end=None,
+		maxresults=None, output=None, restrict=None):
+	"""Multiprocessing wrapper."""
+	return _tgrep_query(query, prods, filename, vocabpath, start, end,
+			maxresults, output, restrict)
+
+
+def _tgrep_query(query, prods, filename, vocabpath, start=None, end=None,
+		maxresults=None, output=None, restrict=None):
+	"""Run a tgrep2 query on a single file.
+
+	:param prods: the result of ``NativeTgrepSearcher._tgrep_prods()``.
+	:param output: if ``'trees'``, include the node table of each matching
+		tree; if ``'breakdown'``, include the matching subtree as a string.
+	:param restrict: if given, a RoaringBitmap with 0-based indices of the
+		trees to search.
+	:returns: a list of tuples ``(sentno, node, x)`` for each match, with
+		``x`` as specified by ``output``, or None."""
+	corpus = _getresident('%s.ct' % filename)
+	vocab = _getresident(vocabpath)
+	pattern = TgrepQuery(query)
+	candidates = None
+	for ids in prods:
+		tmp = RoaringBitmap().union(*[corpus.prodindex[n] for n in ids
+				if n < len(corpus.prodindex)])
+		candidates = tmp if candidates is None else candidates & tmp
+	if candidates is None:
+		candidates = RoaringBitmap(range(corpus.len))
+	if restrict is not None:
+		candidates = candidates & restrict
+	result = []
+	for n in candidates.clamp(start - 1 if start else 0, end or corpus.len):
+		table = _fragments.treenodes(corpus, vocab, n)
+		tree = TgrepTree(*table)
+		for i in pattern.findall(tree):
+			if output == 'trees':
+				result.append((n + 1, i, table))
+			elif output == 'breakdown':
+				result.append((n + 1, i, tree.tostring(i)))
+			else:
+				result.append((n + 1, i, None))
+			if maxresults and len(result) >= maxresults:
+				return result
+	return result
+
+
+__all__ = ['NativeTgrepSearcher']
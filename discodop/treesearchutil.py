@@ -0,0 +1,281 @@
+"""Paging, caching, and restriction of queries for corpus searchers.
+
+Used by :mod:`discodop.treesearch`, which exports the public objects."""
+from __future__ import division, print_function, absolute_import, \
+		unicode_literals
+import io
+import os
+import csv
+import array
+import pickle
+import hashlib
+from collections import OrderedDict
+from roaringbitmap import RoaringBitmap
+from .util import PersistentCache
+
+
+class PagingSearcherMixin(object):
+	"""Methods of ``CorpusSearcher`` to page through query results."""
+
+	def sentspage(self, query, cursor=None, pagesize=100, subset=None,
+			brackets=False, restrict=None):
+		"""Return a page of matching sentences and a cursor for the next page.
+
+		Each file is scanned in consecutive windows of sentences, until
+		enough results have been found; the cursor records where the scan
+		stopped, so that the next page resumes from there without re-running
+		the query on earlier sentences or keeping all results in memory.
+
+		:param cursor: ``None`` for the first page, or the cursor returned
+			with the previous page: a tuple ``(filename, sentno)`` with the
+			last sentence that was scanned.
+		:param pagesize: the number of results after which the scan stops;
+			since all matches in the last window are included, a page may
+			contain more results.
+		:param brackets, restrict: same as for ``sents()``.
+		:returns: a tuple ``(results, cursor)``, where results are as for
+			``sents()``; cursor is None after the last page.
+
+		Results of pages are not cached. NB: with ``TgrepSearcher``, the
+		tgrep2 program cannot resume a query, so each window runs it
+		from the start of the file; later pages of a large file are
+		therefore slower."""
+		return self._page('sents', query, cursor, pagesize, subset,
+				restrict, brackets=brackets)
+
+	def treespage(self, query, cursor=None, pagesize=10, subset=None,
+			nofunc=False, nomorph=False, restrict=None):
+		"""Variant of ``sentspage()`` for ``trees()``."""
+		return self._page('trees', query, cursor, pagesize, subset,
+				restrict, nofunc=nofunc, nomorph=nomorph)
+
+	def _page(self, method, query, cursor, pagesize, subset, restrict,
+			**kwargs):
+		"""Collect a page of results of ``method``; cf. ``sentspage()``.
+
+		Each window is queried with ``_matchjob()``, bypassing the cache,
+		such that memory use does not grow with the number of pages."""
+		_, prepared = self._preparequery(query)
+		convert = self._treesresult if method == 'trees' else self._sentsresult
+		files = list(subset or self.files)
+		idx, sentno = 0, 0
+		if cursor is not None:
+			filename, sentno = cursor
+			if filename not in files:
+				raise ValueError('cursor refers to unknown file: %r'
+						% filename)
+			idx = files.index(filename)
+		result = []
+		window = pagesize
+		while idx < len(files):
+			numsents = self._numsents(files[idx])
+			if sentno >= numsents:
+				idx, sentno = idx + 1, 0
+				continue
+			elif len(result) >= pagesize:
+				break
+			end = min(sentno + window, numsents)
+			tmp = convert(prepared, files[idx], self._matchjob(
+					prepared, files[idx], sentno + 1, end, None,
+					restrict).result(), **kwargs)
+			result.extend(tmp)
+			sentno = end
+			# adapt the size of the window to the density of matches
+			if not tmp:
+				window *= 2
+			elif len(tmp) > pagesize:
+				window = max(window * pagesize // len(tmp), 1)
+		return result, (files[idx], sentno) if idx < len(files) else None
+
+
+class Subcorpus(object):
+	"""A named set of sentences in one or more corpus files.
+
+	May be passed as the ``restrict`` argument of queries, in which case only
+	sentences in the subcorpus are searched. Sentences are stored as a
+	RoaringBitmap of 1-based sentence numbers for each file.
+
+	:param sentnos: a mapping of filenames to iterables of sentence numbers.
+	:param name: an optional name.
+
+	>>> sub = Subcorpus({'a.mrg': [1, 3], 'b.mrg': [2]}, name='example')
+	>>> sub
+	<Subcorpus 'example' with 3 sentences in 2 files>
+	>>> list(sub.get('a.mrg')), list(sub.get('a.mrg', zerobased=True))
+	([1, 3], [0, 2])
+	>>> len(sub & Subcorpus({'a.mrg': [3, 4]}))
+	1"""
+
+	def __init__(self, sentnos, name=None):
+		self.name = name
+		self.bitmaps = {filename: RoaringBitmap(a)
+				for filename, a in sentnos.items()}
+		self._key = None
+		self._zerobased = {}
+
+	@classmethod
+	def fromresults(cls, results, name=None):
+		"""Create a subcorpus of the sentences matched by a query.
+
+		:param results: the result of ``counts(..., indices=True)``, or a
+			sequence of results of ``sents()`` or ``trees()``."""
+		if isinstance(results, dict):
+			return cls(results, name)
+		sentnos = {}
+		for result in results:
+			sentnos.setdefault(result[0], set()).add(result[1])
+		return cls(sentnos, name)
+
+	@classmethod
+	def frommetadata(cls, filename, name=None, **conditions):
+		"""Create a subcorpus from sentence-level metadata in a CSV file.
+
+		The CSV file should have a header with at least the columns
+		``filename`` and ``sentno``; each other column is an attribute.
+		A sentence is selected when its attributes have the given values;
+		e.g., ``Subcorpus.frommetadata('meta.csv', speaker='A')``."""
+		sentnos = {}
+		with io.open(filename, encoding='utf8') as inp:
+			for row in csv.DictReader(inp):
+				if all(row[key] == str(val)
+						for key, val in conditions.items()):
+					sentnos.setdefault(row['filename'], []).append(
+							int(row['sentno']))
+		return cls(sentnos, name)
+
+	@classmethod
+	def load(cls, filename):
+		"""Load a subcorpus saved with ``save()``."""
+		with open(filename, 'rb') as inp:
+			name, bitmaps = pickle.load(inp)
+		return cls(bitmaps, name)
+
+	def save(self, filename):
+		"""Save subcorpus to a file."""
+		with open(filename, 'wb') as out:
+			pickle.dump((self.name, self.bitmaps), out,
+					protocol=pickle.HIGHEST_PROTOCOL)
+
+	def get(self, filename, zerobased=False):
+		"""Return a RoaringBitmap with the sentences in a file.
+
+		:param zerobased: if True, return 0-based indices of trees."""
+		if not zerobased:
+			return self.bitmaps.get(filename, RoaringBitmap())
+		if filename not in self._zerobased:
+			self._zerobased[filename] = RoaringBitmap(
+					n - 1 for n in self.get(filename))
+		return self._zerobased[filename]
+
+	def key(self):
+		"""Return a digest of the sentences; used as part of cache keys."""
+		if self._key is None:
+			digest = hashlib.md5()
+			for filename in sorted(self.bitmaps):
+				if self.bitmaps[filename]:
+					digest.update(filename.encode('utf8') + b'\0')
+					digest.update(array.array(
+							'I', self.bitmaps[filename]).tobytes())
+			self._key = digest.hexdigest()
+		return self._key
+
+	def __and__(self, other):
+		return Subcorpus({filename: self.bitmaps[filename] & other.get(
+				filename) for filename in self.bitmaps})
+
+	def __or__(self, other):
+		return Subcorpus({filename: self.get(filename) | other.get(filename)
+				for filename in set(self.bitmaps) | set(other.bitmaps)})
+
+	def __len__(self):
+		return sum(len(a) for a in self.bitmaps.values())
+
+	def __repr__(self):
+		return '<Subcorpus%s with %d sentences in %d files>' % (
+				'' if self.name is None else ' %r' % self.name, len(self),
+				sum(1 for a in self.bitmaps.values() if a))
+
+
+def restrictkey(restrict):
+	"""Return the part of a cache key for an optional ``Subcorpus``."""
+	return None if restrict is None else restrict.key()
+
+
+def restriction(restrict, filename, zerobased=False):
+	"""Return the sentences in a file of an optional ``Subcorpus``.
+
+	:returns: a RoaringBitmap, or None if ``restrict`` is None."""
+	return None if restrict is None else restrict.get(filename, zerobased)
+
+
+class DiskCache(object):
+	"""A cache of query results in memory, backed by a persistent cache.
+
+	The persistent cache is stored in an SQLite database that may be shared
+	with other searchers and processes. In both layers, keys are extended
+	with the name of the searcher class and the modification time of the
+	corpus file, which is expected to be the third element of each key,
+	such that results are not reused after the corpus file has changed.
+
+	:param engine: name of the searcher class.
+	:param filename: filename of the database.
+	:param maxbytes: maximum size of the persistent cache.
+	:param memsize: maximum number of results in the memory cache."""
+
+	def __init__(self, engine, filename, maxbytes, memsize):
+		self.engine = engine
+		self.memory = FIFOOrederedDict(memsize)
+		self.disk = PersistentCache(filename, maxbytes)
+
+	def _key(self, key):
+		return (self.engine, os.stat(key[2]).st_mtime) + tuple(key)
+
+	def __getitem__(self, key):
+		key = self._key(key)
+		try:
+			return self.memory[key]
+		except KeyError:
+			result = self.memory[key] = self.disk[key]
+			return result
+
+	def __setitem__(self, key, value):
+		key = self._key(key)
+		self.memory[key] = value
+		self.disk[key] = value
+		# write through, such that other processes can use the result
+		self.disk.flush()
+
+	def __contains__(self, key):
+		key = self._key(key)
+		return key in self.memory or key in self.disk
+
+	def stats(self):
+		"""Return hit/miss statistics and size of the persistent cache."""
+		return self.disk.stats()
+
+	def close(self):
+		"""Close the database; may be called more than once."""
+		if self.disk is not None:
+			self.disk.close()
+			self.disk = None
+
+
+class FIFOOrederedDict(OrderedDict):
+	"""FIFO cache with maximum number of elements based on OrderedDict."""
+
+	def __init__(self, limit):
+		super(FIFOOrederedDict, self).__init__()
+		self.limit = limit
+
+	def __setitem__(self, key, value):  # pylint: disable=arguments-differ
+		if self.limit == 0:
+			return
+		elif key in self:
+			self.pop(key)
+		elif len(self) >= self.limit:
+			self.pop(next(iter(self)))
+		super(FIFOOrederedDict, self).__setitem__(key, value)
+
+
+__all__ = ['PagingSearcherMixin', 'Subcorpus', 'restrictkey', 'restriction',
+		'DiskCache', 'FIFOOrederedDict']
@@ -3,10 +3,16 @@ import io
 import os
 import sys
 import gzip
+import time
 import codecs
+import pickle
+import sqlite3
+import hashlib
+import threading
 import traceback
 from heapq import heapify, heappush, heappop, heapreplace
 from functools import wraps
+from itertools import islice
 from collections import Set, Iterable
 
 
@@ -343,6 +349,203 @@ def merge(*iterables, key=None):
 		yield from iterable
 
 
+def batches(iterable, size):
+	"""Yield lists with up to ``size`` consecutive items of ``iterable``.
+
+	>>> list(batches(range(5), 2))
+	[[0, 1], [2, 3], [4]]"""
+	iterable = iter(iterable)
+	batch = list(islice(iterable, size))
+	while batch:
+		yield batch
+		batch = list(islice(iterable, size))
+
+
+class PersistentCache(object):
+	"""A size-bounded mapping stored in an SQLite database.
+
+	Keys and values are pickled; when the total size of the pickled values
+	exceeds ``maxbytes``, the least recently used items are evicted until
+	the size is below ``lowwater * maxbytes``.
+	The database can be shared by multiple threads and processes.
+
+	:param filename: the database file; created if it does not exist.
+	:param maxbytes: the maximum total size of the stored values.
+	:param lowwater: fraction of ``maxbytes`` to which the cache is reduced
+		when it is full, such that items are evicted in batches.
+
+	The total size is maintained by triggers instead of being recomputed.
+	Access times of items that are looked up are kept in memory and
+	written in batches of ``ATIMEBATCH`` items, and when the cache is
+	flushed, evicts items, or is closed. Similarly, new items are written
+	in a single transaction per ``WRITEBATCH`` items; until then, they are
+	not visible to other processes.
+
+	>>> import tempfile
+	>>> with tempfile.NamedTemporaryFile() as tmp:
+	...		cache = PersistentCache(tmp.name, maxbytes=1000)
+	...		cache['a', 1] = list(range(10))
+	...		cache['a', 1], ('b', 2) in cache, cache.hits, cache.misses
+	...		cache.close()
+	([0, 1, 2, 3, 4, 5, 6, 7, 8, 9], False, 1, 0)
+	"""
+
+	ATIMEBATCH = 1000
+	WRITEBATCH = 1000
+
+	def __init__(self, filename, maxbytes=1 << 30, lowwater=0.9):
+		self.filename = filename
+		self.maxbytes = maxbytes
+		self.lowwater = lowwater
+		self.hits = self.misses = 0
+		self.atimes = {}  # pending access times of items that were looked up
+		self.pending = {}  # items that have not been written yet
+		self.lock = threading.Lock()
+		self.db = sqlite3.connect(filename, timeout=60,
+				check_same_thread=False)
+		with self.lock, self.db:
+			self.db.execute('PRAGMA journal_mode=WAL')
+			# with WAL, a crash can only lose the last transactions
+			self.db.execute('PRAGMA synchronous=NORMAL')
+			self.db.execute('CREATE TABLE IF NOT EXISTS cache ('
+					'key BLOB PRIMARY KEY, value BLOB, size INTEGER, '
+					'atime REAL)')
+			self.db.execute(
+					'CREATE INDEX IF NOT EXISTS cache_atime ON cache (atime)')
+			self.db.execute('CREATE TABLE IF NOT EXISTS total ('
+					'id INTEGER PRIMARY KEY CHECK (id = 0), size INTEGER)')
+			self.db.execute('INSERT OR IGNORE INTO total '
+					'SELECT 0, TOTAL(size) FROM cache')
+			self.db.execute('CREATE TRIGGER IF NOT EXISTS cache_insert '
+					'AFTER INSERT ON cache BEGIN UPDATE total '
+					'SET size = size + new.size; END')
+			self.db.execute('CREATE TRIGGER IF NOT EXISTS cache_delete '
+					'AFTER DELETE ON cache BEGIN UPDATE total '
+					'SET size = size - old.size; END')
+			self.db.execute('CREATE TRIGGER IF NOT EXISTS cache_update '
+					'AFTER UPDATE OF size ON cache BEGIN UPDATE total '
+					'SET size = size - old.size + new.size; END')
+
+	@staticmethod
+	def _key(key):
+		return hashlib.sha1(pickle.dumps(key, protocol=2)).digest()
+
+	def __getitem__(self, key):
+		key = self._key(key)
+		with self.lock:
+			if key in self.pending:
+				self.hits += 1
+				return pickle.loads(self.pending[key])
+			row = self.db.execute('SELECT value FROM cache WHERE key = ?',
+					(key, )).fetchone()
+			if row is None:
+				self.misses += 1
+				raise KeyError
+			self.hits += 1
+			self.atimes[key] = time.time()
+			if len(self.atimes) >= self.ATIMEBATCH:
+				with self.db:
+					self._writeatimes()
+		return pickle.loads(row[0])
+
+	def __setitem__(self, key, value):
+		value = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+		if len(value) > self.maxbytes:
+			return
+		key = self._key(key)
+		with self.lock:
+			self.atimes.pop(key, None)
+			self.pending[key] = value
+			if len(self.pending) >= self.WRITEBATCH:
+				with self.db:
+					self._writepending()
+
+	def __delitem__(self, key):
+		key = self._key(key)
+		with self.lock, self.db:
+			self.atimes.pop(key, None)
+			self.pending.pop(key, None)
+			self.db.execute('DELETE FROM cache WHERE key = ?', (key, ))
+
+	def __contains__(self, key):
+		key = self._key(key)
+		with self.lock:
+			return key in self.pending or self.db.execute(
+					'SELECT 1 FROM cache WHERE key = ?',
+					(key, )).fetchone() is not None
+
+	def __len__(self):
+		self.flush()
+		with self.lock:
+			return self.db.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+
+	def _writeatimes(self):
+		"""Write pending access times; caller holds lock and transaction."""
+		if self.atimes:
+			self.db.executemany('UPDATE cache SET atime = ? WHERE key = ?',
+					[(atime, key) for key, atime in self.atimes.items()])
+			self.atimes.clear()
+
+	def _writepending(self):
+		"""Write pending items; caller holds lock and transaction."""
+		if self.pending:
+			now = time.time()
+			# NB: not INSERT OR REPLACE, which does not fire delete triggers
+			self.db.executemany('UPDATE cache SET value = ?, size = ?, '
+					'atime = ? WHERE key = ?', [(value, len(value), now, key)
+					for key, value in self.pending.items()])
+			self.db.executemany('INSERT OR IGNORE INTO cache '
+					'VALUES (?, ?, ?, ?)', [(key, value, len(value), now)
+					for key, value in self.pending.items()])
+			self.pending.clear()
+			self._evict()
+
+	def _evict(self):
+		"""Remove least recently used items if the cache is full."""
+		total = self.db.execute('SELECT size FROM total').fetchone()[0]
+		if total <= self.maxbytes:
+			return
+		self._writeatimes()
+		goal = self.lowwater * self.maxbytes
+		remove = []
+		for key, size in self.db.execute(
+				'SELECT key, size FROM cache ORDER BY atime'):
+			remove.append((key, ))
+			total -= size
+			if total <= goal:
+				break
+		self.db.executemany('DELETE FROM cache WHERE key = ?', remove)
+
+	def flush(self):
+		"""Write pending items and access times to the database."""
+		with self.lock, self.db:
+			self._writepending()
+			self._writeatimes()
+
+	def stats(self):
+		"""Return a dict with the number of hits, misses, items, and bytes.
+
+		Hits and misses are counted in this process only."""
+		self.flush()
+		with self.lock:
+			items = self.db.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+			size = self.db.execute('SELECT size FROM total').fetchone()[0]
+		return dict(hits=self.hits, misses=self.misses, items=items,
+				bytes=int(size))
+
+	def clear(self):
+		"""Remove all items."""
+		with self.lock, self.db:
+			self.atimes.clear()
+			self.pending.clear()
+			self.db.execute('DELETE FROM cache')
+
+	def close(self):
+		"""Write pending items and access times and close the database."""
+		self.flush()
+		self.db.close()
+
+
 ANSICOLOR = {
 		'black': 30,
 		'red': 31,
@@ -355,4 +558,4 @@ ANSICOLOR = {
 }
 
 __all__ = ['ishead', 'which', 'workerfunc', 'openread', 'slice_bounds',
-		'OrderedSet', 'ANSICOLOR']
+		'OrderedSet', 'batches', 'PersistentCache', 'ANSICOLOR']
@@ -0,0 +1,82 @@
+"""Micro-benchmark of the tree kernel used for fragment extraction.
+
+Builds a synthetic treebank from the trees in ``tests/t1.mrg``, by combining
+a random number of their constituents under a new root node and varying the
+words. Reports the number of tree pairs compared per second during
+extraction, and the number of fragments counted per second.
+
+Usage: python tests/benchfragments.py [numtrees [seed]]"""
+from __future__ import division, print_function, absolute_import, \
+		unicode_literals
+import io
+import os
+import sys
+import time
+import random
+import tempfile
+from discodop.tree import Tree
+from discodop import _fragments
+from discodop.fragments import readtreebanks
+
+
+def synthetictreebank(filename, numtrees, seed=1):
+	"""Return bracket trees derived from the trees in ``filename``."""
+	rnd = random.Random(seed)
+	with io.open(filename, encoding='utf8') as inp:
+		constituents = [Tree.parse(line, parse_leaf=None)[0]
+				for line in inp if line.strip()]
+	words = ['w%d' % n for n in range(25)]
+	result = []
+	for _ in range(numtrees):
+		children = []
+		for _ in range(rnd.randint(1, 8)):
+			const = constituents[rnd.randrange(len(constituents))].copy(True)
+			for pos in const.treepositions('leaves'):
+				const[pos] = rnd.choice(words)
+			children.append(const)
+		result.append(str(Tree('S', children)))
+	return result
+
+
+def main():
+	"""Run benchmark."""
+	numtrees = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+	seed = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+	trees = synthetictreebank(os.path.join(
+			os.path.dirname(__file__), 't1.mrg'), numtrees, seed)
+	with tempfile.NamedTemporaryFile('w', suffix='.mrg', delete=False) as out:
+		out.write('\n'.join(trees) + '\n')
+	try:
+		treebank = readtreebanks(out.name)
+	finally:
+		os.unlink(out.name)
+	trees1, vocab = treebank['trees1'], treebank['vocab']
+	print('%d trees; %d nodes (max %d)' % (
+			len(trees1), trees1.numnodes, trees1.maxnodes))
+
+	begin = time.time()
+	fragments = _fragments.extractfragments(
+			trees1, 0, 0, vocab, approx=False, disc=False)
+	elapsed = time.time() - begin
+	numpairs = len(trees1) * (len(trees1) - 1) // 2
+	print('extraction: %d pairs in %.2fs: %.0f pairs/s; %d fragments' % (
+			numpairs, elapsed, numpairs / elapsed, len(fragments)))
+
+	bitsets = list(fragments.values())
+	begin = time.time()
+	counts = _fragments.exactcounts(trees1, trees1, bitsets)
+	elapsed = time.time() - begin
+	print('exact counts: %d fragments in %.2fs: %.0f fragments/s; '
+			'total count %d' % (len(bitsets), elapsed,
+			len(bitsets) / elapsed, sum(counts)))
+
+	begin = time.time()
+	counts = _fragments.exactcountsbatch(trees1, trees1, bitsets)
+	elapsed = time.time() - begin
+	print('batch counts: %d fragments in %.2fs: %.0f fragments/s; '
+			'total count %d' % (len(bitsets), elapsed,
+			len(bitsets) / elapsed, sum(counts)))
+
+
+if __name__ == '__main__':
+	main()
@@ -4,6 +4,9 @@ from __future__ import division, print_function, absolute_import, \
 		unicode_literals
 import os
 import re
+import sys
+import shutil
+import tempfile
 from unittest import TestCase
 from itertools import count, islice
 from operator import itemgetter
@@ -115,6 +118,89 @@ rich	JJ	--	--	500
 		result = list(incrementaltreereader(data.splitlines()))
 		assert len(result) == 1
 
+	def test_cachedir(self):
+		from discodop.treebank import NegraCorpusReader
+		cachedir = tempfile.mkdtemp()
+		try:
+			orig = NegraCorpusReader('alpinosample.export', punct='move')
+			for _ in range(2):  # create cache, then read it
+				cached = NegraCorpusReader('alpinosample.export',
+						punct='move', cachedir=cachedir)
+				assert cached.sents() == orig.sents()
+				assert list(map(str, cached.trees().values())) == list(
+						map(str, orig.trees().values()))
+				assert [(a.source, a.head) for tree in cached.trees().values()
+						for a in tree.subtrees()] == [(a.source, a.head)
+						for tree in orig.trees().values()
+						for a in tree.subtrees()]
+				assert len(os.listdir(cachedir)) == 1
+			key, item = next(cached.itertrees(1, 2))
+			assert key == list(orig.trees())[1]
+			assert item.block == orig.blocks()[key]
+			assert item.tree[0].parent is item.tree
+			# without expensive transformations, trees are parsed directly
+			unused = os.path.join(cachedir, 'unused')
+			NegraCorpusReader('alpinosample.export', cachedir=unused).trees()
+			assert not os.path.exists(unused)
+		finally:
+			shutil.rmtree(cachedir)
+
+	def test_tigerxml(self):
+		from discodop.treebank import TigerXMLCorpusReader
+		sent = '''<s id="s%d"><graph root="s%d_500"><terminals>
+			<t id="s%d_1" word="Ball" lemma="--" pos="NN" morph="--"/>
+			<t id="s%d_2" word="rollt" lemma="--" pos="VVFIN" morph="--"/>
+			</terminals><nonterminals><nt id="s%d_500" cat="S">
+			<edge label="SB" idref="s%d_1"/><edge label="HD" idref="s%d_2"/>
+			</nt></nonterminals></graph></s>\n'''
+		tmpdir = tempfile.mkdtemp()
+		filename = os.path.join(tmpdir, 'tiger.xml')
+		try:
+			with open(filename, 'w') as out:
+				out.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+						'<corpus><body>\n%s</body></corpus>\n' % ''.join(
+							sent % ((n, ) * 7) for n in range(1, 4)))
+			trees = TigerXMLCorpusReader(filename).trees()
+			assert list(trees) == ['s1', 's2', 's3']
+			item = TigerXMLCorpusReader(filename).item('s2')
+			assert str(item.tree) == str(trees['s2'])
+			assert item.sent == ['Ball', 'rollt']
+			assert os.path.exists(filename + '.offsets')
+		finally:
+			shutil.rmtree(tmpdir)
+
+	def test_offsets(self):
+		from discodop.treebank import NegraCorpusReader
+		tmpdir = tempfile.mkdtemp()
+		filename = os.path.join(tmpdir, 'sample.export')
+		try:
+			shutil.copy('alpinosample.export', filename)
+			items = list(NegraCorpusReader(filename).itertrees())
+			for _ in range(2):  # create index, then read it
+				result = list(NegraCorpusReader(filename).itertrees(1, 3))
+				assert [key for key, _ in result] == [
+						key for key, _ in items[1:3]]
+				assert [item.block for _, item in result] == [
+						item.block for _, item in items[1:3]]
+			key, item = items[2]
+			assert NegraCorpusReader(filename).item(key).sent == item.sent
+			assert NegraCorpusReader(filename).keys() == [
+					key for key, _ in items]
+			sample = NegraCorpusReader(filename).sample(2, seed=1)
+			assert len(sample) == 2 and sample[0][0] != sample[1][0]
+			assert os.path.exists(filename + '.offsets')
+		finally:
+			shutil.rmtree(tmpdir)
+
+	def test_numproc(self):
+		from discodop.treebank import NegraCorpusReader
+		orig = NegraCorpusReader('alpinosample.export', punct='move')
+		parallel = NegraCorpusReader('alpinosample.export', punct='move',
+				numproc=2)
+		assert list(parallel.trees()) == list(orig.trees())
+		assert list(map(str, parallel.trees().values())) == list(
+				map(str, orig.trees().values()))
+
 
 class Test_treebanktransforms(object):
 	def test_balancedpunctraise(self):
@@ -370,8 +456,46 @@ class TestHeap(TestCase):
 				sorted(list(d1.keys()) + list(d1.values())))
 
 
+def test_treedist():
+	"""Tree edit distance implementations agree; maxdist gives a bound."""
+	import random
+	from discodop import treedist
+
+	def randomtree(leaves):
+		if len(leaves) == 1 and rnd.random() < 0.6:
+			return Tree(rnd.choice('PQ'), list(leaves))
+		elif len(leaves) == 1:
+			return Tree(rnd.choice('ABC'), [randomtree(leaves)])
+		split = sorted(rnd.sample(range(1, len(leaves)),
+				rnd.randint(1, min(2, len(leaves) - 1))))
+		return Tree(rnd.choice('ABC'), [randomtree(leaves[a:b])
+				for a, b in zip([0] + split, split + [len(leaves)])])
+
+	rnd = random.Random(1)
+	orig = treedist.zhangshasha
+	bounded = 0
+	for _ in range(200):
+		leaves = list(range(rnd.randint(1, 6)))
+		tree1, tree2 = randomtree(leaves), randomtree(leaves)
+		dist = treedist.treedist(tree1, tree2)
+		try:
+			treedist.zhangshasha = treedist._zhangshasha
+			assert treedist.treedist(tree1, tree2) == dist, (tree1, tree2)
+		finally:
+			treedist.zhangshasha = orig
+		assert treedist.newtreedist(tree1, tree2) == dist, (tree1, tree2)
+		for maxdist in range(dist + 2):
+			result = treedist.treedist(tree1, tree2, maxdist=maxdist)
+			# either the exact distance or a lower bound exceeding maxdist
+			assert result == dist or maxdist < result < dist, (
+					tree1, tree2, maxdist)
+			bounded += result != dist
+	assert bounded
+
+
 def test_fragments():
-	from discodop._fragments import getctrees, extractfragments, exactcounts
+	from discodop._fragments import getctrees, extractfragments, \
+			exactcounts, exactcountsbatch
 	treebank = """\
 (S (NP (DT 0) (NN 1)) (VP (VBP 2) (NP (DT 3) (JJ 4) (NN 5))))\
 	The cat saw the hungry dog
@@ -399,6 +523,134 @@ def test_fragments():
 			list(fragments.values()))
 	assert len(fragments) == 25
 	assert sum(counts) == 100
+	assert list(exactcountsbatch(params['trees1'], params['trees1'],
+			list(fragments.values()))) == list(counts)
+
+	# worker processes use memory-mapped copies of the treebank
+	from discodop.fragments import PARAMS, writectrees, initworkermmap
+	tmpdir = tempfile.mkdtemp()
+	try:
+		PARAMS.update(params, twoterms=None)
+		initworkermmap(*writectrees(tmpdir))
+		assert extractfragments(PARAMS['trees1'], 0, 0, PARAMS['vocab'],
+				disc=True, approx=False) == fragments
+	finally:
+		shutil.rmtree(tmpdir)
+
+
+def test_fragmentscheckpoint():
+	"""Kill a fragment extraction run partway and resume it."""
+	from discodop import fragments
+	treebank = """\
+(S (NP (DT The) (NN cat)) (VP (VBP saw) (NP (DT the) (JJ hungry) (NN dog))))
+(S (NP (DT The) (NN cat)) (VP (VBP saw) (NP (DT the) (NN dog))))
+(S (NP (DT The) (NN mouse)) (VP (VBP saw) (NP (DT the) (NN cat))))
+(S (NP (DT The) (JJ little) (NN mouse)) (VP (VBP saw) (NP (DT the) (NN cat))))
+(S (NP (DT The) (NN cat)) (VP (VBP ate) (NP (DT the) (NN dog))))
+(S (NP (DT The) (NN mouse)) (VP (VBP ate) (NP (DT the) (NN cat))))
+"""
+	origsize, origworker = fragments.INTERVALSIZE, fragments.worker
+	origwrite = fragments.writecheckpoint
+	tmpdir = tempfile.mkdtemp()
+	try:
+		filename = os.path.join(tmpdir, 'treebank.mrg')
+		with open(filename, 'w') as out:
+			out.write(treebank * 3)
+		checkpoint = os.path.join(tmpdir, 'checkpoint')
+		fragments.INTERVALSIZE = 4  # 18 trees => 5 intervals
+
+		def run(name, *opts):
+			output = os.path.join(tmpdir, name)
+			fragments.main(['--quiet', '-o', output, filename] + list(opts))
+			with open(output) as inp:
+				return sorted(inp)
+
+		expected = run('expected.txt')
+
+		def killingwrite(directory, interval, results):
+			if len(os.listdir(directory)) > 2:  # run.pkl + 2 intervals
+				raise KeyboardInterrupt
+			origwrite(directory, interval, results)
+
+		fragments.writecheckpoint = killingwrite
+		try:
+			run('killed.txt', '--checkpoint=' + checkpoint)
+		except KeyboardInterrupt:
+			pass
+		else:
+			raise AssertionError('run was not interrupted')
+		fragments.writecheckpoint = origwrite
+
+		computed = []
+
+		def countingworker(interval):
+			computed.append(interval)
+			return origworker(interval)
+
+		fragments.worker = countingworker
+		assert run('resumed.txt', '--checkpoint=' + checkpoint) == expected
+		assert computed == [(8, 12), (12, 16), (16, 18)]
+	finally:
+		fragments.INTERVALSIZE, fragments.worker = origsize, origworker
+		fragments.writecheckpoint = origwrite
+		shutil.rmtree(tmpdir)
+
+
+def test_fragmentsrestrict():
+	"""With --restrict, only the selected trees are compared and counted."""
+	import json
+	from discodop import fragments
+	from discodop.tree import brackettree
+	from discodop._fragments import getctrees, extractfragments, selecttrees
+	treebank = """\
+(S (NP (DT The) (NN cat)) (VP (VBP saw) (NP (DT the) (JJ hungry) (NN dog))))
+(S (NP (DT The) (NN cat)) (VP (VBP saw) (NP (DT the) (NN dog))))
+(S (NP (DT The) (NN mouse)) (VP (VBP saw) (NP (DT the) (NN cat))))
+(S (NP (DT The) (JJ little) (NN mouse)) (VP (VBP saw) (NP (DT the) (NN cat))))
+(S (NP (DT The) (NN cat)) (VP (VBP ate) (NP (DT the) (NN dog))))
+(S (NP (DT The) (NN mouse)) (VP (VBP ate) (NP (DT the) (NN cat))))
+"""
+	patterns = (('JJ', {0, 3}), ('VBP ate', {4, 5}),
+			(r'NP\|<.*', {0, 3}), ('S NP VP', set(range(6))))
+	items = [(binarize(tree), sent) for tree, sent
+			in map(brackettree, treebank.splitlines())]
+	params = getctrees(items)
+	for pattern, selected in patterns:
+		subset = selecttrees(params['trees1'], params['vocab'], pattern)
+		assert set(subset) == selected, pattern
+		# equivalent to extracting fragments from the selected trees only
+		result = extractfragments(params['trees1'], 0, 0, params['vocab'],
+				disc=True, approx=False, subset1=subset, subset2=subset)
+		params2 = getctrees([items[n] for n in sorted(selected)])
+		assert set(result) == set(extractfragments(params2['trees1'], 0, 0,
+				params2['vocab'], disc=True, approx=False)), pattern
+
+	tmpdir = tempfile.mkdtemp()
+	try:
+		filename = os.path.join(tmpdir, 'treebank.mrg')
+		with open(filename, 'w') as out:
+			out.write(treebank)
+
+		def run(*opts):
+			output = os.path.join(tmpdir, 'output.txt')
+			fragments.main(['--quiet', '--indices', '-o', output, filename]
+					+ list(opts))
+			with open(output) as inp:
+				return dict((frag, json.loads(indices)) for frag, indices
+						in (line.rstrip('\n').split('\t') for line in inp))
+
+		unrestricted = run()
+		for pattern, selected in patterns:
+			restricted = run('--restrict=' + pattern)
+			assert restricted, pattern
+			for frag, indices in restricted.items():
+				assert set(indices) <= selected, (pattern, frag)
+				assert frag in unrestricted, (pattern, frag)
+				assert len(indices) <= len(unrestricted[frag]), (pattern, frag)
+			if selected == set(range(6)):
+				assert restricted == unrestricted
+	finally:
+		shutil.rmtree(tmpdir)
 
 
 def test_allfragments():
@@ -593,6 +845,471 @@ def test_eval():
 	print(evaluator.summary())
 
 
+def test_bracketarray():
+	"""Brackets encoded as arrays are matched like multisets."""
+	from collections import Counter
+	from discodop.eval import bracketarray, stackbrackets, \
+			matchingbrackets, unmatchedbrackets, spanfanout, intervals
+	labelids = {}
+	# discontinuous spans, a span wider than 64 bits, and duplicates
+	gold = Counter({('S', 0b111111): 1, ('VP', 0b101001): 2,
+			('NP', 0b10110): 1, ('X', (1 << 70) | 0b11): 1})
+	cand = Counter({('S', 0b111111): 1, ('VP', 0b101001): 3,
+			('NP', 0b10010): 1, ('X', (1 << 70) | 0b11): 1, ('X', 0b11): 1})
+	goldarr = bracketarray(gold, labelids, 0)
+	candarr = bracketarray(cand, labelids, 0)
+	assert goldarr.shape == (5, 5) and candarr.shape == (7, 5)
+	goldidx, candidx = matchingbrackets(goldarr, candarr)
+	assert len(goldidx) == sum((gold & cand).values()) == 4
+	assert (goldarr[goldidx] == candarr[candidx]).all()
+	gunmatched, cunmatched = unmatchedbrackets(goldarr, candarr)
+	assert gunmatched.tolist() == [[0, labelids['NP'], 0, 0b10110, 0]]
+	assert cunmatched.tolist() == [[0, labelids['VP'], 0, 0b101001, 0],
+			[0, labelids['NP'], 0, 0b10010, 0], [0, labelids['X'], 0, 0b11, 0]]
+	assert spanfanout(goldarr).tolist() == [len(list(intervals(span)))
+			for (_, span), cnt in gold.items() for _ in range(cnt)]
+	# brackets of different sentences never match
+	other = bracketarray(Counter({('S', 0b111): 1}), labelids, 1)
+	narrow = bracketarray(Counter({('S', 0b111): 1}), labelids, 0)
+	stacked = stackbrackets([goldarr, other])
+	assert stacked.shape == (6, 5)
+	assert len(matchingbrackets(stacked, narrow)[0]) == 0
+	assert len(matchingbrackets(stacked, stackbrackets([other]))[0]) == 1
+
+
+def test_evalmerge():
+	"""Merging evaluators of parts gives the same result as a single one."""
+	from discodop.treebank import READERS
+	from discodop.eval import Evaluator, readparam
+	corpus = READERS['export']('alpinosample.export', punct='move')
+	items = list(corpus.itertrees())
+	param = readparam(None)
+	param['LA'] = param['TED'] = True
+	whole, first, second = (Evaluator(param) for _ in range(3))
+	for n, (key, item) in enumerate(items):
+		for evaluator in (whole, first if n == 0 else second):
+			evaluator.add(key, item.tree.copy(True), item.sent,
+					item.tree.copy(True), item.sent)
+	first.merge(second)
+	assert first.summary() == whole.summary()
+	assert first.acc.tagpairs == whole.acc.tagpairs
+	assert first.acc.labelcounts() == whole.acc.labelcounts()
+
+
+def test_treepairs():
+	"""Parses in a different order are paired with the right gold trees."""
+	from discodop.treebank import NegraCorpusReader
+	from discodop.eval import treepairs
+	tmpdir = tempfile.mkdtemp()
+	filename = os.path.join(tmpdir, 'sample.export')
+	try:
+		shutil.copy('alpinosample.export', filename)
+		gold = NegraCorpusReader(filename)
+		parses = NegraCorpusReader(filename)
+		keys = parses.keys()
+		parses.itertrees = lambda: (  # last sentence first
+				(key, parses.item(key)) for key in keys[-1:] + keys[:-1])
+		for key, golditem, parseitem in treepairs(gold, parses):
+			assert golditem.sent == parseitem.sent
+			assert str(golditem.tree) == str(parseitem.tree)
+		# after a skipped sentence, the gold corpus is read in lockstep again
+		parses.itertrees = lambda: (
+				(key, parses.item(key)) for key in keys[:1] + keys[2:])
+		gold.item = None
+		assert [key for key, golditem, parseitem
+				in treepairs(gold, parses)] == keys[:1] + keys[2:]
+		os.remove(filename + '.offsets')
+		assert NegraCorpusReader(filename).keys(writeindex=False) == keys
+		assert not os.path.exists(filename + '.offsets')
+	finally:
+		shutil.rmtree(tmpdir)
+
+
+def test_evalcache():
+	"""Results retrieved from the cache give the same scores."""
+	from discodop.treebank import READERS
+	from discodop.eval import Evaluator, readparam
+	from discodop.util import PersistentCache
+	corpus = READERS['export']('alpinosample.export', punct='move')
+	items = list(corpus.itertrees())
+	param = readparam(None)
+	param['LA'] = param['TED'] = True
+	tmpdir = tempfile.mkdtemp()
+	try:
+		cache = PersistentCache(os.path.join(tmpdir, 'evalcache.db'))
+		summaries = []
+		for _ in range(2):
+			evaluator = Evaluator(param, cache=cache)
+			for key, item in items:
+				evaluator.add(key, item.tree.copy(True), item.sent,
+						item.tree.copy(True), item.sent)
+			summaries.append(evaluator.summary())
+		assert summaries[0] == summaries[1]
+		assert cache.stats()['hits'] == len(items)
+		cache.close()
+	finally:
+		shutil.rmtree(tmpdir)
+
+
+def test_persistentcache():
+	"""The size of the cache is tracked and items are evicted in batches."""
+	import pickle
+	from discodop.util import PersistentCache
+	from discodop.treesearchutil import DiskCache
+	tmpdir = tempfile.mkdtemp()
+	try:
+		filename = os.path.join(tmpdir, 'cache.db')
+		cache = PersistentCache(filename, maxbytes=2000, lowwater=0.5)
+		cache.WRITEBATCH = 1  # write and evict after each item
+		for n in range(10):
+			cache[n] = 'x' * 200
+			cache[0]  # keep the first item recently used
+		size = len(pickle.dumps('x' * 200, protocol=pickle.HIGHEST_PROTOCOL))
+		# the 10th item exceeds maxbytes; the cache is reduced to half
+		assert cache.stats()['items'] == 1000 // size
+		assert cache.stats()['bytes'] == (1000 // size) * size
+		assert 0 in cache and 9 in cache and 1 not in cache
+		cache[9] = 'y'  # replacing an item updates the total size
+		del cache[0]
+		assert cache.stats()['bytes'] == cache.db.execute(
+				'SELECT TOTAL(size) FROM cache').fetchone()[0]
+		cache.close()
+
+		# new items are visible before they are written in a batch
+		cache = PersistentCache(os.path.join(tmpdir, 'batch.db'))
+		cache['a'] = 1
+		assert cache['a'] == 1 and 'a' in cache
+		assert cache.db.execute(
+				'SELECT COUNT(*) FROM cache').fetchone()[0] == 0
+		cache.close()
+		cache = PersistentCache(os.path.join(tmpdir, 'batch.db'))
+		assert cache['a'] == 1
+		cache.close()
+
+		# results are not reused after the corpus file has changed
+		corpus = os.path.join(tmpdir, 'corpus.txt')
+		with open(corpus, 'w') as out:
+			out.write('a')
+		cache = DiskCache('Searcher', filename, 10000, 100)
+		cache['counts', 'query', corpus] = 1
+		assert cache['counts', 'query', corpus] == 1
+		os.utime(corpus, (0, 0))
+		assert ('counts', 'query', corpus) not in cache
+		cache.close()
+	finally:
+		shutil.rmtree(tmpdir)
+
+
+def test_treesearchdiskcache():
+	"""Query results cached on disk are used by another searcher."""
+	from discodop.treesearch import RegexSearcher
+	tmpdir = tempfile.mkdtemp()
+	try:
+		filename = os.path.join(tmpdir, 'corpus.txt')
+		with open(filename, 'w') as out:
+			out.write('the cat\nthe dog\na cat\n')
+		with RegexSearcher([filename], numproc=1,
+				diskcache=1 << 20) as searcher:
+			expected = searcher.counts('the (cat|dog)')
+		with RegexSearcher([filename], numproc=1,
+				diskcache=1 << 20) as searcher:
+			assert searcher.cache.stats()['items'] == 1
+			assert searcher.counts('the (cat|dog)') == expected
+			assert searcher.cache.stats()['hits'] == 1
+	finally:
+		shutil.rmtree(tmpdir)
+
+
+def test_regextrigramindex():
+	"""The trigram index does not change the results of regex queries."""
+	from discodop.treesearch import RegexSearcher
+	queries = ['the (cat|dog)', 'c[ao]t', 'c[^a]t', r'\w+ing', r'\bcat\w*',
+			'^The', 'dog$', 'the (black|) cat', '(?i)the cat', r'cat\s+the',
+			r'dog\n\nA', 'cat[^x]the', 'sleeping cat|dogs']
+	tmpdir = tempfile.mkdtemp()
+	try:
+		filename = os.path.join(tmpdir, 'corpus.txt')
+		with open(filename, 'w') as out:
+			out.write('The cat saw the dog\nthe dog was sleeping\n'
+					'The black cat\nthe cat\n\nA dog saw the cot\n'
+					'THE CAT and the dogs\ncut the cat\n' * 3)
+		for ignorecase in (False, True):
+			plain = RegexSearcher([filename], numproc=1,
+					ignorecase=ignorecase)
+			indexed = RegexSearcher([filename], numproc=1,
+					ignorecase=ignorecase, trigramindex=True)
+			for query in queries:
+				for start, end in ((None, None), (3, 11)):
+					assert indexed.counts(query, start=start, end=end) == (
+							plain.counts(query, start=start, end=end)), query
+					assert indexed.counts(query, start=start, end=end,
+							indices=True) == plain.counts(query, start=start,
+							end=end, indices=True), query
+					assert indexed.sents(query, start=start, end=end,
+							maxresults=None) == plain.sents(query,
+							start=start, end=end, maxresults=None), query
+			plain.close()
+			indexed.close()
+	finally:
+		shutil.rmtree(tmpdir)
+
+
+def test_regexbatch():
+	"""Batches of regex queries give the same results as single queries."""
+	from discodop.treesearch import RegexSearcher
+	from discodop.treesearchutil import Subcorpus
+	queries = ['the cat', 'cat', 'the (cat|dog)', 'The cat', 'c[^a]t',
+			r'\w+', '^the', 'dog$', 'cat the', 'sleeping']
+	tmpdir = tempfile.mkdtemp()
+	try:
+		filenames = [os.path.join(tmpdir, 'corpus%d.txt' % n)
+				for n in range(2)]
+		for n, filename in enumerate(filenames):
+			with open(filename, 'w') as out:
+				out.write('The cat saw the dog\nthe dog was sleeping\n\n'
+						'the cat\ncut the cat the cat\n' * (n + 2))
+		odd = Subcorpus({filename: range(1, 10, 2) for filename in filenames})
+		for numproc in (1, 2):
+			searcher = RegexSearcher(filenames, numproc=numproc)
+			for start, end, restrict in ((None, None, None), (2, 7, None),
+					(None, None, odd), (2, 7, odd)):
+				expected = {filename: [] for filename in filenames}
+				for query in queries:
+					for filename, cnt in searcher.counts(query, start=start,
+							end=end, restrict=restrict).items():
+						expected[filename].append(cnt)
+				assert {filename: list(counts) for filename, counts
+						in searcher.batchcounts(queries, start=start, end=end,
+						restrict=restrict)} == expected
+				if restrict is not None:
+					continue
+				expected = {filename: [] for filename in filenames}
+				for query in queries:
+					for match in searcher.sents(query, start=start, end=end,
+							maxresults=None):
+						expected[match[0]].append(match[1:])
+				assert dict(searcher.batchsents(queries, start=start,
+						end=end, maxresults=None)) == expected
+			searcher.close()
+	finally:
+		shutil.rmtree(tmpdir)
+
+
+def test_tgrep():
+	"""Each family of tgrep operators on a fixed tree."""
+	from discodop.tgrep import TgrepTree, TgrepQuery
+	labels, parents, leaves = [], [], []
+
+	def visit(node, parent):
+		labels.append(node.label)
+		parents.append(parent)
+		leaves.append(-1)
+		parent = len(labels) - 1
+		for child in node:
+			if isinstance(child, Tree):
+				visit(child, parent)
+			else:
+				labels.append(child)
+				parents.append(parent)
+				leaves.append(sum(1 for a in leaves if a >= 0))
+
+	# node indices in pre-order, with words as nodes:
+	# 0 S; 1 NP 2 DT 3 the 4 JJ 5 big 6 NN 7 cat;
+	# 8 VP 9 VB 10 sat 11 PP 12 IN 13 on 14 NP 15 DT 16 the 17 NN 18 mat;
+	# 19 ADVP 20 RB 21 today
+	visit(Tree.parse('(S (NP (DT the) (JJ big) (NN cat)) (VP (VB sat) '
+			'(PP (IN on) (NP (DT the) (NN mat)))) (ADVP (RB today)))',
+			parse_leaf=None), -1)
+	tree = TgrepTree(labels, parents, leaves)
+	queries = [
+			# <N, <-N, >N, >-N
+			('NP <2 JJ', [1]), ('NP <3 NN', [1]), ('NP <-1 NN', [1, 14]),
+			('S <-2 VP', [0]), ('VP <-1 PP', [8]), ('NP <4 *', []),
+			('JJ >2 NP', [4]), ('NN >-1 NP', [6, 17]),
+			# <, <- <` and their inverses
+			('NP <, DT', [1, 14]), ('S <- ADVP', [0]), ('S <` ADVP', [0]),
+			('NP <- JJ', []), ('DT >, NP', [2, 15]), ('ADVP >- S', [19]),
+			('ADVP >` S', [19]),
+			# <: >:
+			('ADVP <: RB', [19]), ('* <: the', [2, 15]), ('NP <: NN', []),
+			('RB >: ADVP', [20]),
+			# <<, <<` <<: and their inverses
+			('* <<, the', [0, 1, 2, 14, 15]), ('* <<` mat', [8, 11, 14, 17]),
+			('* <<: today', [19, 20]), ('S <<: RB', []),
+			('the >>, S', [3]), ('mat >>` VP', [18]), ('RB >>: ADVP', [20]),
+			# . .. , ,,
+			('NP . VB', [1]), ('JJ . NN', [4]), ('VB .. NN', [9]),
+			('DT .. NN', [2, 15]), ('NN , JJ', [6]), ('NN ,, VB', [17]),
+			('DT , IN', [15]), ('ADVP , NP', [19]),
+			# $ $. $, $.. $,,
+			('DT $ NN', [2, 15]), ('DT $. JJ', [2]), ('DT $. NN', [15]),
+			('NN $, JJ', [6]), ('VP $, NP', [8]), ('DT $.. NN', [2, 15]),
+			('NN $,, DT', [6, 17]), ('ADVP $,, NP', [19]),
+			('NP $.. ADVP', [1]),
+			# negation
+			('NP !< JJ', [14]), ('NP !<< cat', [14]), ('!NP < DT', []),
+			('NP !$. *', [14]), ('DT !, *', [2]),
+			('!/^[A-Z]/ !> DT', [5, 7, 10, 13, 18, 21]),
+			# grouping and disjunction of relations
+			('NP [< JJ | $, IN]', [1, 14]), ('NP [< JJ | $, VB]', [1]),
+			('VP [< NP | < PP] < VB', [8]), ('VP [< NP | < ADVP]', []),
+			('NP ![< JJ | $, VB]', [14]), ('NP < JJ | $, IN', [1, 14]),
+			('NP < (DT < the) < (NN [< cat | < mat])', [1, 14]),
+			]
+	for query, expected in queries:
+		pattern = TgrepQuery(query)
+		assert pattern.findall(tree) == expected, (query, expected)
+		# a tree can only match if it contains the required labels
+		if expected:
+			assert all(any(req(label) for label in labels)
+					for req in pattern.required), query
+
+
+SEARCHCORPUS = """\
+(S (NP (DT The) (NN cat)) (VP (VBP saw) (NP (DT the) (JJ hungry) (NN dog))))
+(S (NP (DT The) (NN cat)) (VP (VBP saw) (NP (DT the) (NN dog))))
+(S (NP (DT The) (NN mouse)) (VP (VBP saw) (NP (DT the) (NN cat))))
+(S (NP (DT The) (JJ little) (NN mouse)) (VP (VBP saw) (NP (DT the) (NN cat))))
+(S (NP (DT The) (NN cat)) (VP (VBP ate) (NP (DT the) (NN dog))))
+(S (NP (DT The) (NN mouse)) (VP (VBP ate) (NP (DT the) (NN cat))))
+"""
+
+
+def searchers(tmpdir):
+	"""Create corpora and yield each searcher with a query and methods."""
+	from discodop import treesearch
+	from discodop.util import which
+	treebanks, textfiles = [], []
+	for n in range(2):
+		treebanks.append(os.path.join(tmpdir, 'corpus%d.mrg' % n))
+		textfiles.append(os.path.join(tmpdir, 'corpus%d.txt' % n))
+		with open(treebanks[-1], 'w') as out:
+			out.write(SEARCHCORPUS * (n + 2))
+		with open(textfiles[-1], 'w') as out:
+			out.write(''.join(' '.join(re.findall(r' ([^ ()]+)\)', line))
+					+ '\n' for line in SEARCHCORPUS.splitlines()) * (n + 2))
+	yield (treesearch.FragmentSearcher(treebanks, numproc=1),
+			'(NP (DT the) (NN cat))', ('counts', 'sents', 'trees'))
+	yield (treesearch.NativeTgrepSearcher(treebanks, numproc=1),
+			'NP < (NN < cat)', ('counts', 'sents', 'trees'))
+	try:
+		which('tgrep2')
+	except ValueError:
+		pass
+	else:
+		yield (treesearch.TgrepSearcher(treebanks, numproc=1),
+				'NP < (NN < cat)', ('counts', 'sents', 'trees'))
+	yield (treesearch.RegexSearcher(textfiles, numproc=1),
+			'the (cat|dog)', ('counts', 'sents'))
+
+
+def test_treesearchasync():
+	"""The asynchronous query methods give the same results as the others."""
+	if sys.version_info < (3, 7):
+		return
+	import asyncio
+
+	def collect(agen):
+		result = []
+		while True:
+			try:
+				result.append(loop.run_until_complete(agen.__anext__()))
+			except StopAsyncIteration:  # pylint: disable=undefined-variable
+				return result
+
+	tmpdir = tempfile.mkdtemp()
+	loop = asyncio.new_event_loop()
+	try:
+		for searcher, query, methods in searchers(tmpdir):
+			with searcher:
+				for method in methods:
+					expected = getattr(searcher, method)(query)
+					result = collect(getattr(searcher, 'a' + method)(query))
+					assert sorted(f for f, _ in result) == sorted(
+							searcher.files), method
+					if method == 'counts':
+						assert dict(result) == expected
+					else:  # results of the same file are contiguous
+						assert [x for _, results in sorted(result)
+								for x in results] == expected
+				queries = [query, query.replace('cat', 'dog')]
+				expected = {filename: list(counts) for filename, counts
+						in searcher.batchcounts(queries, start=2, end=9)}
+				assert {filename: list(counts) for filename, counts
+						in collect(searcher.abatchcounts(
+							queries, start=2, end=9))} == expected
+				assert searcher._asyncpool is not None
+			assert searcher._asyncpool is None and searcher.pool is None
+	finally:
+		loop.close()
+		shutil.rmtree(tmpdir)
+
+
+def test_treesearchpages():
+	"""Concatenated pages are equal to the results without paging."""
+	from discodop.treesearchutil import Subcorpus
+	tmpdir = tempfile.mkdtemp()
+	try:
+		for searcher, query, methods in searchers(tmpdir):
+			with searcher:
+				odd = Subcorpus({filename: range(1, 20, 2)
+						for filename in searcher.files})
+				for method in methods:
+					if method == 'counts':
+						continue
+					for restrict in (None, odd):
+						searcher.cache.clear()
+						paged, cursor = [], None
+						while True:
+							page, cursor = getattr(
+									searcher, method + 'page')(
+									query, cursor, pagesize=2,
+									restrict=restrict)
+							paged.extend(page)
+							if cursor is None:
+								break
+						# paging does not store results in the cache
+						assert len(searcher.cache) == 0, type(searcher)
+						assert paged == getattr(searcher, method)(
+								query, maxresults=None, restrict=restrict
+								), (type(searcher), method)
+	finally:
+		shutil.rmtree(tmpdir)
+
+
+def test_fragmentquery():
+	"""A compiled query can be reused on a corpus with another vocabulary."""
+	import pickle
+	from discodop.treesearch import FragmentSearcher
+	query = '(NP (DT the) (NN cat))\n(VP (VBP saw) (NP ))'
+	tmpdir1, tmpdir2 = tempfile.mkdtemp(), tempfile.mkdtemp()
+	try:
+		with open(os.path.join(tmpdir1, 'a.mrg'), 'w') as out:
+			out.write(SEARCHCORPUS)
+		with open(os.path.join(tmpdir2, 'b.mrg'), 'w') as out:
+			out.write('(S (NP (NN dog)) (VP (VBZ barks)))\n' + SEARCHCORPUS)
+		searcher1 = FragmentSearcher([os.path.join(tmpdir1, 'a.mrg')])
+		searcher2 = FragmentSearcher([os.path.join(tmpdir2, 'b.mrg')])
+		cquery = pickle.loads(pickle.dumps(searcher1.compile(query)))
+		expected = searcher2.sents(query, maxresults=None)
+		counts = list(searcher2.batchcounts(query.splitlines()))
+		searcher2.cache.clear()
+		searcher2.compiled.clear()
+		orig = FragmentSearcher._parse_query
+		try:
+			FragmentSearcher._parse_query = None  # must not be parsed again
+			assert searcher2.sents(cquery, maxresults=None) == expected
+			assert list(searcher2.batchcounts(cquery)) == counts
+		finally:
+			FragmentSearcher._parse_query = orig
+		assert searcher2.compile(cquery).vocabkey != cquery.vocabkey
+		searcher1.close()
+		searcher2.close()
+	finally:
+		shutil.rmtree(tmpdir1)
+		shutil.rmtree(tmpdir2)
+
+
 def test_punct():
 	"""Verify that punctuation movement does not increase fan-out."""
 	def phrasal(x):
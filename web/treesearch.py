@@ -44,6 +44,7 @@ from discodop.util import which
 
 DEBUG = False  # when True: enable debugging interface, disable multiprocessing
 INMEMORY = False  # keep corpora in memory
+DISKCACHE = 1 << 30  # max bytes of query results cached on disk; 0 to disable
 NUMPROC = None  # None==use all cores
 MINFREQ = 2  # filter out fragments which occur just once or twice
 MINNODES = 3  # filter out fragments with only three nodes (CFG productions)
@@ -1106,17 +1107,20 @@ def getcorpus():
 	tokfiles = sorted(glob.glob(os.path.join(CORPUS_DIR, '*.tok')))
 	if tfiles and set(tfiles) != set(corpora.get('tgrep2', ())):
 		corpora['tgrep2'] = treesearch.TgrepSearcher(
-				tfiles, macros='static/tgrepmacros.txt', numproc=NUMPROC)
+				tfiles, macros='static/tgrepmacros.txt', numproc=NUMPROC,
+				diskcache=DISKCACHE)
 		log.info('tgrep2 corpus loaded.')
 	if ffiles and set(ffiles) != set(corpora.get('frag', ())):
 		corpora['frag'] = treesearch.FragmentSearcher(
 				ffiles, macros='static/fragmacros.txt',
-				inmemory=INMEMORY, numproc=1 if DEBUG else NUMPROC)
+				inmemory=INMEMORY, numproc=1 if DEBUG else NUMPROC,
+				diskcache=DISKCACHE)
 		log.info('frag corpus loaded.')
 	if tokfiles and set(tokfiles) != set(corpora.get('regex', ())):
 		corpora['regex'] = treesearch.RegexSearcher(
 				tokfiles, macros='static/regexmacros.txt',
-				inmemory=INMEMORY, numproc=1 if DEBUG else NUMPROC)
+				inmemory=INMEMORY, numproc=1 if DEBUG else NUMPROC,
+				diskcache=DISKCACHE)
 		log.info('regex corpus loaded.')
 
 	assert tfiles or ffiles or tokfiles, (